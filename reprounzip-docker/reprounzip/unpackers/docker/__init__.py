@@ -13,8 +13,8 @@ See http://www.docker.io/
 from __future__ import division, print_function, unicode_literals
 
 import argparse
+import hashlib
 from itertools import chain
-import json
 import logging
 import os
 import re
@@ -22,8 +22,9 @@ from rpaths import Path, PosixPath
 import socket
 import subprocess
 import sys
+import tarfile
 
-from reprounzip.common import load_config, record_usage, RPZPack
+from reprounzip.common import record_usage, RPZPack
 from reprounzip import signals
 from reprounzip.parameters import get_parameter
 from reprounzip.unpackers.common import COMPAT_OK, COMPAT_MAYBE, \
@@ -31,20 +32,31 @@ from reprounzip.unpackers.common import COMPAT_OK, COMPAT_MAYBE, \
     make_unique_name, shell_escape, select_installer, busybox_url, sudo_url, \
     FileUploader, FileDownloader, get_runs, add_environment_options, \
     fixup_environment, interruptible_call, metadata_read, metadata_write, \
-    metadata_initial_iofiles, metadata_update_run, parse_ports
+    metadata_update, metadata_initial_iofiles, metadata_update_run, \
+    parse_ports, delta_hashes_command, parse_block_hashes, \
+    delta_write_command, load_target_config
 from reprounzip.unpackers.common.x11 import X11Handler, LocalForwarder
+from reprounzip.unpackers.docker.client import DockerError, get_client
 from reprounzip.utils import unicode_, iteritems, stderr, join_root, \
-    download_file
+    download_files, copyfile
 
 
 logger = logging.getLogger('reprounzip.docker')
 
 
+# Command keeping a container running, so we can exec commands in it
+KEEP_ALIVE_CMD = ['/busybox', 'sh', '-c',
+                  'while true; do /busybox sleep 3600; done']
+
+
 # How this all works:
 #  - setup/create just copies file to the target directory and writes the
-#    Dockerfile
-#  - setup/build creates the image and stores it in the unpacker info as
-#    'initial_image' and 'current_image'
+#    Dockerfile. If packages need to be installed, this is done in a separate
+#    image 'packages_image' (from packages/Dockerfile) whose name only depends
+#    on the base image and the packages
+#  - setup/build creates the packages image if it doesn't exist yet, then
+#    creates the image and stores it in the unpacker info as 'initial_image'
+#    and 'current_image'
 #  - run runs a container from 'current_image', the commits it into the new
 #    'current_image'
 #  - upload creates a Dockerfile in a temporary directory, copies all the files
@@ -56,6 +68,13 @@ logger = logging.getLogger('reprounzip.docker')
 # This means that a lot of images will get layered on top of each other,
 # unfortunately this is necessary so that successive runs carry over the global
 # state as expected.
+# Most of these operations go through the Docker Engine API over the daemon's
+# UNIX socket if it is available (see client.py), falling back on the docker
+# command otherwise; run always calls the command, since it needs a terminal.
+# With 'run --keep-container', a container is started from 'current_image' and
+# stored as 'kept_container'; runs happen in it with docker exec, and upload
+# and download copy files to and from it directly. The 'commit' command turns
+# it into a new 'current_image'.
 
 
 def select_image(runs):
@@ -112,6 +131,95 @@ def read_dict(path):
     return metadata_read(path, 'docker')
 
 
+def update_dict(path):
+    return metadata_update(path, 'docker')
+
+
+def packages_image_name(base_image, packages, scripts):
+    """Computes the name of the image with the packages installed.
+
+    The name is derived from the base image, the installed packages (with
+    their versions) and the commands used to install them, so that an existing
+    image can be reused if another experiment needs the exact same packages.
+    """
+    h = hashlib.sha256()
+    h.update(base_image.encode('utf-8') + b'\n')
+    for name, version in sorted((pkg.name, pkg.version) for pkg in packages):
+        h.update(('%s=%s\n' % (name, version)).encode('utf-8'))
+    for script in scripts:
+        h.update(script.encode('utf-8') + b'\n')
+    return b'reprounzip_packages_' + h.hexdigest()[:16].encode('ascii')
+
+
+def get_docker(args, options=()):
+    """Gets the client used to talk to Docker, from the command-line options.
+    """
+    return get_client(args.docker_cmd.split(), use_api=args.docker_api,
+                      options=options)
+
+
+def remove_container(client, container):
+    """Forcibly removes a container, ignoring errors.
+    """
+    try:
+        client.remove_container(container, force=True)
+    except DockerError:
+        pass
+
+
+def remove_kept_container(client, unpacked_info):
+    """Removes the container left running by ``run --keep-container``.
+
+    Whatever was done in that container and not committed is lost.
+    """
+    container = unpacked_info.pop('kept_container', None)
+    if container is None:
+        return
+    logger.info("Removing container %s", container.decode('ascii'))
+    try:
+        client.remove_container(container, force=True)
+    except DockerError as e:
+        logger.warning("Can't remove container: %s", e)
+
+
+def write_filtered_data(rpz_pack, pathlist, target):
+    """Writes a tarball containing only the selected paths from the pack.
+
+    The 'DATA' prefix is removed from the member names, so that the tarball
+    can be extracted at the root of the image by an ``ADD`` instruction. This
+    way, only the files that are needed get sent to Docker, and they end up in
+    a single layer without a copy of the tarball.
+    """
+    wanted = set(join_root(rpz_pack.data_prefix, p) for p in pathlist)
+    written = set()
+    tar = tarfile.open(str(target), 'w')
+    try:
+        for member in rpz_pack.list_data():
+            path = PosixPath(member.name)
+            if path not in wanted:
+                continue
+            fileobj = None
+            if member.islnk():
+                link = PosixPath(member.linkname)
+                if link in written:
+                    member.linkname = str(rpz_pack.remove_data_prefix(link))
+                else:
+                    # The target of the hard link was not selected, store the
+                    # content as a regular file instead
+                    link_target = rpz_pack.data.getmember(member.linkname)
+                    fileobj = rpz_pack.data.extractfile(link_target)
+                    member.type = tarfile.REGTYPE
+                    member.linkname = ''
+                    member.size = link_target.size
+            elif member.isreg():
+                fileobj = rpz_pack.data.extractfile(member)
+            member.name = str(rpz_pack.remove_data_prefix(path))
+            tar.addfile(member, fileobj)
+            written.add(path)
+    finally:
+        tar.close()
+
+
 def docker_setup(args):
     """Does both create and build.
 
@@ -144,8 +252,7 @@ def docker_setup_create(args):
         rpz_pack.extract_config(target / 'config.yml')
 
         # Loads config
-        runs, packages, other_files = config = load_config(
-            target / 'config.yml', True)
+        runs, packages, other_files = config = load_target_config(target)
 
         if args.base_image:
             record_usage(docker_explicit_base=True)
@@ -159,60 +266,74 @@ def docker_setup_create(args):
         logger.info("Using base image %s", base_image)
         logger.debug("Distribution: %s", target_distribution or "unknown")
 
-        rpz_pack.copy_data_tar(target / 'data.tgz')
+        if not args.filter_data:
+            rpz_pack.copy_data_tar(target / 'data.tgz')
 
         arch = runs[0]['architecture']
 
+        if args.install_pkgs:
+            # Install every package through package manager
+            missing_packages = []
+        else:
+            # Only install packages that were not packed
+            missing_packages = [pkg for pkg in packages if pkg.packfiles]
+            packages = [pkg for pkg in packages if not pkg.packfiles]
+        packages_image = None
+        if packages:
+            record_usage(docker_install_pkgs=True)
+            try:
+                installer = select_installer(pack, runs,
+                                             target_distribution)
+            except CantFindInstaller as e:
+                logger.error("Need to install %d packages but couldn't "
+                             "select a package installer: %s",
+                             len(packages), e)
+                sys.exit(1)
+            pkg_cmds = []
+            # Updates package sources
+            update_script = installer.update_script()
+            if update_script:
+                pkg_cmds.append(update_script)
+            # Installs necessary packages
+            pkg_cmds.append(installer.install_script(
+                sorted(packages, key=lambda pkg: pkg.name)))
+
+            # Packages are installed in a separate image, named after the base
+            # image and the packages, so it can be shared between experiments
+            packages_image = packages_image_name(base_image, packages,
+                                                 pkg_cmds)
+            (target / 'packages').mkdir()
+            logger.info("Writing %s...", target / 'packages/Dockerfile')
+            with (target / 'packages/Dockerfile').open(
+                    'w', encoding='utf-8', newline='\n') as fp:
+                fp.write('FROM %s\n\n' % base_image)
+                fp.write('RUN \\\n    %s\n' % ' && \\\n    '.join(pkg_cmds))
+            logger.info("Dockerfile will install the %d software "
+                        "packages that were not packed", len(packages))
+        else:
+            record_usage(docker_install_pkgs=False)
+
         # Writes Dockerfile
         logger.info("Writing %s...", target / 'Dockerfile')
         with (target / 'Dockerfile').open('w', encoding='utf-8',
                                           newline='\n') as fp:
-            fp.write('FROM %s\n\n' % base_image)
+            if packages_image is not None:
+                fp.write('FROM %s\n\n' % packages_image.decode('ascii'))
+            else:
+                fp.write('FROM %s\n\n' % base_image)
 
-            # Installs busybox
-            download_file(busybox_url(arch),
-                          target / 'busybox',
-                          'busybox-%s' % arch)
+            # Installs busybox and rpzsudo, downloaded concurrently
+            download_files([(busybox_url(arch), target / 'busybox',
+                             'busybox-%s' % arch),
+                            (sudo_url(arch), target / 'rpzsudo',
+                             'rpzsudo-%s' % arch)])
             fp.write('COPY busybox /busybox\n')
-
-            # Installs rpzsudo
-            download_file(sudo_url(arch),
-                          target / 'rpzsudo',
-                          'rpzsudo-%s' % arch)
             fp.write('COPY rpzsudo /rpzsudo\n\n')
 
-            fp.write('COPY data.tgz /reprozip_data.tgz\n\n')
-            fp.write('COPY rpz-files.list /rpz-files.list\n')
-            fp.write('RUN \\\n'
-                     '    chmod +x /busybox /rpzsudo && \\\n')
-
-            if args.install_pkgs:
-                # Install every package through package manager
-                missing_packages = []
-            else:
-                # Only install packages that were not packed
-                missing_packages = [pkg for pkg in packages if pkg.packfiles]
-                packages = [pkg for pkg in packages if not pkg.packfiles]
-            if packages:
-                record_usage(docker_install_pkgs=True)
-                try:
-                    installer = select_installer(pack, runs,
-                                                 target_distribution)
-                except CantFindInstaller as e:
-                    logger.error("Need to install %d packages but couldn't "
-                                 "select a package installer: %s",
-                                 len(packages), e)
-                    sys.exit(1)
-                # Updates package sources
-                update_script = installer.update_script()
-                if update_script:
-                    fp.write('    %s && \\\n' % update_script)
-                # Installs necessary packages
-                fp.write('    %s && \\\n' % installer.install_script(packages))
-                logger.info("Dockerfile will install the %d software "
-                            "packages that were not packed", len(packages))
-            else:
-                record_usage(docker_install_pkgs=False)
+            if not args.filter_data:
+                fp.write('COPY data.tgz /reprozip_data.tgz\n\n')
+                fp.write('COPY rpz-files.list /rpz-files.list\n')
+            run_cmds = ['chmod +x /busybox /rpzsudo']
 
             # Untar
             paths = set()
@@ -239,22 +360,42 @@ def docker_setup_create(args):
                         pathlist.append(path)
                     else:
                         logger.info("Missing file %s", path)
-            rpz_pack.close()
-            # FIXME : for some reason we need reversed() here, I'm not sure why
-            # Need to read more of tar's docs.
-            # TAR bug: --no-overwrite-dir removes --keep-old-files
-            with (target / 'rpz-files.list').open('wb') as lfp:
-                for p in reversed(pathlist):
-                    lfp.write(join_root(rpz_pack.data_prefix, p).path)
-                    lfp.write(b'\0')
-            fp.write('    cd / && '
-                     '(tar zpxf /reprozip_data.tgz -U --recursive-unlink '
-                     '--numeric-owner --strip=1 --null -T /rpz-files.list || '
-                     '/busybox echo "TAR reports errors, this might or might '
-                     'not prevent the execution to run")\n')
+
+            if args.filter_data:
+                # Only the selected files go in the build context, and the
+                # Dockerfile adds them directly to the image
+                logger.info("Writing filtered data to %s...",
+                            target / 'data.tar')
+                write_filtered_data(rpz_pack, pathlist, target / 'data.tar')
+                rpz_pack.close()
+                fp.write('RUN \\\n    %s\n\n' %
+                         ' && \\\n    '.join(run_cmds))
+                fp.write('ADD data.tar /\n')
+            else:
+                rpz_pack.close()
+                # FIXME : for some reason we need reversed() here, I'm not
+                # sure why. Need to read more of tar's docs.
+                # TAR bug: --no-overwrite-dir removes --keep-old-files
+                with (target / 'rpz-files.list').open('wb') as lfp:
+                    for p in reversed(pathlist):
+                        lfp.write(join_root(rpz_pack.data_prefix, p).path)
+                        lfp.write(b'\0')
+                run_cmds.append(
+                    'cd / && '
+                    '(tar zpxf /reprozip_data.tgz -U --recursive-unlink '
+                    '--numeric-owner --strip=1 --null -T /rpz-files.list || '
+                    '/busybox echo "TAR reports errors, this might or might '
+                    'not prevent the execution to run")')
+                fp.write('RUN \\\n    %s\n' %
+                         ' && \\\n    '.join(run_cmds))
 
         # Meta-data for reprounzip
-        write_dict(target, metadata_initial_iofiles(config))
+        unpacked_info = metadata_initial_iofiles(config)
+        if args.filter_data:
+            unpacked_info['filtered_data'] = True
+        if packages_image is not None:
+            unpacked_info['packages_image'] = packages_image
+        write_dict(target, unpacked_info)
 
         signals.post_setup(target=target, pack=pack)
     except Exception:
@@ -279,18 +420,30 @@ def docker_setup_build(args):
     else:
         image = make_unique_name(b'reprounzip_image_')
 
-    logger.info("Calling 'docker build'...")
+    client = get_docker(args, args.docker_option)
+
+    packages_image = unpacked_info.get('packages_image')
+    if packages_image is not None:
+        if client.inspect_image(packages_image) is not None:
+            logger.info("Reusing existing image %s with the packages "
+                        "installed", packages_image.decode('ascii'))
+        else:
+            logger.info("Building image to install packages...")
+            try:
+                client.build(packages_image, target / 'packages',
+                             args.docker_option)
+            except DockerError as e:
+                logger.critical("%s", e)
+                sys.exit(1)
+            logger.info("Package image created: %s",
+                        packages_image.decode('ascii'))
+
+    logger.info("Building image...")
     try:
-        retcode = subprocess.call(args.docker_cmd.split() + ['build', '-t'] +
-                                  args.docker_option + [image, '.'],
-                                  cwd=target.path)
-    except OSError:
-        logger.critical("docker executable not found")
+        client.build(image, target, args.docker_option)
+    except DockerError as e:
+        logger.critical("%s", e)
         sys.exit(1)
-    else:
-        if retcode != 0:
-            logger.critical("docker build failed with code %d", retcode)
-            sys.exit(1)
     logger.info("Initial image created: %s", image.decode('ascii'))
 
     unpacked_info['initial_image'] = image
@@ -324,15 +477,21 @@ def docker_reset(args):
     image = unpacked_info['current_image']
     initial = unpacked_info['initial_image']
 
+    client = get_docker(args)
+
+    if 'kept_container' in unpacked_info:
+        remove_kept_container(client, unpacked_info)
+        write_dict(target, unpacked_info)
+
     if image == initial:
         logger.warning("Image is already in the initial state, nothing to "
                        "reset")
     else:
         logger.info("Removing image %s", image.decode('ascii'))
-        retcode = subprocess.call(args.docker_cmd.split() + ['rmi', image])
-        if retcode != 0:
-            logger.warning("Can't remove previous image, docker returned %d",
-                           retcode)
+        try:
+            client.remove_image(image)
+        except DockerError as e:
+            logger.warning("Can't remove previous image: %s", e)
         unpacked_info['current_image'] = initial
         write_dict(target, unpacked_info)
 
@@ -408,9 +567,12 @@ def docker_run(args):
     if args.detach and args.x11:
         logger.critical("Error: Can't use X11 forwarding if you're detaching")
         raise UsageError
+    if args.detach and args.keep_container:
+        logger.critical("Error: Can't keep the container if you're detaching")
+        raise UsageError
 
     # Loads config
-    config = load_config(target / 'config.yml', True)
+    config = load_target_config(target)
     runs = config.runs
 
     selected_runs = get_runs(runs, args.run, cmdline)
@@ -423,6 +585,8 @@ def docker_run(args):
         logger.critical("Image doesn't exist yet, have you run setup/build?")
         sys.exit(1)
 
+    client = get_docker(args)
+
     # Name of new container
     if args.detach:
         container = make_unique_name(b'reprounzip_detached_')
@@ -500,6 +664,23 @@ def docker_run(args):
     for port, connector in x11.port_forward:
         forwarders.append(LocalForwarder(connector, port))
 
+    if args.keep_container:
+        retcode = run_in_kept_container(args, target, unpacked_info, image,
+                                        hostname, port_options, cmds)
+        stderr.write("\n*** Command finished, status: %d\n" % retcode)
+
+        # Update input file status
+        with update_dict(target) as unpacked_info:
+            metadata_update_run(config, unpacked_info, selected_runs)
+
+        signals.post_run(target=target, retcode=retcode)
+        return
+    elif 'kept_container' in unpacked_info:
+        logger.warning("Container %s was kept by a previous run, but this "
+                       "run starts from the image and won't see changes made "
+                       "there; use --keep-container or the 'commit' command",
+                       unpacked_info['kept_container'].decode('ascii'))
+
     if args.detach:
         logger.info("Start container %s (detached)",
                     container.decode('ascii'))
@@ -512,7 +693,7 @@ def docker_run(args):
                                      [image, '/busybox', 'sh', '-c', cmds])
         if retcode != 0:
             logger.critical("docker run failed with code %d", retcode)
-            subprocess.call(['docker', 'rm', '-f', container])
+            remove_container(client, container)
             sys.exit(1)
         return
 
@@ -527,57 +708,156 @@ def docker_run(args):
                                  [image, '/busybox', 'sh', '-c', cmds],
                                  request_tty=True)
 
-    # Get exit status from "docker inspect"
+    # Get exit status from the stopped container
     try:
-        out = subprocess.check_output(args.docker_cmd.split() +
-                                      ['inspect', container])
-    except subprocess.CalledProcessError:
+        retcode = client.wait_container(container)
+    except DockerError:
         logger.critical("docker run failed with code %d", retcode)
-        subprocess.call(['docker', 'rm', '-f', container])
+        remove_container(client, container)
         sys.exit(1)
-    outjson = json.loads(out.decode('ascii'))
-    if (outjson[0]["State"]["Running"] is not False or
-            outjson[0]["State"]["Paused"] is not False):
-        logger.error("Invalid container state after execution:\n%s",
-                     json.dumps(outjson[0]["State"]))
-    retcode = outjson[0]["State"]["ExitCode"]
     stderr.write("\n*** Command finished, status: %d\n" % retcode)
 
     # Commit to create new image
     new_image = make_unique_name(b'reprounzip_image_')
     logger.info("Committing container %s to image %s",
                 container.decode('ascii'), new_image.decode('ascii'))
-    subprocess.check_call(args.docker_cmd.split() +
-                          ['commit', container, new_image])
+    try:
+        client.commit(container, new_image)
+    except DockerError as e:
+        logger.critical("%s", e)
+        sys.exit(1)
 
     # Update image name
-    unpacked_info['current_image'] = new_image
-    write_dict(target, unpacked_info)
+    with update_dict(target) as unpacked_info:
+        unpacked_info['current_image'] = new_image
 
     # Remove the container
     logger.info("Destroying container %s", container.decode('ascii'))
-    retcode = subprocess.call(args.docker_cmd.split() + ['rm', container])
-    if retcode != 0:
+    try:
+        client.remove_container(container)
+    except DockerError:
         logger.error("Error deleting container %s", container.decode('ascii'))
 
     # Untag previous image, unless it is the initial_image
     if image != unpacked_info['initial_image']:
         logger.info("Untagging previous image %s", image.decode('ascii'))
-        subprocess.check_call(args.docker_cmd.split() + ['rmi', image])
+        try:
+            client.remove_image(image)
+        except DockerError as e:
+            logger.warning("Can't remove previous image: %s", e)
 
     # Update input file status
-    metadata_update_run(config, unpacked_info, selected_runs)
-    write_dict(target, unpacked_info)
+    with update_dict(target) as unpacked_info:
+        metadata_update_run(config, unpacked_info, selected_runs)
 
     signals.post_run(target=target, retcode=retcode)
 
 
+def run_in_kept_container(args, target, unpacked_info, image, hostname,
+                          port_options, cmds):
+    """Runs the commands in the container kept for this target.
+
+    The container is created (or restarted) if needed, then the commands are
+    run in it using ``docker exec``. Nothing gets committed.
+    """
+    docker_cmd = args.docker_cmd.split()
+    client = get_docker(args)
+    container = unpacked_info.get('kept_container')
+    state = None
+    if container is not None:
+        state = client.inspect_container(container)
+        if state is None:
+            logger.warning("Container %s doesn't exist anymore, changes made "
+                           "in it are lost", container.decode('ascii'))
+    if state is None:
+        container = make_unique_name(b'reprounzip_kept_')
+        logger.info("Starting container %s", container.decode('ascii'))
+        retcode = subprocess.call(docker_cmd +
+                                  ['run', b'--name=' + container,
+                                   '-h', hostname,
+                                   '-d'] +
+                                  port_options +
+                                  args.docker_option +
+                                  [image] + KEEP_ALIVE_CMD)
+        if retcode != 0:
+            logger.critical("docker run failed with code %d", retcode)
+            remove_container(client, container)
+            sys.exit(1)
+        unpacked_info['kept_container'] = container
+        write_dict(target, unpacked_info)
+    else:
+        if port_options:
+            logger.warning("Container already exists, ports can't be exposed "
+                           "anymore")
+        if not state['State']['Running']:
+            logger.info("Restarting container %s", container.decode('ascii'))
+            try:
+                client.start_container(container)
+            except DockerError as e:
+                logger.critical("%s", e)
+                sys.exit(1)
+
+    logger.info("Running in container %s", container.decode('ascii'))
+    return interruptible_call(docker_cmd +
+                              ['exec', '-i', '-t', container,
+                               '/busybox', 'sh', '-c', cmds],
+                              request_tty=True)
+
+
+@target_must_exist
+def docker_commit(args):
+    """Commits the container kept by 'run --keep-container' to a new image.
+    """
+    target = Path(args.target[0])
+    unpacked_info = read_dict(target)
+    client = get_docker(args)
+    if 'kept_container' not in unpacked_info:
+        logger.critical("No container was kept, use 'run --keep-container'")
+        sys.exit(1)
+    container = unpacked_info['kept_container']
+    image = unpacked_info['current_image']
+
+    new_image = make_unique_name(b'reprounzip_image_')
+    logger.info("Committing container %s to image %s",
+                container.decode('ascii'), new_image.decode('ascii'))
+    try:
+        client.commit(container, new_image)
+    except DockerError as e:
+        logger.critical("%s", e)
+        sys.exit(1)
+
+    # Update image name
+    unpacked_info['current_image'] = new_image
+    write_dict(target, unpacked_info)
+
+    if not args.keep_container:
+        remove_kept_container(client, unpacked_info)
+        write_dict(target, unpacked_info)
+
+    # Untag previous image, unless it is the initial_image
+    if image != unpacked_info['initial_image']:
+        logger.info("Untagging previous image %s", image.decode('ascii'))
+        try:
+            client.remove_image(image)
+        except DockerError as e:
+            logger.warning("Can't remove previous image: %s", e)
+
+
 class ContainerUploader(FileUploader):
     def __init__(self, target, input_files, files, unpacked_info,
-                 docker_cmd='docker'):
+                 client, use_cp=False, container=None, delta=False):
         self.unpacked_info = unpacked_info
-        self.docker_cmd = docker_cmd
-        FileUploader.__init__(self, target, input_files, files)
+        self.client = client
+        # If a container is given, the files are copied to it directly,
+        # without committing
+        self.container = container
+        # Delta uploads write over the files from inside a container
+        self.use_cp = use_cp or delta or container is not None
+        if unpacked_info.get('filtered_data'):
+            # The data was written without the DATA prefix by setup/create
+            self.data_tgz = 'data.tar'
+            self.data_prefix = PosixPath('')
+        FileUploader.__init__(self, target, input_files, files, delta=delta)
 
     def prepare_upload(self, files):
         if 'current_image' not in self.unpacked_info:
@@ -585,10 +865,52 @@ class ContainerUploader(FileUploader):
                          "setup/build?\n")
             sys.exit(1)
 
-        self.build_directory = Path.tempdir(prefix='reprozip_build_')
         self.docker_copy = []
+        if self.use_cp:
+            self.commit = self.container is None
+            try:
+                if self.commit:
+                    # Create a container from the image; the files get
+                    # streamed to it as a single tar archive, then it is
+                    # committed once
+                    self.container = make_unique_name(b'reprounzip_upload_')
+                    logger.info("Creating container %s",
+                                self.container.decode('ascii'))
+                    self.client.create_container(
+                        self.unpacked_info['current_image'],
+                        self.container,
+                        KEEP_ALIVE_CMD if self.delta else None)
+                    if self.delta:
+                        self.client.start_container(self.container)
+                self.copy_stream = self.client.put_archive(self.container,
+                                                           b'/')
+            except DockerError as e:
+                logger.critical("%s", e)
+                self.remove_container()
+                sys.exit(1)
+            self.copy_tar = tarfile.open(fileobj=self.copy_stream,
+                                         mode='w|', dereference=True)
+        else:
+            self.build_directory = Path.tempdir(prefix='reprozip_build_')
 
     def upload_file(self, local_path, input_path):
+        if self.use_cp:
+            tarinfo = self.copy_tar.gettarinfo(
+                local_path.path,
+                str(join_root(PosixPath(''), input_path)))
+            tarinfo.uid = tarinfo.gid = 1000
+            tarinfo.uname = tarinfo.gname = ''
+            try:
+                with local_path.open('rb') as fp:
+                    self.copy_tar.addfile(tarinfo, fp)
+            except DockerError as e:
+                logger.critical("%s", e)
+                self.remove_container()
+                sys.exit(1)
+            logger.info("Sent file %s to %s", local_path, input_path)
+            self.docker_copy.append((local_path, input_path))
+            return
+
         stem, ext = local_path.stem, local_path.ext
         name = local_path.name
         nb = 0
@@ -600,10 +922,108 @@ class ContainerUploader(FileUploader):
         logger.info("Copied file %s to %s", local_path, name)
         self.docker_copy.append((name, input_path))
 
+    def get_block_hashes(self, input_path, block_size):
+        try:
+            retcode, output = self.client.exec_(
+                self.container,
+                ['/busybox', 'sh', '-c',
+                 delta_hashes_command(input_path.path, block_size,
+                                      '/busybox ')])
+        except DockerError as e:
+            logger.warning("Can't get block hashes: %s", e)
+            return None
+        if retcode != 0:
+            return None
+        return parse_block_hashes(output)
+
+    def write_blocks(self, local_path, input_path, runs, truncate):
+        with local_path.open('rb') as fp:
+            for i, (first_block, count) in enumerate(runs):
+                try:
+                    retcode, output = self.client.exec_(
+                        self.container,
+                        ['/busybox', 'sh', '-c',
+                         delta_write_command(input_path.path,
+                                             self.delta_block_size,
+                                             first_block,
+                                             truncate and i == len(runs) - 1,
+                                             '/busybox ')],
+                        self.read_blocks(fp, first_block, count))
+                except DockerError as e:
+                    logger.critical("%s", e)
+                    retcode = None
+                if retcode != 0:
+                    logger.critical("Couldn't write file in container")
+                    self.remove_container()
+                    sys.exit(1)
+        logger.info("Updated file %s from %s", input_path, local_path)
+        self.docker_copy.append((local_path, input_path))
+
     def finalize(self):
+        if self.use_cp:
+            image = self.commit_container()
+        else:
+            image = self.build_image()
+        if image is None:
+            return
+
+        from_image = self.unpacked_info['current_image']
+        logger.info("New image created: %s", image.decode('ascii'))
+        if from_image != self.unpacked_info['initial_image']:
+            logger.info("Untagging previous image %s",
+                        from_image.decode('ascii'))
+            try:
+                self.client.remove_image(from_image)
+            except DockerError as e:
+                logger.warning("Can't remove previous image: %s", e)
+        self.unpacked_info['current_image'] = image
+        write_dict(self.target, self.unpacked_info)
+
+    def commit_container(self):
+        """Finishes sending the files and commits the container.
+        """
+        try:
+            self.copy_tar.close()
+            self.copy_stream.close()
+        except DockerError as e:
+            logger.critical("%s", e)
+            self.remove_container()
+            sys.exit(1)
+
+        if not self.commit:
+            return None
+
+        image = None
+        if self.docker_copy:
+            image = make_unique_name(b'reprounzip_image_')
+            logger.info("Committing container %s to image %s",
+                        self.container.decode('ascii'), image.decode('ascii'))
+            try:
+                self.client.commit(self.container, image)
+            except DockerError as e:
+                logger.critical("%s", e)
+                self.remove_container()
+                sys.exit(1)
+        self.remove_container()
+        return image
+
+    def remove_container(self):
+        if not self.commit or self.container is None:
+            return
+        logger.info("Removing container %s", self.container.decode('ascii'))
+        try:
+            self.client.remove_container(self.container, force=True)
+        except DockerError as e:
+            logger.warning("Can't remove temporary container: %s", e)
+        # Don't try to commit or remove it again from finalize()
+        self.commit = False
+
+    def build_image(self):
+        """Builds a new image from a Dockerfile that copies the files.
+        """
         if not self.docker_copy:
             self.build_directory.rmtree()
-            return
+            return None
 
         from_image = self.unpacked_info['current_image']
 
@@ -627,26 +1047,14 @@ class ContainerUploader(FileUploader):
             # TODO : restore permissions?
 
         image = make_unique_name(b'reprounzip_image_')
-        retcode = subprocess.call(self.docker_cmd +
-                                  ['build', '-t', image, '.'],
-                                  cwd=self.build_directory.path)
-        if retcode != 0:
-            logger.critical("docker build failed with code %d", retcode)
+        try:
+            self.client.build(image, self.build_directory)
+        except DockerError as e:
+            logger.critical("%s", e)
             sys.exit(1)
-        else:
-            logger.info("New image created: %s", image.decode('ascii'))
-            if from_image != self.unpacked_info['initial_image']:
-                logger.info("Untagging previous image %s",
-                            from_image.decode('ascii'))
-                retcode = subprocess.call(self.docker_cmd +
-                                          ['rmi', from_image])
-                if retcode != 0:
-                    logger.warning("Can't remove previous image, docker "
-                                   "returned %d", retcode)
-            self.unpacked_info['current_image'] = image
-            write_dict(self.target, self.unpacked_info)
-
-        self.build_directory.rmtree()
+        finally:
+            self.build_directory.rmtree()
+        return image
 
 
 @target_must_exist
@@ -660,49 +1068,93 @@ def docker_upload(args):
 
     try:
         ContainerUploader(target, input_files, files, unpacked_info,
-                          docker_cmd=args.docker_cmd.split())
+                          get_docker(args),
+                          use_cp=args.docker_cp,
+                          container=unpacked_info.get('kept_container'),
+                          delta=args.delta)
     finally:
         write_dict(target, unpacked_info)
 
 
 class ContainerDownloader(FileDownloader):
-    def __init__(self, target, files, image, all_=False, docker_cmd='docker'):
+    max_workers = 4
+
+    def __init__(self, target, files, image, client, all_=False,
+                 container=None):
         self.image = image
-        self.docker_cmd = docker_cmd
+        self.client = client
+        # If a container is given, the files are copied from it directly
+        self.container = container
+        self.temporary_container = container is None
         FileDownloader.__init__(self, target, files, all_=all_)
 
     def prepare_download(self, files):
-        # Create a container from the image
+        if not self.temporary_container:
+            return
+        # Create a container from the image; if there are several files, it
+        # is started so they can be fetched at once with tar
         self.container = make_unique_name(b'reprounzip_dl_')
         logger.info("Creating container %s", self.container.decode('ascii'))
-        subprocess.check_call(self.docker_cmd +
-                              ['create',
-                               b'--name=' + self.container,
-                               self.image])
+        batch = len([f for f in files if f[1] is not None]) > 1
+        try:
+            self.client.create_container(self.image, self.container,
+                                         KEEP_ALIVE_CMD if batch else None)
+            if batch:
+                self.client.start_container(self.container)
+        except DockerError as e:
+            logger.critical("%s", e)
+            sys.exit(1)
+
+    def download_archive(self, remote_paths):
+        try:
+            return self.client.exec_stream(
+                self.container,
+                ['/busybox', 'tar', '-c', '-h', '-f', '-', '-C', '/', '--'] +
+                [join_root(PosixPath(''), p).path for p in remote_paths])
+        except DockerError as e:
+            logger.info("Can't get files as an archive: %s", e)
+            return None
 
     def download(self, remote_path, local_path):
-        # Docker copies to a file in the specified directory, cannot just take
-        # a file name (#4272)
-        tmpdir = Path.tempdir(prefix='reprozip_docker_output_')
+        # Docker sends the file as a tar archive, which we read as a stream
+        try:
+            stream = self.client.get_archive(self.container, remote_path.path)
+        except DockerError as e:
+            logger.critical("Can't get output file %s: %s", remote_path, e)
+            return False
+        tar = None
         try:
-            ret = subprocess.call(self.docker_cmd +
-                                  ['cp',
-                                   self.container + b':' + remote_path.path,
-                                   tmpdir.path])
-            if ret != 0:
-                logger.critical("Can't get output file: %s", remote_path)
-                return False
-            (tmpdir / remote_path.name).copyfile(local_path)
+            tar = tarfile.open(fileobj=stream, mode='r|')
+            for member in tar:
+                if member.isfile():
+                    with local_path.open('wb') as fp:
+                        copyfile(tar.extractfile(member), fp)
+                    return True
+            logger.critical("Can't get output file %s: not a file",
+                            remote_path)
+            return False
+        except (DockerError, tarfile.TarError) as e:
+            logger.critical("Can't get output file %s: %s", remote_path, e)
+            return False
         finally:
-            tmpdir.rmtree()
-        return True
+            if tar is not None:
+                tar.close()
+            # The rest of the archive might not have been read, so the other
+            # end can fail with a broken pipe; that doesn't change the result
+            try:
+                stream.close()
+            except (DockerError, IOError, OSError) as e:
+                logger.debug("Error closing archive of %s: %s",
+                             remote_path, e)
 
     def finalize(self):
+        if not self.temporary_container:
+            return
         logger.info("Removing container %s", self.container.decode('ascii'))
-        retcode = subprocess.call(self.docker_cmd + ['rm', self.container])
-        if retcode != 0:
-            logger.warning("Can't remove temporary container, docker "
-                           "returned %d", retcode)
+        try:
+            self.client.remove_container(self.container, force=True)
+        except DockerError as e:
+            logger.warning("Can't remove temporary container: %s", e)
 
 
 @target_must_exist
@@ -717,10 +1169,15 @@ def docker_download(args):
         logger.critical("Image doesn't exist yet, have you run setup/build?")
         sys.exit(1)
     image = unpacked_info['current_image']
-    logger.debug("Downloading from image %s", image.decode('ascii'))
+    container = unpacked_info.get('kept_container')
+    if container is not None:
+        logger.debug("Downloading from container %s",
+                     container.decode('ascii'))
+    else:
+        logger.debug("Downloading from image %s", image.decode('ascii'))
 
-    ContainerDownloader(target, files, image,
-                        all_=args.all, docker_cmd=args.docker_cmd.split())
+    ContainerDownloader(target, files, image, get_docker(args),
+                        all_=args.all, container=container)
 
 
 @target_must_exist
@@ -735,19 +1192,29 @@ def docker_destroy_docker(args):
 
     initial_image = unpacked_info.pop('initial_image')
 
+    client = get_docker(args)
+    remove_kept_container(client, unpacked_info)
+
     if 'current_image' in unpacked_info:
         image = unpacked_info.pop('current_image')
         if image != initial_image:
             logger.info("Destroying image %s...", image.decode('ascii'))
-            retcode = subprocess.call(args.docker_cmd.split() + ['rmi', image])
-            if retcode != 0:
+            try:
+                client.remove_image(image)
+            except DockerError:
                 logger.error("Error deleting image %s", image.decode('ascii'))
 
     logger.info("Destroying image %s...", initial_image.decode('ascii'))
-    retcode = subprocess.call(args.docker_cmd.split() + ['rmi', initial_image])
-    if retcode != 0:
+    try:
+        client.remove_image(initial_image)
+    except DockerError:
         logger.error("Error deleting image %s", initial_image.decode('ascii'))
 
+    if 'packages_image' in unpacked_info:
+        logger.info("Not removing image %s, which has the packages installed "
+                    "and might be used by other experiments",
+                    unpacked_info['packages_image'].decode('ascii'))
+
 
 @target_must_exist
 def docker_destroy_dir(args):
@@ -788,6 +1255,8 @@ def setup(parser, **kwargs):
     upload                  replaces input files in the container
                             (without arguments, lists input files)
     run                     runs the experiment in the container
+    commit                  commits the container kept by
+                            'run --keep-container' to a new image
     download                gets output files from the container
                             (without arguments, lists output files)
     destroy destroy/docker  destroys the container and associated images
@@ -812,6 +1281,10 @@ def setup(parser, **kwargs):
     """
     parser.add_argument('--docker-cmd', action='store', default='docker',
                         help="Change the Docker command; split on spaces")
+    parser.add_argument('--no-docker-api', action='store_false',
+                        dest='docker_api', default=True,
+                        help="Don't talk to the Docker daemon's API directly, "
+                        "always call the docker command")
 
     subparsers = parser.add_subparsers(title="actions",
                                        metavar='', help=argparse.SUPPRESS)
@@ -833,6 +1306,11 @@ def setup(parser, **kwargs):
         opts.add_argument('--unpack-pkgs', action='store_false',
                           default=False, dest='install_pkgs',
                           help=argparse.SUPPRESS)
+        opts.add_argument('--filter-data', action='store_true',
+                          default=False,
+                          help="Only put the files that are needed in the "
+                               "build context, instead of the whole data "
+                               "tarball (faster build, smaller image)")
 
     # Common between setup and setup/build
     def add_opt_setup_build(opts):
@@ -877,6 +1355,14 @@ def setup(parser, **kwargs):
     add_opt_general(parser_upload)
     parser_upload.add_argument('file', nargs=argparse.ZERO_OR_MORE,
                                help="<path>:<input_file_name>")
+    parser_upload.add_argument('--docker-cp', action='store_true',
+                               default=False,
+                               help="Copy the files into a container with "
+                                    "'docker cp' and commit it, instead of "
+                                    "building a new image")
+    parser_upload.add_argument('--delta', action='store_true', default=False,
+                               help="Only send the parts of the files that "
+                                    "changed (implies --docker-cp)")
     parser_upload.set_defaults(func=docker_upload)
 
     # run
@@ -905,10 +1391,25 @@ def setup(parser, **kwargs):
     parser_run.add_argument('-d', '--detach', action='store_true',
                             help="Don't attach or commit the created "
                                  "container, just start it and leave it be")
+    parser_run.add_argument('--keep-container', action='store_true',
+                            default=False,
+                            help="Run in a container that is kept running "
+                                 "between runs, using 'docker exec', instead "
+                                 "of committing a new image after each run "
+                                 "(use the 'commit' command to save it)")
     add_raw_docker_option(parser_run)
     add_environment_options(parser_run)
     parser_run.set_defaults(func=docker_run)
 
+    # commit
+    parser_commit = subparsers.add_parser('commit')
+    add_opt_general(parser_commit)
+    parser_commit.add_argument('--keep-container', action='store_true',
+                               default=False,
+                               help="Leave the container running after "
+                                    "committing it")
+    parser_commit.set_defaults(func=docker_commit)
+
     # download
     parser_download = subparsers.add_parser('download')
     add_opt_general(parser_download)
@@ -0,0 +1,551 @@
+# Copyright (C) 2014-2017 New York University
+# This file is part of ReproZip which is released under the Revised BSD License
+# See file LICENSE for full license details.
+
+"""Clients used to talk to Docker.
+
+This contains `DockerAPIClient`, which talks HTTP to the Docker Engine API
+over the daemon's UNIX socket, and `DockerCommandClient`, which does the same
+operations by calling the docker command-line client. Use `get_client()` to
+get the best one available.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import json
+import logging
+import os
+import socket
+import struct
+import subprocess
+import tarfile
+
+from reprounzip.utils import PY3, unicode_, stdout
+
+
+if PY3:
+    import http.client as httplib
+    from urllib.parse import quote, urlencode
+else:
+    import httplib
+    from urllib import quote, urlencode
+
+
+logger = logging.getLogger('reprounzip.docker')
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+# Version of the API that we use (Docker 1.12)
+API_VERSION = '1.24'
+
+
+class DockerError(Exception):
+    """An operation on Docker failed.
+    """
+
+
+def _text(s):
+    if isinstance(s, bytes):
+        return s.decode('utf-8')
+    return unicode_(s)
+
+
+def _tar_directory(fileobj, directory):
+    """Writes the content of a directory to a stream, as a tar archive.
+    """
+    directory = str(directory)
+    tar = tarfile.open(fileobj=fileobj, mode='w|')
+    try:
+        for name in sorted(os.listdir(directory)):
+            tar.add(os.path.join(directory, name), arcname=name)
+    finally:
+        tar.close()
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a UNIX socket.
+    """
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ChunkedRequest(object):
+    """A request whose body is sent as it is written, with chunked encoding.
+
+    This is a file-like object, so it can be given to `tarfile` to stream an
+    archive to the daemon. Call `response()` when done writing.
+    """
+    def __init__(self, socket_path, method, url, content_type):
+        self.conn = UnixHTTPConnection(socket_path)
+        self.conn.putrequest(method, url, skip_accept_encoding=True)
+        self.conn.putheader('Content-Type', content_type)
+        self.conn.putheader('Transfer-Encoding', 'chunked')
+        self.conn.endheaders()
+
+    def write(self, data):
+        if data:
+            self.conn.send(('%x\r\n' % len(data)).encode('ascii') +
+                           bytes(data) + b'\r\n')
+
+    def response(self):
+        self.conn.send(b'0\r\n\r\n')
+        return self.conn.getresponse()
+
+    def close(self):
+        self.conn.close()
+
+
+class ArchiveUpload(object):
+    """Stream of a tar archive being uploaded, as returned by `put_archive()`.
+    """
+    def __init__(self, client, request):
+        self.client = client
+        self.request = request
+
+    def write(self, data):
+        try:
+            self.request.write(data)
+        except (IOError, socket.error):
+            # The daemon closed the connection, probably to send us an error
+            self.close()
+            raise DockerError("Docker closed the connection")
+
+    def close(self):
+        try:
+            response = self.request.response()
+            self.client._check(response, response.read())
+        finally:
+            self.request.close()
+
+
+class ExecOutput(object):
+    """Standard output of a command started with the exec API.
+
+    The daemon multiplexes the output streams; each frame has an 8-byte
+    header: stream type (1 is stdout), 3 bytes of padding, length.
+    """
+    def __init__(self, client, exec_id, sock, fp):
+        self.client = client
+        self.exec_id = exec_id
+        self.sock = sock
+        self.fp = fp
+        self.buffer = b''
+        self.eof = False
+
+    def _read_frame(self):
+        while True:
+            header = self.fp.read(8)
+            if len(header) < 8:
+                self.eof = True
+                return
+            length, = struct.unpack('>I', header[4:])
+            data = self.fp.read(length)
+            if header[0:1] == b'\x01':
+                self.buffer += data
+                return
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._read_frame()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        """Closes the stream and returns the exit code of the command.
+        """
+        self.fp.close()
+        self.sock.close()
+        result = self.client._call('GET', '/exec/%s/json' % self.exec_id)
+        return result['ExitCode']
+
+
+class DockerAPIClient(object):
+    """Client for the Docker Engine API, over a UNIX socket.
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+
+    def _url(self, path, params=None):
+        url = '/v%s%s' % (API_VERSION, path)
+        if params:
+            url += '?' + urlencode(sorted((k, _text(v).encode('utf-8'))
+                                          for k, v in params.items()))
+        return url
+
+    def _check(self, response, content):
+        if response.status >= 400:
+            try:
+                message = json.loads(content.decode('utf-8'))['message']
+            except (ValueError, KeyError, TypeError):
+                message = content.decode('utf-8', 'replace').strip()
+            raise DockerError("Docker API error %d: %s" % (response.status,
+                                                           message))
+
+    def _call(self, method, path, params=None, data=None, allow_404=False):
+        headers = {}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        conn = UnixHTTPConnection(self.socket_path)
+        try:
+            conn.request(method, self._url(path, params), body, headers)
+            response = conn.getresponse()
+            content = response.read()
+        finally:
+            conn.close()
+        if allow_404 and response.status == 404:
+            return None
+        self._check(response, content)
+        if (content and
+                response.getheader('Content-Type', '').startswith(
+                    'application/json')):
+            return json.loads(content.decode('utf-8'))
+        return content
+
+    def ping(self):
+        self._call('GET', '/_ping')
+
+    def inspect_image(self, image):
+        """Gets information on an image, or None if it doesn't exist.
+        """
+        return self._call('GET', '/images/%s/json' % quote(_text(image)),
+                          allow_404=True)
+
+    def inspect_container(self, container):
+        """Gets information on a container, or None if it doesn't exist.
+        """
+        return self._call('GET',
+                          '/containers/%s/json' % quote(_text(container)),
+                          allow_404=True)
+
+    def create_container(self, image, container, command=None):
+        data = {'Image': _text(image)}
+        if command is not None:
+            data['Cmd'] = [_text(a) for a in command]
+        self._call('POST', '/containers/create', {'name': container}, data)
+
+    def start_container(self, container):
+        self._call('POST', '/containers/%s/start' % quote(_text(container)))
+
+    def wait_container(self, container):
+        """Waits for a container to stop, and returns its exit code.
+        """
+        result = self._call('POST',
+                            '/containers/%s/wait' % quote(_text(container)))
+        return result['StatusCode']
+
+    def commit(self, container, image):
+        self._call('POST', '/commit', {'container': container,
+                                       'repo': image})
+
+    def remove_container(self, container, force=False):
+        self._call('DELETE', '/containers/%s' % quote(_text(container)),
+                   {'force': '1' if force else '0'})
+
+    def remove_image(self, image):
+        self._call('DELETE', '/images/%s' % quote(_text(image)))
+
+    def _exec_start(self, container, command, attach_stdin):
+        exec_id = self._call(
+            'POST', '/containers/%s/exec' % quote(_text(container)),
+            data={'Cmd': [_text(a) for a in command],
+                  'AttachStdin': attach_stdin,
+                  'AttachStdout': True, 'AttachStderr': True})['Id']
+
+        # The daemon takes over the connection to stream the input and output,
+        # which httplib can't do
+        body = json.dumps({'Detach': False, 'Tty': False}).encode('utf-8')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        try:
+            sock.sendall(('POST %s HTTP/1.1\r\n'
+                          'Host: localhost\r\n'
+                          'Content-Type: application/json\r\n'
+                          'Content-Length: %d\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Upgrade: tcp\r\n'
+                          '\r\n' % (self._url('/exec/%s/start' % exec_id),
+                                    len(body))).encode('ascii') + body)
+            fp = sock.makefile('rb')
+            status = fp.readline().split(None, 2)
+            if len(status) < 2 or int(status[1]) >= 400:
+                raise DockerError("Docker API error starting exec: %s" %
+                                  b' '.join(status).decode('utf-8',
+                                                           'replace'))
+            while fp.readline().strip():
+                pass
+        except Exception:
+            sock.close()
+            raise
+        return ExecOutput(self, exec_id, sock, fp)
+
+    def exec_(self, container, command, input=None):
+        """Runs a command in a running container.
+
+        `input` is an iterable of bytes objects sent to the command's standard
+        input. Returns the exit code and the standard output.
+        """
+        output = self._exec_start(container, command, input is not None)
+        try:
+            if input is not None:
+                for chunk in input:
+                    output.sock.sendall(chunk)
+            output.sock.shutdown(socket.SHUT_WR)
+            data = output.read()
+        finally:
+            retcode = output.close()
+        return retcode, data
+
+    def exec_stream(self, container, command):
+        """Runs a command in a running container, streaming its output.
+
+        Returns a file-like object from which the standard output can be
+        read; its `close()` method returns the exit code.
+        """
+        output = self._exec_start(container, command, False)
+        output.sock.shutdown(socket.SHUT_WR)
+        return output
+
+    def put_archive(self, container, path):
+        """Starts uploading a tar archive to be extracted in a container.
+
+        Returns a file-like object; write the archive to it, then call
+        `close()`.
+        """
+        request = ChunkedRequest(
+            self.socket_path, 'PUT',
+            self._url('/containers/%s/archive' % quote(_text(container)),
+                      {'path': path}),
+            'application/x-tar')
+        return ArchiveUpload(self, request)
+
+    def get_archive(self, container, path):
+        """Gets a file or directory from a container, as a tar archive.
+
+        Returns a file-like object from which the archive can be read.
+        """
+        conn = UnixHTTPConnection(self.socket_path)
+        conn.request('GET', self._url('/containers/%s/archive' % quote(
+            _text(container)), {'path': path}))
+        response = conn.getresponse()
+        if response.status >= 400:
+            try:
+                self._check(response, response.read())
+            finally:
+                conn.close()
+        return response
+
+    def build(self, image, directory, options=()):
+        """Builds an image from a directory containing a Dockerfile.
+
+        The directory is streamed to the daemon as the build context, and the
+        output of the build is printed.
+        """
+        if options:
+            raise DockerError("Docker options can't be used with the API")
+        request = ChunkedRequest(
+            self.socket_path, 'POST',
+            self._url('/build', {'t': image, 'rm': '1'}),
+            'application/x-tar')
+        try:
+            try:
+                _tar_directory(request, directory)
+            except (IOError, socket.error):
+                pass  # The daemon should tell us what happened
+            response = request.response()
+            if response.status >= 400:
+                self._check(response, response.read())
+            buf = b''
+            while True:
+                chunk = response.read(4096)
+                buf += chunk
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                if not chunk:
+                    lines.append(buf)
+                for line in lines:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    message = json.loads(line.decode('utf-8'))
+                    if 'error' in message:
+                        raise DockerError(message['error'].strip())
+                    elif 'stream' in message:
+                        stdout.write(message['stream'])
+                if not chunk:
+                    break
+        finally:
+            request.close()
+
+
+class CommandStream(object):
+    """Standard input or output of the docker command, as a file-like object.
+
+    If `check` is False, `close()` returns the exit code instead of raising
+    `DockerError`.
+    """
+    def __init__(self, proc, fileobj, what, check=True):
+        self.proc = proc
+        self.fileobj = fileobj
+        self.what = what
+        self.check = check
+
+    def read(self, size=-1):
+        return self.fileobj.read(size)
+
+    def write(self, data):
+        try:
+            self.fileobj.write(data)
+        except IOError:
+            self.close()
+            raise DockerError("docker %s exited early" % self.what)
+
+    def close(self):
+        try:
+            self.fileobj.close()
+        except IOError:
+            pass
+        retcode = self.proc.wait()
+        if not self.check:
+            return retcode
+        if retcode != 0:
+            raise DockerError("docker %s failed with code %d" % (self.what,
+                                                                 retcode))
+
+
+class DockerCommandClient(object):
+    """Client doing the same operations as `DockerAPIClient` using the docker
+    command-line client.
+    """
+    def __init__(self, docker_cmd):
+        self.docker_cmd = list(docker_cmd)
+
+    def _call(self, args, what):
+        retcode = subprocess.call(self.docker_cmd + args)
+        if retcode != 0:
+            raise DockerError("docker %s failed with code %d" % (what,
+                                                                 retcode))
+
+    def _inspect(self, type_, name):
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                out = subprocess.check_output(self.docker_cmd +
+                                              ['inspect', '--type=' + type_,
+                                               name],
+                                              stderr=devnull)
+            except subprocess.CalledProcessError:
+                return None
+        return json.loads(out.decode('utf-8'))[0]
+
+    def inspect_image(self, image):
+        return self._inspect('image', image)
+
+    def inspect_container(self, container):
+        return self._inspect('container', container)
+
+    def create_container(self, image, container, command=None):
+        self._call(['create', b'--name=' + container, image] +
+                   list(command or []),
+                   'create')
+
+    def start_container(self, container):
+        self._call(['start', container], 'start')
+
+    def wait_container(self, container):
+        try:
+            out = subprocess.check_output(self.docker_cmd +
+                                          ['wait', container])
+        except subprocess.CalledProcessError as e:
+            raise DockerError("docker wait failed with code %d" %
+                              e.returncode)
+        return int(out.strip())
+
+    def commit(self, container, image):
+        self._call(['commit', container, image], 'commit')
+
+    def remove_container(self, container, force=False):
+        self._call(['rm'] + (['-f'] if force else []) + [container], 'rm')
+
+    def remove_image(self, image):
+        self._call(['rmi', image], 'rmi')
+
+    def exec_(self, container, command, input=None):
+        proc = subprocess.Popen(self.docker_cmd +
+                                ['exec'] +
+                                (['-i'] if input is not None else []) +
+                                [container] + list(command),
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        if input is not None:
+            try:
+                for chunk in input:
+                    proc.stdin.write(chunk)
+            except IOError:
+                pass  # The command failed, exit code is returned below
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        output = proc.stdout.read()
+        return proc.wait(), output
+
+    def exec_stream(self, container, command):
+        proc = subprocess.Popen(self.docker_cmd +
+                                ['exec', container] + list(command),
+                                stdout=subprocess.PIPE)
+        return CommandStream(proc, proc.stdout, 'exec', check=False)
+
+    def put_archive(self, container, path):
+        proc = subprocess.Popen(self.docker_cmd +
+                                ['cp', '-', container + b':' + path],
+                                stdin=subprocess.PIPE)
+        return CommandStream(proc, proc.stdin, 'cp')
+
+    def get_archive(self, container, path):
+        proc = subprocess.Popen(self.docker_cmd +
+                                ['cp', container + b':' + path, '-'],
+                                stdout=subprocess.PIPE)
+        return CommandStream(proc, proc.stdout, 'cp')
+
+    def build(self, image, directory, options=()):
+        try:
+            retcode = subprocess.call(self.docker_cmd + ['build', '-t'] +
+                                      list(options) + [image, '.'],
+                                      cwd=directory.path)
+        except OSError:
+            raise DockerError("docker executable not found")
+        if retcode != 0:
+            raise DockerError("docker build failed with code %d" % retcode)
+
+
+def get_client(docker_cmd, use_api=True, options=()):
+    """Gets the client to use to talk to Docker.
+
+    The Engine API is used if the default docker command is used, no raw
+    options were given for it, and the daemon can be reached on its local
+    UNIX socket. Otherwise, the docker command is called.
+    """
+    if use_api and list(docker_cmd) == ['docker'] and not options:
+        host = os.environ.get('DOCKER_HOST', 'unix://' + DEFAULT_SOCKET)
+        if (hasattr(socket, 'AF_UNIX') and host.startswith('unix://') and
+                os.path.exists(host[7:])):
+            client = DockerAPIClient(host[7:])
+            try:
+                client.ping()
+            except (socket.error, httplib.HTTPException, DockerError) as e:
+                logger.info("Can't use the Docker API, using the docker "
+                            "command instead: %s", e)
+            else:
+                logger.debug("Using the Docker API over %s", host[7:])
+                return client
+    return DockerCommandClient(docker_cmd)
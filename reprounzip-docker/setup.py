@@ -12,7 +12,8 @@ with io.open('README.rst', encoding='utf-8') as fp:
     description = fp.read()
 setup(name='reprounzip-docker',
       version='1.0.16',
-      packages=['reprounzip', 'reprounzip.unpackers'],
+      packages=['reprounzip', 'reprounzip.unpackers',
+                'reprounzip.unpackers.docker'],
       entry_points={
           'reprounzip.unpackers': [
               'docker = reprounzip.unpackers.docker:setup']},
@@ -5,7 +5,6 @@
 from __future__ import division, print_function, unicode_literals
 
 from qtpy import QtCore, QtWidgets
-import yaml
 
 import reprounzip_qt.reprounzip_interface as reprounzip
 from reprounzip_qt.gui.common import ROOT, ResizableStack, handle_error, \
@@ -369,8 +368,7 @@ class RunTab(QtWidgets.QWidget):
 
         self.runs_widget.clear()
         if unpacker is not None:
-            with open(self.directory + '/config.yml') as fp:
-                self.config = yaml.safe_load(fp)
+            self.config = reprounzip.load_config(self.directory)
             self.run_widget.setEnabled(True)
             self.destroy_widget.setEnabled(True)
             self.files_button.setEnabled(True)
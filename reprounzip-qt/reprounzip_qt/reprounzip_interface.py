@@ -15,6 +15,11 @@ import yaml
 
 from reprounzip_qt.qt_terminal import run_in_builtin_terminal
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader
+
 
 logger = logging.getLogger('reprounzip_qt')
 
@@ -64,12 +69,33 @@ else:
     native_escape = shell_escape
 
 
+# Metadata files that were read, {filename: (stat key, dict)}
+_metadata_cache = {}
+
+
+def read_metadata(directory):
+    """Reads the unpacker metadata (``.reprounzip``) of an unpacked directory.
+
+    The file is only read again if it changed since the last call, so this can
+    be used when refreshing the interface. Don't change the returned dict.
+    """
+    filename = os.path.join(directory, '.reprounzip')
+    st = os.stat(filename)
+    key = st.st_size, st.st_mtime, st.st_ino
+    cached = _metadata_cache.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with open(filename, 'rb') as fp:
+        unpacked_info = pickle.load(fp)
+    _metadata_cache[filename] = key, unpacked_info
+    return unpacked_info
+
+
 def check_directory(directory):
     if os.path.isdir(directory):
         filename = os.path.join(directory, '.reprounzip')
         if os.path.isfile(filename):
-            with open(filename, 'rb') as fp:
-                unpacked_info = pickle.load(fp)
+            unpacked_info = read_metadata(directory)
             logger.debug("Directory was created by unpacker '%s': %s",
                          unpacked_info['unpacker'], directory)
             return unpacked_info['unpacker']
@@ -77,9 +103,15 @@ def check_directory(directory):
     return None
 
 
-def is_jupyter(directory):
+def load_config(directory):
+    """Reads the configuration file of an unpacked directory.
+    """
     with open(os.path.join(directory, 'config.yml')) as fp:
-        config = yaml.safe_load(fp)
+        return yaml.load(fp, Loader=SafeLoader)
+
+
+def is_jupyter(directory):
+    config = load_config(directory)
     iofiles = config.get('inputs_outputs', None)
     detected = iofiles and any(iofile['name'] == 'jupyter_connection_file'
                                for iofile in config.get('inputs_outputs'))
@@ -100,8 +132,7 @@ class FileStatus(object):
 class FilesStatus(object):
     def __init__(self, directory):
         self.directory = directory
-        with open(os.path.join(directory, 'config.yml')) as fp:
-            config = yaml.safe_load(fp)
+        config = load_config(directory)
 
         self.files = [FileStatus(f['name'], f['path'],
                                  f.get('read_by_runs'),
@@ -111,8 +142,7 @@ class FilesStatus(object):
         self._refresh()
 
     def _refresh(self):
-        with open(os.path.join(self.directory, '.reprounzip'), 'rb') as fp:
-            unpacked_info = pickle.load(fp)
+        unpacked_info = read_metadata(self.directory)
         assigned_input_files = unpacked_info.get('input_files', {})
         for f in self.files:
             f.assigned = assigned_input_files.get(f.name)
@@ -171,8 +201,7 @@ def run(directory, unpacker=None, runs=None,
 
     env = {}
 
-    with open(os.path.join(directory, '.reprounzip'), 'rb') as fp:
-        docker_host = pickle.load(fp).get('docker_host')
+    docker_host = read_metadata(directory).get('docker_host')
     if docker_host and docker_host['type']:
         if docker_host['type'] == 'docker-machine':
             env.update(docker_machine_env(docker_host['name']))
@@ -20,18 +20,21 @@ import os
 import paramiko
 import re
 from rpaths import PosixPath, Path
+import socket
 import subprocess
 import sys
 
-from reprounzip.common import load_config, record_usage, RPZPack
+from reprounzip.common import record_usage, RPZPack
 from reprounzip import signals
 from reprounzip.parameters import get_parameter
 from reprounzip.unpackers.common import COMPAT_OK, COMPAT_MAYBE, COMPAT_NO, \
     CantFindInstaller, composite_action, target_must_exist, \
     make_unique_name, shell_escape, select_installer, busybox_url, join_root, \
     FileUploader, FileDownloader, get_runs, add_environment_options, \
-    fixup_environment, metadata_read, metadata_write, \
-    metadata_initial_iofiles, metadata_update_run, parse_ports
+    fixup_environment, metadata_read, metadata_write, metadata_update, \
+    metadata_initial_iofiles, metadata_update_run, parse_ports, \
+    delta_hashes_command, parse_block_hashes, delta_write_command, \
+    load_target_config
 from reprounzip.unpackers.common.x11 import BaseX11Handler, X11Handler
 from reprounzip.unpackers.vagrant.run_command import IgnoreMissingKey, \
     run_interactive
@@ -108,8 +111,12 @@ def read_dict(path):
     return metadata_read(path, 'vagrant')
 
 
-def machine_setup(target):
-    """Prepare the machine and get SSH parameters from ``vagrant ssh``.
+def update_dict(path):
+    return metadata_update(path, 'vagrant')
+
+
+def get_ssh_parameters(target):
+    """Gets SSH parameters from ``vagrant ssh-config``, starting the machine.
     """
     try:
         out = subprocess.check_output(['vagrant', 'ssh-config'],
@@ -154,16 +161,80 @@ def machine_setup(target):
     logger.debug("SSH parameters from Vagrant: %s@%s:%s, key=%s",
                  info['username'], info['hostname'], info['port'],
                  info['key_filename'])
+    return info
 
-    unpacked_info = read_dict(target)
+
+def vagrant_machine_id(target):
+    """Gets the identifier of the virtual machine from Vagrant's state.
+
+    This changes if the machine gets destroyed and created again, and is None
+    if it doesn't exist.
+    """
+    machine_dir = target / '.vagrant' / 'machines' / 'default'
+    if not machine_dir.is_dir():
+        return None
+    for provider_dir in sorted(machine_dir.listdir()):
+        id_file = provider_dir / 'id'
+        if id_file.is_file():
+            with id_file.open('rb') as fp:
+                return fp.read().strip()
+    return None
+
+
+def connect_ssh(info, timeout=None):
+    """Opens an SSH connection to the machine.
+    """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(IgnoreMissingKey())
+    ssh.connect(timeout=timeout, **info)
+    return ssh
+
+
+def machine_setup(target, unpacked_info=None):
+    """Prepare the machine and connect to it via SSH.
+
+    Calling ``vagrant ssh-config`` is slow, so the SSH parameters are cached
+    in the unpacker info, along with the identifier of the machine. They are
+    only used if the machine is still the same and the connection succeeds;
+    otherwise, we ask Vagrant again (starting the machine if needed).
+
+    :returns: the SSH parameters and the connected ``paramiko.SSHClient``,
+    which should be used for everything this command does, then closed.
+    """
+    if unpacked_info is None:
+        unpacked_info = read_dict(target)
     use_chroot = unpacked_info['use_chroot']
     gui = unpacked_info['gui']
 
+    ssh = None
+    machine_id = vagrant_machine_id(target)
+    cache = unpacked_info.get('ssh_cache')
+    if (cache is not None and machine_id is not None and
+            cache['machine_id'] == machine_id):
+        info = cache['parameters']
+        try:
+            ssh = connect_ssh(info, timeout=10)
+        except (socket.error, paramiko.SSHException) as e:
+            logger.info("Couldn't connect with cached SSH parameters, "
+                        "asking Vagrant: %s", e)
+            ssh = None
+        else:
+            logger.debug("Using cached SSH parameters: %s@%s:%s",
+                         info['username'], info['hostname'], info['port'])
+    if ssh is None:
+        info = get_ssh_parameters(target)
+        ssh = connect_ssh(info)
+        machine_id = vagrant_machine_id(target)
+        if machine_id is not None:
+            unpacked_info['ssh_cache'] = {'machine_id': machine_id,
+                                          'parameters': info}
+        else:
+            unpacked_info.pop('ssh_cache', None)
+        with update_dict(target) as latest_info:
+            latest_info['ssh_cache'] = unpacked_info.get('ssh_cache')
+
     if use_chroot:
         # Mount directories
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(IgnoreMissingKey())
-        ssh.connect(**info)
         chan = ssh.get_transport().open_session()
         chan.exec_command(
             '/usr/bin/sudo /bin/sh -c %s' % shell_escape(
@@ -190,9 +261,16 @@ def machine_setup(target):
             if chan.recv_exit_status() != 0:
                 logger.critical("Couldn't mount X11 sockets in chroot")
                 sys.exit(1)
-        ssh.close()
 
-    return info
+    return info, ssh
+
+
+def invalidate_ssh_cache(target):
+    """Forgets the cached SSH parameters, when the machine is changed.
+    """
+    unpacked_info = read_dict(target)
+    if unpacked_info.pop('ssh_cache', None) is not None:
+        write_dict(target, unpacked_info)
 
 
 def vagrant_setup_create(args):
@@ -231,8 +309,7 @@ def vagrant_setup_create(args):
     rpz_pack.extract_config(target / 'config.yml')
 
     # Loads config
-    runs, packages, other_files = config = load_config(target / 'config.yml',
-                                                       True)
+    runs, packages, other_files = config = load_target_config(target)
 
     if not args.memory:
         memory = None
@@ -441,7 +518,8 @@ def vagrant_setup_start(args):
 
     check_vagrant_version()
 
-    machine_setup(target)
+    info, ssh = machine_setup(target)
+    ssh.close()
 
 
 class LocalX11Handler(BaseX11Handler):
@@ -470,7 +548,7 @@ def vagrant_run(args):
     check_vagrant_version()
 
     # Loads config
-    config = load_config(target / 'config.yml', True)
+    config = load_target_config(target)
     runs = config.runs
 
     selected_runs = get_runs(runs, args.run, cmdline)
@@ -506,6 +584,8 @@ def vagrant_run(args):
             logger.critical("vagrant reload failed with code %d, aborting",
                             retcode)
             sys.exit(1)
+        # Vagrant might have picked a different SSH port
+        unpacked_info.pop('ssh_cache', None)
         write_dict(target, unpacked_info)
 
     # X11 handler
@@ -560,62 +640,77 @@ def vagrant_run(args):
     cmds = '/usr/bin/sudo /bin/sh -c %s' % shell_escape(cmds)
 
     # Gets vagrant SSH parameters
-    info = machine_setup(target)
+    info, ssh = machine_setup(target, unpacked_info)
 
     signals.pre_run(target=target)
 
     interactive = not (args.no_stdin or
                        os.environ.get('REPROUNZIP_NON_INTERACTIVE'))
-    retcode = run_interactive(info, interactive,
-                              cmds,
-                              not args.no_pty,
-                              x11.port_forward)
+    try:
+        retcode = run_interactive(info, interactive,
+                                  cmds,
+                                  not args.no_pty,
+                                  x11.port_forward,
+                                  ssh=ssh)
+    finally:
+        ssh.close()
     stderr.write("\r\n*** Command finished, status: %d\r\n" % retcode)
 
     # Update input file status
-    metadata_update_run(config, unpacked_info, selected_runs)
-    write_dict(target, unpacked_info)
+    with update_dict(target) as unpacked_info:
+        metadata_update_run(config, unpacked_info, selected_runs)
 
     signals.post_run(target=target, retcode=retcode)
 
 
+# Files are streamed over an SSH channel, with larger windows than paramiko's
+# default so that the transfer doesn't stall waiting for acknowledgements
+TRANSFER_WINDOW_SIZE = 16 << 20
+TRANSFER_PACKET_SIZE = 1 << 17
+TRANSFER_CHUNK_SIZE = 1 << 16
+
+
+def open_transfer_channel(ssh):
+    """Opens a session channel suitable for transferring file contents.
+    """
+    return ssh.get_transport().open_session(
+        window_size=TRANSFER_WINDOW_SIZE,
+        max_packet_size=TRANSFER_PACKET_SIZE)
+
+
 class SSHUploader(FileUploader):
-    def __init__(self, target, input_files, files, use_chroot):
+    def __init__(self, target, input_files, files, use_chroot,
+                 unpacked_info=None, delta=False):
         self.use_chroot = use_chroot
-        FileUploader.__init__(self, target, input_files, files)
+        self.unpacked_info = unpacked_info
+        FileUploader.__init__(self, target, input_files, files, delta=delta)
+
+    def get_remote_path(self, input_path):
+        if self.use_chroot:
+            return join_root(PosixPath('/experimentroot'), input_path)
+        else:
+            return input_path
 
     def prepare_upload(self, files):
-        # Checks whether the VM is running
+        # Checks whether the VM is running, and connect with SSH
         try:
-            ssh_info = machine_setup(self.target)
+            ssh_info, self.ssh = machine_setup(self.target,
+                                               self.unpacked_info)
         except subprocess.CalledProcessError:
             logger.critical("Failed to get the status of the machine -- is "
                             "it running?")
             sys.exit(1)
 
-        # Connect with SSH
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(IgnoreMissingKey())
-        self.ssh.connect(**ssh_info)
-
     def upload_file(self, local_path, input_path):
-        if self.use_chroot:
-            remote_path = join_root(PosixPath('/experimentroot'),
-                                    input_path)
-        else:
-            remote_path = input_path
-
-        temp = make_unique_name(b'reprozip_input_')
-        ltemp = self.target / temp
-        rtemp = PosixPath('/vagrant') / temp
+        remote_path = self.get_remote_path(input_path)
 
-        # Copy file to shared folder
-        logger.info("Copying file to shared folder...")
-        local_path.copyfile(ltemp)
+        # The file is written next to its destination, then moved into place
+        rtemp = remote_path.parent / make_unique_name(b'.reprozip_input_')
 
-        # Move it
-        logger.info("Moving file into place...")
-        chan = self.ssh.get_transport().open_session()
+        # Stream the file to the machine and move it
+        logger.info("Sending file to virtual machine...")
+        chan = open_transfer_channel(self.ssh)
+        cat_cmd = '/bin/cat > %s' % shell_escape(rtemp.path)
         chown_cmd = '/bin/chown --reference=%s %s' % (
             shell_escape(remote_path.path),
             shell_escape(rtemp.path))
@@ -626,16 +721,53 @@ class SSHUploader(FileUploader):
             shell_escape(rtemp.path),
             shell_escape(remote_path.path))
         chan.exec_command('/usr/bin/sudo /bin/sh -c %s' % shell_escape(
-                          ' && '.join((chown_cmd, chmod_cmd, mv_cmd))))
+            '(%s) || { /bin/rm -f %s; exit 1; }' % (
+                ' && '.join((cat_cmd, chown_cmd, chmod_cmd, mv_cmd)),
+                shell_escape(rtemp.path))))
+        try:
+            with local_path.open('rb') as fp:
+                chunk = fp.read(TRANSFER_CHUNK_SIZE)
+                while chunk:
+                    chan.sendall(chunk)
+                    chunk = fp.read(TRANSFER_CHUNK_SIZE)
+            chan.shutdown_write()
+        except socket.error:
+            pass  # The command failed, exit status is checked below
         if chan.recv_exit_status() != 0:
-            logger.critical("Couldn't move file in virtual machine")
-            try:
-                ltemp.remove()
-            except OSError:
-                pass
+            logger.critical("Couldn't upload file to virtual machine")
             sys.exit(1)
         chan.close()
 
+    def get_block_hashes(self, input_path, block_size):
+        remote_path = self.get_remote_path(input_path)
+        chan = self.ssh.get_transport().open_session()
+        chan.exec_command('/usr/bin/sudo /bin/sh -c %s' % shell_escape(
+            delta_hashes_command(remote_path.path, block_size)))
+        output = chan.makefile('rb').read()
+        if chan.recv_exit_status() != 0:
+            return None
+        return parse_block_hashes(output)
+
+    def write_blocks(self, local_path, input_path, runs, truncate):
+        remote_path = self.get_remote_path(input_path)
+        with local_path.open('rb') as fp:
+            for i, (first_block, count) in enumerate(runs):
+                chan = open_transfer_channel(self.ssh)
+                chan.exec_command('/usr/bin/sudo /bin/sh -c %s' % shell_escape(
+                    delta_write_command(remote_path.path,
+                                        self.delta_block_size, first_block,
+                                        truncate and i == len(runs) - 1)))
+                try:
+                    for chunk in self.read_blocks(fp, first_block, count):
+                        chan.sendall(chunk)
+                    chan.shutdown_write()
+                except socket.error:
+                    pass  # The command failed, exit status is checked below
+                if chan.recv_exit_status() != 0:
+                    logger.critical("Couldn't write file in virtual machine")
+                    sys.exit(1)
+                chan.close()
+
     def finalize(self):
         self.ssh.close()
 
@@ -651,55 +783,51 @@ def vagrant_upload(args):
     use_chroot = unpacked_info['use_chroot']
 
     try:
-        SSHUploader(target, input_files, files, use_chroot)
+        SSHUploader(target, input_files, files, use_chroot, unpacked_info,
+                    delta=args.delta)
     finally:
         write_dict(target, unpacked_info)
 
 
 class SSHDownloader(FileDownloader):
+    max_workers = 4
+
     def __init__(self, target, files, use_chroot, all_=False):
         self.use_chroot = use_chroot
         FileDownloader.__init__(self, target, files, all_=all_)
 
     def prepare_download(self, files):
-        # Checks whether the VM is running
+        # Checks whether the VM is running, and connect with SSH
         try:
-            info = machine_setup(self.target)
+            info, self.ssh = machine_setup(self.target)
         except subprocess.CalledProcessError:
             logger.critical("Failed to get the status of the machine -- is "
                             "it running?")
             sys.exit(1)
 
-        # Connect with SSH
-        self.ssh = paramiko.SSHClient()
-        self.ssh.set_missing_host_key_policy(IgnoreMissingKey())
-        self.ssh.connect(**info)
-
     def download(self, remote_path, local_path):
         if self.use_chroot:
             remote_path = join_root(PosixPath('/experimentroot'), remote_path)
 
-        temp = make_unique_name(b'reprozip_output_')
-        rtemp = PosixPath('/vagrant') / temp
-        ltemp = self.target / temp
-
-        # Copy file to shared folder
-        logger.info("Copying file to shared folder...")
-        chan = self.ssh.get_transport().open_session()
-        cp_cmd = '/bin/cp %s %s' % (
-            shell_escape(remote_path.path),
-            shell_escape(rtemp.path))
-        chown_cmd = '/bin/chown vagrant %s' % shell_escape(rtemp.path)
-        chmod_cmd = '/bin/chmod 644 %s' % shell_escape(rtemp.path)
-        chan.exec_command('/usr/bin/sudo /bin/sh -c %s' % shell_escape(
-            ' && '.join((cp_cmd, chown_cmd, chmod_cmd))))
+        # The file is written to a temporary file first, so that the
+        # destination isn't overwritten if the transfer fails
+        ltemp = local_path.parent / make_unique_name(b'.reprozip_output_')
+
+        # Stream the file from the machine
+        logger.info("Receiving file from virtual machine...")
+        chan = open_transfer_channel(self.ssh)
+        chan.exec_command('/usr/bin/sudo /bin/cat %s' % shell_escape(
+            remote_path.path))
+        with ltemp.open('wb') as fp:
+            chunk = chan.recv(TRANSFER_CHUNK_SIZE)
+            while chunk:
+                fp.write(chunk)
+                chunk = chan.recv(TRANSFER_CHUNK_SIZE)
         if chan.recv_exit_status() != 0:
-            logger.critical("Couldn't copy file in virtual machine")
-            try:
-                ltemp.remove()
-            except OSError:
-                pass
+            logger.critical("Couldn't get file from virtual machine")
+            ltemp.remove()
             return False
+        chan.close()
 
         # Move file to final destination
         try:
@@ -711,10 +839,33 @@ class SSHDownloader(FileDownloader):
             return False
         return True
 
+    def download_archive(self, remote_paths):
+        chan = open_transfer_channel(self.ssh)
+        chan.exec_command('/usr/bin/sudo /bin/tar -c -h -f - -C %s -- %s' % (
+            '/experimentroot' if self.use_chroot else '/',
+            ' '.join(shell_escape(join_root(PosixPath(''), p).path)
+                     for p in remote_paths)))
+        return ChannelReader(chan)
+
     def finalize(self):
         self.ssh.close()
 
 
+class ChannelReader(object):
+    """Standard output of a command run over SSH, as a file-like object.
+    """
+    def __init__(self, chan):
+        self.chan = chan
+        self.fp = chan.makefile('rb')
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def close(self):
+        self.fp.close()
+        self.chan.close()
+
+
 @target_must_exist
 def vagrant_download(args):
     """Gets an output file out of the VM.
@@ -732,6 +883,7 @@ def vagrant_suspend(args):
     """
     target = Path(args.target[0])
 
+    invalidate_ssh_cache(target)
     retcode = subprocess.call(['vagrant', 'suspend'], cwd=target.path)
     if retcode != 0:
         logger.critical("vagrant suspend failed with code %d, ignoring...",
@@ -743,8 +895,8 @@ def vagrant_destroy_vm(args):
     """Destroys the VM through Vagrant.
     """
     target = Path(args.target[0])
-    read_dict(target)
 
+    invalidate_ssh_cache(target)
     retcode = subprocess.call(['vagrant', 'destroy', '-f'], cwd=target.path)
     if retcode != 0:
         logger.critical("vagrant destroy failed with code %d, ignoring...",
@@ -908,6 +1060,9 @@ def setup(parser, **kwargs):
     add_opt_general(parser_upload)
     parser_upload.add_argument('file', nargs=argparse.ZERO_OR_MORE,
                                help="<path>:<input_file_name>")
+    parser_upload.add_argument('--delta', action='store_true', default=False,
+                               help="Only send the parts of the files that "
+                                    "changed")
     parser_upload.set_defaults(func=vagrant_upload)
 
     # run
@@ -72,8 +72,11 @@ class SSHForwarder(BaseForwarder):
         def __init__(self, channel):
             self.channel = channel
 
+        def fileno(self):
+            return self.channel.fileno()
+
         def sendall(self, data):
-            return self.channel.send(data)
+            return self.channel.sendall(data)
 
         def recv(self, data):
             return self.channel.recv(data)
@@ -86,11 +89,12 @@ class SSHForwarder(BaseForwarder):
         socklike = self._ChannelWrapper(channel)
         t = threading.Thread(target=self._forward,
                              args=(socklike, src_addr))
-        t.setDaemon(True)
+        t.daemon = True
         t.start()
 
 
-def run_interactive(ssh_info, interactive, cmd, request_pty, forwarded_ports):
+def run_interactive(ssh_info, interactive, cmd, request_pty, forwarded_ports,
+                    ssh=None):
     """Runs a command on an SSH server.
 
     If `interactive` is True, we'll try to find an ``ssh`` executable, falling
@@ -112,6 +116,9 @@ def run_interactive(ssh_info, interactive, cmd, request_pty, forwarded_ports):
     and `connector` is the connector object used to build the connected socket
     to forward to on this side
     :type forwarded_ports: collections.Iterable[(int, object)]
+    :param ssh: existing paramiko connection to use instead of opening a new
+    one; it is left open
+    :type ssh: paramiko.SSHClient
     """
     if interactive:
         ssh_exe = find_ssh_executable()
@@ -140,9 +147,11 @@ def run_interactive(ssh_info, interactive, cmd, request_pty, forwarded_ports):
     else:
         record_usage(vagrant_ssh='interactive' if interactive else 'simple')
         # Connects to the machine
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(IgnoreMissingKey())
-        ssh.connect(**ssh_info)
+        close_ssh = ssh is None
+        if close_ssh:
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(IgnoreMissingKey())
+            ssh.connect(**ssh_info)
 
         # Starts forwarding
         forwarders = []
@@ -170,5 +179,6 @@ def run_interactive(ssh_info, interactive, cmd, request_pty, forwarded_ports):
                 stdout_bytes.write(data)
                 stdout_bytes.flush()
         retcode = chan.recv_exit_status()
-        ssh.close()
+        if close_ssh:
+            ssh.close()
         return retcode
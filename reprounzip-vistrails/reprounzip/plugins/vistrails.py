@@ -27,9 +27,9 @@ import subprocess
 import sys
 import zipfile
 
-from reprounzip.common import load_config, setup_logging, record_usage
+from reprounzip.common import setup_logging, record_usage
 from reprounzip import signals
-from reprounzip.unpackers.common import shell_escape
+from reprounzip.unpackers.common import load_target_config, shell_escape
 from reprounzip.utils import iteritems
 
 
@@ -219,7 +219,7 @@ def do_vistrails(target, pack=None, **kwargs):
     """
     record_usage(do_vistrails=True)
 
-    config = load_config(target / 'config.yml', canonical=True)
+    config = load_target_config(target)
 
     # Writes VisTrails workflow
     bundle = target / 'vistrails.vt'
@@ -309,7 +309,7 @@ def run_from_vistrails():
 
     args = parser.parse_args(sys.argv[2:])
 
-    config = load_config(Path(args.directory) / 'config.yml', canonical=True)
+    config = load_target_config(Path(args.directory))
 
     python = sys.executable
     rpuz = [python, '-c', 'from reprounzip.main import main; main()',
@@ -18,9 +18,11 @@ if __name__ == '__main__':  # noqa
     main()
 
 import argparse
+import importlib
+import json
 import locale
 import logging
-from pkg_resources import iter_entry_points
+import os
 import sys
 import traceback
 
@@ -29,6 +31,7 @@ from reprounzip.common import setup_logging, \
     submit_usage_report, record_usage
 from reprounzip import signals
 from reprounzip.unpackers.common import UsageError
+from reprounzip.utils import cache_dir, replace_file
 
 
 __version__ = '1.0.16'
@@ -40,24 +43,165 @@ logger = logging.getLogger('reprounzip')
 unpackers = {}
 
 
-def get_plugins(entry_point_name):
-    for entry_point in iter_entry_points(entry_point_name):
+#: Version of the format of the plugin manifest
+PLUGIN_MANIFEST_VERSION = 1
+
+PLUGIN_GROUPS = ['reprounzip.plugins', 'reprounzip.unpackers']
+
+#: Subcommands that use the information returned by all the unpackers (for
+#: example their compatibility tests)
+ALL_UNPACKERS_COMMANDS = ('info',)
+
+
+def _plugin_manifest_key():
+    """Identifies the installed distributions.
+
+    Installing, upgrading or removing a distribution changes the modification
+    time of the directory it is in, so this changes when the entry points
+    might have.
+    """
+    key = [__version__, sys.version]
+    for entry in sys.path:
         try:
-            func = entry_point.load()
+            mtime = os.stat(entry or '.').st_mtime
+        except OSError:
+            mtime = None
+        key.append([entry, mtime])
+    return key
+
+
+def _scan_plugins():
+    """Loads all the entry points, to build the plugin manifest.
+    """
+    from pkg_resources import iter_entry_points
+
+    plugins = {}
+    for group in PLUGIN_GROUPS:
+        plugins[group] = entries = []
+        for entry_point in iter_entry_points(group):
+            plugin = {'name': entry_point.name,
+                      'module': entry_point.module_name,
+                      'attrs': list(entry_point.attrs),
+                      'dist': '%s %s' % (entry_point.dist.project_name,
+                                         entry_point.dist.version),
+                      'description': None}
+            func = load_plugin(plugin)
+            if func is not None:
+                # Docstring is used as description (used for detailed help)
+                plugin['description'] = func.__doc__.strip()
+            entries.append(plugin)
+    return plugins
+
+
+def get_plugin_manifest():
+    """Gets the plugins that are installed, without importing them.
+
+    Discovering the entry points means importing pkg_resources, scanning all
+    the installed distributions and importing every plugin; this is only done
+    when the cached manifest in ``~/.cache/reprozip/plugins.json`` is missing
+    or out of date.
+    """
+    manifest = cache_dir() / 'plugins.json'
+    key = _plugin_manifest_key()
+    try:
+        with manifest.open('r') as fp:
+            cached = json.load(fp)
+        if (cached['version'] == PLUGIN_MANIFEST_VERSION and
+                cached['key'] == key):
+            return cached['plugins']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    plugins = _scan_plugins()
+    logger.debug("Writing plugin manifest %s", manifest)
+    try:
+        manifest.parent.mkdir(parents=True)
+        fd, tmp = manifest.parent.tempfile(prefix='.plugins_')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'version': PLUGIN_MANIFEST_VERSION,
+                           'key': key,
+                           'plugins': plugins}, fp)
+            replace_file(tmp, manifest)
         except Exception:
-            print("Plugin %s from %s %s failed to initialize!" % (
-                  entry_point.name,
-                  entry_point.dist.project_name, entry_point.dist.version),
-                  file=sys.stderr)
-            traceback.print_exc(file=sys.stderr)
+            tmp.remove()
+            raise
+    except (IOError, OSError) as e:
+        logger.debug("Couldn't write plugin manifest: %s", e)
+    return plugins
+
+
+def load_plugin(plugin):
+    """Imports a plugin from the manifest, returning its function or None.
+    """
+    try:
+        func = importlib.import_module(plugin['module'])
+        for attr in plugin['attrs']:
+            func = getattr(func, attr)
+    except Exception:
+        print("Plugin %s from %s failed to initialize!" % (
+              plugin['name'], plugin['dist']),
+              file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        return None
+    return func
+
+
+def get_plugins(entry_point_name):
+    for plugin in get_plugin_manifest().get(entry_point_name, []):
+        func = load_plugin(plugin)
+        if func is None:
             continue
-        name = entry_point.name
-        # Docstring is used as description (used for detailed help)
         descr = func.__doc__.strip()
         # First line of docstring is the help (used for general help)
         descr_1 = descr.split('\n', 1)[0]
 
-        yield name, func, descr, descr_1
+        yield plugin['name'], func, descr, descr_1
+
+
+def _selected_subcommand(argv):
+    """Finds the subcommand on the command-line, before parsing it.
+
+    The options of the main parser don't take values, so this is the first
+    argument that is not an option.
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
+def add_unpackers(subparsers, add_options, selected):
+    """Adds the subcommands of the unpackers, filling `unpackers`.
+
+    Only the selected one gets imported, the others are listed using the
+    description from the manifest. Subcommands in `ALL_UNPACKERS_COMMANDS`
+    need the information of every unpacker, so they all get imported then.
+    """
+    load_all = selected in ALL_UNPACKERS_COMMANDS
+    for plugin in get_plugin_manifest()['reprounzip.unpackers']:
+        name = plugin['name']
+        descr = plugin['description']
+        if load_all or name == selected or descr is None:
+            func = load_plugin(plugin)
+            if func is None:
+                continue
+            descr = func.__doc__.strip()
+        else:
+            func = None
+        # First line of docstring is the help (used for general help)
+        descr_1 = descr.split('\n', 1)[0]
+        plugin_parser = subparsers.add_parser(
+            name, help=descr_1, description=descr,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+        add_options(plugin_parser)
+        if func is None:
+            continue
+        info = func(plugin_parser)
+        plugin_parser.set_defaults(selected_unpacker=name)
+        if info is None:
+            info = {}
+        unpackers[name] = info
 
 
 class RPUZArgumentParser(argparse.ArgumentParser):
@@ -113,16 +257,8 @@ def main():
     parser_stats.set_defaults(func=usage_report)
 
     # Loads unpackers
-    for name, func, descr, descr_1 in get_plugins('reprounzip.unpackers'):
-        plugin_parser = subparsers.add_parser(
-            name, help=descr_1, description=descr,
-            formatter_class=argparse.RawDescriptionHelpFormatter)
-        add_options(plugin_parser)
-        info = func(plugin_parser)
-        plugin_parser.set_defaults(selected_unpacker=name)
-        if info is None:
-            info = {}
-        unpackers[name] = info
+    add_unpackers(subparsers, add_options,
+                  _selected_subcommand(sys.argv[1:]))
 
     signals.pre_parse_args(parser=parser, subparsers=subparsers)
     args = parser.parse_args()
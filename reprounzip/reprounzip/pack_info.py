@@ -21,10 +21,11 @@ import platform
 from rpaths import Path
 import sys
 
-from reprounzip.common import RPZPack, load_config as load_config_file
+from reprounzip.common import RPZPack
 from reprounzip.main import unpackers
-from reprounzip.unpackers.common import load_config, COMPAT_OK, COMPAT_MAYBE, \
-    COMPAT_NO, UsageError, shell_escape, metadata_read
+from reprounzip.unpackers.common import load_config, load_target_config, \
+    COMPAT_OK, COMPAT_MAYBE, COMPAT_NO, UsageError, shell_escape, \
+    metadata_read
 from reprounzip.utils import iteritems, itervalues, unicode_, hsize
 
 
@@ -79,7 +80,7 @@ def get_package_info(pack, read_data=False):
     unpacked_packages_files = 0
     packed_packages = 0
     for package in packages:
-        nb = len(package.files)
+        nb = package.nb_files
         total_paths += nb
         if package.packfiles:
             packed_packages_files += nb
@@ -287,8 +288,7 @@ def showfiles(args):
 
     if pack.is_dir():
         # Reads info from an unpacked directory
-        config = load_config_file(pack / 'config.yml',
-                                  canonical=True)
+        config = load_target_config(pack)
 
         # Filter files by run
         if args.run is not None:
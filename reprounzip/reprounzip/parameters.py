@@ -15,7 +15,6 @@ and Docker images for various operating systems.
 
 from __future__ import division, print_function, unicode_literals
 
-from distutils.version import LooseVersion
 import json
 import logging
 import os
@@ -70,6 +69,9 @@ def update_parameters():
             except OSError:
                 pass
         else:
+            # Imported here, it brings in setuptools
+            from distutils.version import LooseVersion
+
             ver = LooseVersion(parameters.get('version', '1.0'))
             if LooseVersion('1.0') <= ver < LooseVersion('1.1'):
                 return
@@ -14,23 +14,29 @@ from reprounzip.utils import join_root
 from reprounzip.unpackers.common.misc import UsageError, \
     COMPAT_OK, COMPAT_NO, COMPAT_MAYBE, \
     composite_action, target_must_exist, unique_names, \
-    make_unique_name, shell_escape, load_config, busybox_url, sudo_url, \
+    make_unique_name, shell_escape, load_config, load_target_config, \
+    busybox_url, sudo_url, \
     FileUploader, FileDownloader, get_runs, add_environment_options, \
     fixup_environment, interruptible_call, \
-    metadata_read, metadata_write, metadata_initial_iofiles, \
-    metadata_update_run, parse_ports
+    metadata_read, metadata_write, metadata_update, \
+    metadata_initial_iofiles, metadata_update_run, parse_ports, \
+    delta_hashes_command, parse_block_hashes, delta_write_command
 from reprounzip.unpackers.common.packages import THIS_DISTRIBUTION, \
     PKG_NOT_INSTALLED, CantFindInstaller, select_installer
+from reprounzip.unpackers.common.tracecache import cached_trace, \
+    file_trace_key, prune_trace_cache, trace_cache_path
 
 
 __all__ = ['THIS_DISTRIBUTION', 'PKG_NOT_INSTALLED', 'select_installer',
            'COMPAT_OK', 'COMPAT_NO', 'COMPAT_MAYBE',
            'UsageError', 'CantFindInstaller',
            'composite_action', 'target_must_exist', 'unique_names',
-           'make_unique_name', 'shell_escape', 'load_config', 'busybox_url',
-           'sudo_url',
+           'make_unique_name', 'shell_escape', 'load_config',
+           'load_target_config', 'busybox_url', 'sudo_url',
            'join_root', 'FileUploader', 'FileDownloader', 'get_runs',
            'add_environment_options', 'fixup_environment',
            'interruptible_call', 'metadata_read', 'metadata_write',
-           'metadata_initial_iofiles', 'metadata_update_run',
-           'parse_ports']
+           'metadata_update', 'metadata_initial_iofiles',
+           'metadata_update_run', 'parse_ports', 'delta_hashes_command',
+           'parse_block_hashes', 'delta_write_command', 'cached_trace',
+           'file_trace_key', 'prune_trace_cache', 'trace_cache_path']
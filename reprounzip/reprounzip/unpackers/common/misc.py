@@ -7,8 +7,10 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import contextlib
 import copy
 import functools
+import hashlib
 import logging
 import itertools
 import os
@@ -22,12 +24,18 @@ import signal
 import subprocess
 import sys
 import tarfile
+import threading
 
 import reprounzip.common
 from reprounzip.common import RPZPack
 from reprounzip.parameters import get_parameter
 from reprounzip.utils import PY3, irange, iteritems, itervalues, \
-    stdout_bytes, unicode_, join_root, copyfile
+    stdout_bytes, unicode_, join_root, copyfile, replace_file
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 
 logger = logging.getLogger('reprounzip')
@@ -82,13 +90,15 @@ def unique_names():
 
 
 unique_names = unique_names()
+_unique_names_lock = threading.Lock()
 
 
 def make_unique_name(prefix):
     """Makes a unique (random) bytestring name, starting with the given prefix.
     """
     assert isinstance(prefix, bytes)
-    return prefix + next(unique_names)
+    with _unique_names_lock:
+        return prefix + next(unique_names)
 
 
 safe_shell_chars = set("ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -123,6 +133,78 @@ def load_config(pack):
         return reprounzip.common.load_config(configfile, canonical=True)
 
 
+#: Version of the format of the '.reprounzip-config' file
+CONFIG_CACHE_VERSION = 1
+
+
+def _config_stat(configfile):
+    st = configfile.stat()
+    return st.st_size, st.st_mtime
+
+
+def _config_hash(configfile):
+    h = hashlib.sha1()
+    with configfile.open('rb') as fp:
+        chunk = fp.read(4096)
+        while chunk:
+            h.update(chunk)
+            chunk = fp.read(4096)
+    return h.hexdigest()
+
+
+def load_target_config(target):
+    """Loads the configuration file of an unpacked directory.
+
+    Parsing the YAML file is slow for big experiments, so the parsed document
+    is also kept in `target / '.reprounzip-config'`, and read from there by
+    the following commands. That copy is used as long as config.yml has the
+    same size and modification time, or the same hash.
+    """
+    configfile = target / 'config.yml'
+    cachefile = target / '.reprounzip-config'
+
+    size, mtime = _config_stat(configfile)
+    digest = None
+    try:
+        with cachefile.open('rb') as fp:
+            version, c_size, c_mtime, c_digest = pickle.load(fp)
+            if version == CONFIG_CACHE_VERSION and c_size == size:
+                if c_mtime != mtime:
+                    digest = _config_hash(configfile)
+                if c_mtime == mtime or c_digest == digest:
+                    document = pickle.load(fp)
+                    return reprounzip.common.parse_config(document, True)
+    except Exception as e:
+        if not isinstance(e, (IOError, OSError)):
+            logger.warning("Couldn't read %s: %s", cachefile, e)
+
+    document = reprounzip.common.read_config_document(configfile)
+    # Serialized now, parse_config() modifies the runs
+    serialized = pickle.dumps(document, 2)
+    config = reprounzip.common.parse_config(document, True)
+
+    # Writes the parsed document for next time
+    if digest is None:
+        digest = _config_hash(configfile)
+    try:
+        fd, tmp = Path.tempfile(prefix='.reprounzip-config_', dir=target)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump((CONFIG_CACHE_VERSION, size, mtime, digest), fp,
+                            2)
+                fp.write(serialized)
+            # mkstemp() creates the file readable by its owner only
+            tmp.chmod(0o644)
+            replace_file(tmp, cachefile)
+        except Exception:
+            tmp.remove()
+            raise
+    except (IOError, OSError) as e:
+        logger.warning("Couldn't write %s: %s", cachefile, e)
+
+    return config
+
+
 def busybox_url(arch):
     """Gets the correct URL for the busybox binary given the architecture.
     """
@@ -135,14 +217,61 @@ def sudo_url(arch):
     return get_parameter('rpzsudo_url')[arch]
 
 
+def delta_hashes_command(path, block_size, prefix=''):
+    """Builds a shell command printing the size and block hashes of a file.
+
+    This can be used to implement `FileUploader.get_block_hashes()` when the
+    file is in a machine or container; `prefix` is put before the names of
+    the tools (dd, md5sum, wc), for example ``'/busybox '``. The command exits
+    with code 3 if the file doesn't exist. Parse its output with
+    `parse_block_hashes()`.
+    """
+    return ('f=%(path)s; [ -f "$f" ] || exit 3; '
+            'size=$(%(p)swc -c < "$f"); echo $size; i=0; '
+            'while [ $((i * %(bs)d)) -lt $size ]; do '
+            '%(p)sdd if="$f" bs=%(bs)d skip=$i count=1 2>/dev/null | '
+            '%(p)smd5sum; i=$((i + 1)); done' % dict(
+                path=shell_escape(path), p=prefix, bs=block_size))
+
+
+def parse_block_hashes(output):
+    """Reads the output of the `delta_hashes_command()`.
+
+    Returns None if the output is invalid.
+    """
+    lines = output.decode('ascii', 'replace').splitlines()
+    try:
+        return int(lines[0]), [line.split()[0] for line in lines[1:]
+                               if line.strip()]
+    except (IndexError, ValueError):
+        return None
+
+
+def delta_write_command(path, block_size, first_block, truncate, prefix=''):
+    """Builds a shell command writing its input over blocks of a file.
+
+    Writing starts at block `first_block` and goes on until the end of the
+    input. If `truncate` is True, the file is cut where the input ends.
+    """
+    return '%sdd of=%s bs=%d seek=%d%s 2>/dev/null' % (
+        prefix, shell_escape(path), block_size, first_block,
+        '' if truncate else ' conv=notrunc')
+
+
 class FileUploader(object):
     """Common logic for 'upload' commands.
+
+    If `delta` is True, unpackers that implement `get_block_hashes()` and
+    `write_blocks()` only send the blocks that changed, see `upload_delta()`.
     """
     data_tgz = 'data.tgz'
+    data_prefix = PosixPath(b'DATA')
+    delta_block_size = 1 << 20
 
-    def __init__(self, target, input_files, files):
+    def __init__(self, target, input_files, files, delta=False):
         self.target = target
         self.input_files = input_files
+        self.delta = delta
         self.run(files)
 
     def run(self, files):
@@ -208,7 +337,9 @@ class FileUploader(object):
                                         local_path)
                         sys.exit(1)
 
-                self.upload_file(local_path, input_path)
+                if not (self.delta and
+                        self.upload_delta(local_path, input_path)):
+                    self.upload_file(local_path, input_path)
 
                 if temp is not None:
                     temp.remove()
@@ -219,8 +350,7 @@ class FileUploader(object):
             self.finalize()
 
     def get_config(self):
-        return reprounzip.common.load_config(self.target / 'config.yml',
-                                             canonical=True)
+        return load_target_config(self.target)
 
     def prepare_upload(self, files):
         pass
@@ -228,7 +358,7 @@ class FileUploader(object):
     def extract_original_input(self, input_name, input_path, temp):
         tar = tarfile.open(str(self.target / self.data_tgz), 'r:*')
         try:
-            member = tar.getmember(str(join_root(PosixPath('DATA'),
+            member = tar.getmember(str(join_root(self.data_prefix,
                                                  input_path)))
         except KeyError:
             return None
@@ -241,13 +371,88 @@ class FileUploader(object):
     def upload_file(self, local_path, input_path):
         raise NotImplementedError
 
+    def upload_delta(self, local_path, input_path):
+        """Replaces an input file by only sending the blocks that changed.
+
+        The MD5 hashes of the blocks of the file currently in the target are
+        compared with the local file's, and runs of consecutive blocks that
+        differ are sent with `write_blocks()`. Returns False if that isn't
+        possible, in which case `upload_file()` is used instead.
+        """
+        block_size = self.delta_block_size
+        remote = self.get_block_hashes(input_path, block_size)
+        if remote is None:
+            logger.debug("Can't upload %s as a delta", input_path)
+            return False
+        remote_size, remote_hashes = remote
+
+        size = local_path.size()
+        nblocks = (size + block_size - 1) // block_size
+        runs = []
+        with local_path.open('rb') as fp:
+            for i in irange(nblocks):
+                digest = hashlib.md5(fp.read(block_size)).hexdigest()
+                # If the size changed, the last run also sets the new size
+                if (i >= len(remote_hashes) or digest != remote_hashes[i] or
+                        (size != remote_size and i == nblocks - 1)):
+                    if runs and runs[-1][0] + runs[-1][1] == i:
+                        runs[-1] = runs[-1][0], runs[-1][1] + 1
+                    else:
+                        runs.append((i, 1))
+        if size != remote_size and not runs:
+            runs.append((0, 0))
+
+        logger.info("Sending %d of %d blocks of %s",
+                    sum(count for first, count in runs), nblocks, local_path)
+        if runs:
+            self.write_blocks(local_path, input_path, runs,
+                              size != remote_size)
+        return True
+
+    def get_block_hashes(self, input_path, block_size):
+        """Gets the size and block hashes of a file in the target.
+
+        Returns a pair ``(size, hashes)`` where `hashes` is the list of the
+        hexadecimal MD5 of each block, or None if it can't be done, for
+        example if the file doesn't exist.
+        """
+        return None
+
+    def write_blocks(self, local_path, input_path, runs, truncate):
+        """Writes blocks from the local file over the file in the target.
+
+        `runs` is a list of ``(first_block, number_of_blocks)``. If `truncate`
+        is True, the file must be cut at the end of the last run (which ends
+        at the end of the local file).
+        """
+        raise NotImplementedError
+
+    def read_blocks(self, fp, first_block, count, chunk_size=65536):
+        """Reads a run of blocks from a file, as chunks of bytes.
+        """
+        fp.seek(first_block * self.delta_block_size)
+        left = count * self.delta_block_size
+        while left > 0:
+            chunk = fp.read(min(chunk_size, left))
+            if not chunk:
+                break
+            left -= len(chunk)
+            yield chunk
+
     def finalize(self):
         pass
 
 
 class FileDownloader(object):
     """Common logic for 'download' commands.
+
+    When several files are requested, they are fetched as a single tar
+    archive if the unpacker implements `download_archive()`; otherwise up to
+    `max_workers` calls to `download()` are made concurrently, from different
+    threads. Unpackers for which this is safe should set it.
     """
+    max_workers = 1
+
     def __init__(self, target, files, all_=False):
         self.target = target
         self.run(files, all_)
@@ -291,34 +496,130 @@ class FileDownloader(object):
 
         success = True
         try:
-            # Download files
+            jobs = []
             for output_name, local_path in resolved_files:
                 try:
                     remote_path = inputs_outputs[output_name].path
                 except KeyError:
                     logger.critical("Invalid output file: %r", output_name)
                     sys.exit(1)
+                jobs.append((remote_path, local_path))
 
-                logger.debug("Downloading file %s", remote_path)
+            # Download files
+            if not self.download_files([(r, l) for r, l in jobs
+                                        if l is not None]):
+                success = False
+
+            # Print files, in order
+            for remote_path, local_path in jobs:
                 if local_path is None:
-                    ret = self.download_and_print(remote_path)
-                else:
-                    ret = self.download(remote_path, local_path)
-                if ret is None:
-                    ret = True
-                    warnings.warn("download() returned None instead of "
-                                  "True/False, assuming True",
-                                  category=DeprecationWarning)
-                if not ret:
-                    success = False
+                    logger.debug("Downloading file %s", remote_path)
+                    if not self._check_download(
+                            self.download_and_print(remote_path)):
+                        success = False
             if not success:
                 sys.exit(1)
         finally:
             self.finalize()
 
+    @staticmethod
+    def _check_download(ret):
+        if ret is None:
+            warnings.warn("download() returned None instead of "
+                          "True/False, assuming True",
+                          category=DeprecationWarning)
+            return True
+        return ret
+
+    def download_files(self, jobs):
+        """Downloads a list of ``(remote_path, local_path)`` pairs.
+
+        Uses `download_archive()` if possible, else calls `download()` from
+        up to `max_workers` threads. Returns False if any download failed.
+        """
+        if len(jobs) > 1:
+            remote_paths = []
+            for remote_path, local_path in jobs:
+                if remote_path not in remote_paths:
+                    remote_paths.append(remote_path)
+            archive = self.download_archive(remote_paths)
+            if archive is not None:
+                return self.extract_archive(archive, jobs)
+
+        if self.max_workers <= 1 or len(jobs) <= 1:
+            success = True
+            for remote_path, local_path in jobs:
+                logger.debug("Downloading file %s", remote_path)
+                if not self._check_download(self.download(remote_path,
+                                                          local_path)):
+                    success = False
+            return success
+
+        # Each worker thread takes files from the shared list until it's empty
+        jobs = list(reversed(jobs))
+        lock = threading.Lock()
+        failed = []
+
+        def worker():
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    remote_path, local_path = jobs.pop()
+                logger.debug("Downloading file %s", remote_path)
+                try:
+                    ret = self._check_download(self.download(remote_path,
+                                                             local_path))
+                except (Exception, SystemExit):
+                    logger.exception("Error downloading %s", remote_path)
+                    ret = False
+                if not ret:
+                    failed.append(remote_path)
+
+        threads = [threading.Thread(target=worker)
+                   for i in irange(min(self.max_workers, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return not failed
+
+    def extract_archive(self, archive, jobs):
+        """Writes the files from a tar archive to their local paths.
+
+        The archive comes from `download_archive()`; its members are named
+        after the remote paths, relative to the root.
+        """
+        wanted = {}
+        for remote_path, local_path in jobs:
+            name = str(join_root(PosixPath(''), remote_path))
+            wanted.setdefault(name, []).append(local_path)
+
+        try:
+            tar = tarfile.open(fileobj=archive, mode='r|')
+            for member in tar:
+                if member.name not in wanted or not member.isfile():
+                    continue
+                local_paths = wanted.pop(member.name)
+                fp = tar.extractfile(member)
+                first = local_paths[0]
+                with first.open('wb') as out:
+                    copyfile(fp, out)
+                for local_path in local_paths[1:]:
+                    first.copyfile(local_path)
+            tar.close()
+        except tarfile.TarError as e:
+            logger.critical("Error reading archive of output files: %s", e)
+            return False
+        finally:
+            archive.close()
+
+        for name in sorted(wanted):
+            logger.critical("Can't get output file: /%s", name)
+        return not wanted
+
     def get_config(self):
-        return reprounzip.common.load_config(self.target / 'config.yml',
-                                             canonical=True)
+        return load_target_config(self.target)
 
     def prepare_download(self, files):
         pass
@@ -339,6 +640,16 @@ class FileDownloader(object):
     def download(self, remote_path, local_path):
         raise NotImplementedError
 
+    def download_archive(self, remote_paths):
+        """Gets several files from the target as a tar archive.
+
+        Returns a file-like object, on which `close()` will be called, or None
+        if the unpacker can't do this. Members should be named after the
+        remote paths, relative to the root; missing files are reported as
+        failures.
+        """
+        return None
+
     def finalize(self):
         pass
 
@@ -506,6 +817,18 @@ def interruptible_call(cmd, **kwargs):
         signal.signal(signal.SIGINT, signal.default_int_handler)
 
 
+#: Version of the format of the metadata file, stored as 'metadata_version'
+METADATA_VERSION = 1
+
+# Metadata files that were read or written, {filename: (stat key, dict)}
+_metadata_cache = {}
+
+
+def _metadata_stat(filename):
+    st = filename.stat()
+    return st.st_size, st.st_mtime, st.st_ino
+
+
 def metadata_read(path, type_):
     """Read the unpacker-specific metadata from an unpacked directory.
 
@@ -520,23 +843,35 @@ def metadata_read(path, type_):
     It's a simple pickled dictionary under path / '.reprounzip'. The
     'input_files' key stores the status of the input files.
 
-    If you change it, don't forget to call `metadata_write` to write it to disk
-    again.
+    The dictionary is kept in memory and only read again if the file changed;
+    you get a copy of it, so if you change it, don't forget to call
+    `metadata_write` to write it to disk again (or use `metadata_update`).
     """
     filename = path / '.reprounzip'
 
-    if not filename.exists():
+    try:
+        key = _metadata_stat(filename)
+    except OSError:
         logger.critical("Required metadata missing, did you point this "
                         "command at the directory you created using the "
                         "'setup' command?")
         raise UsageError
-    with filename.open('rb') as fp:
-        dct = pickle.load(fp)
+    cached = _metadata_cache.get(filename)
+    if cached is not None and cached[0] == key:
+        dct = cached[1]
+    else:
+        with filename.open('rb') as fp:
+            dct = pickle.load(fp)
+        _metadata_cache[filename] = key, dct
+    if dct.get('metadata_version', 0) > METADATA_VERSION:
+        logger.critical("This directory was created by a newer version of "
+                        "reprounzip")
+        raise UsageError
     if type_ is not None and dct['unpacker'] != type_:
         logger.critical("Wrong unpacker used: %s != %s",
                         dct['unpacker'], type_)
         raise UsageError
-    return dct
+    return copy.deepcopy(dct)
 
 
 def metadata_write(path, dct, type_):
@@ -547,13 +882,44 @@ def metadata_write(path, dct, type_):
     :param type_: The name of the unpacker, that is written to the pickle file
     under the key 'unpacker'.
     :param dct: The dictionary with the info to write to the file.
+
+    The file is replaced atomically, so other commands reading it concurrently
+    never see a partial file.
     """
     filename = path / '.reprounzip'
 
     to_write = {'unpacker': type_}
     to_write.update(dct)
-    with filename.open('wb') as fp:
-        pickle.dump(to_write, fp, 2)
+    to_write['metadata_version'] = METADATA_VERSION
+    fd, tmp = Path.tempfile(prefix='.reprounzip_', dir=path)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(to_write, fp, 2)
+        # mkstemp() creates the file readable by its owner only
+        tmp.chmod(0o644)
+        replace_file(tmp, filename)
+    except Exception:
+        tmp.remove()
+        raise
+    _metadata_cache[filename] = (_metadata_stat(filename),
+                                 copy.deepcopy(to_write))
+
+
+@contextlib.contextmanager
+def metadata_update(path, type_):
+    """Context manager changing the unpacker-specific metadata.
+
+    The metadata is read when entering, and written back if the block exits
+    without an exception. On POSIX, a lock is held in between so that commands
+    running concurrently on the same directory don't lose each other's
+    changes; don't do anything long in there.
+    """
+    with (path / '.reprounzip.lock').open('ab') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        dct = metadata_read(path, type_)
+        yield dct
+        metadata_write(path, dct, type_)
 
 
 def metadata_initial_iofiles(config, dct=None):
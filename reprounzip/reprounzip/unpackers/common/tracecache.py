@@ -0,0 +1,156 @@
+# Copyright (C) 2014-2017 New York University
+# This file is part of ReproZip which is released under the Revised BSD License
+# See file LICENSE for full license details.
+
+"""Cache of the trace databases extracted from packs.
+
+Commands like ``reprounzip graph`` often get run many times on the same pack,
+with different options. Instead of extracting (and decompressing) the trace
+every time, it is kept in ``~/.cache/reprozip/traces/<key>/``, where the key
+is a hash of the pack_id and of the name, size and modification time of the
+trace. Plugins can also store data they parsed from the trace in the same
+directory, with `trace_cache_path()`.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import contextlib
+import hashlib
+import logging
+import os
+from rpaths import Path
+import yaml
+
+from reprounzip.common import SafeLoader
+from reprounzip.utils import unicode_, cache_dir, replace_file
+
+
+logger = logging.getLogger('reprounzip')
+
+
+#: Number of traces kept in the cache
+TRACE_CACHE_ENTRIES = 4
+
+#: Maximum number of lines read from the beginning of the configuration to
+#: find the pack_id
+PACK_ID_LINES = 32
+
+
+def trace_cache_dir():
+    return cache_dir() / 'traces'
+
+
+def read_pack_id(fp):
+    """Reads the pack_id from the beginning of a configuration file.
+
+    `save_config()` writes it in the preamble, before the runs, so the rest
+    of the file (which lists every packed file) doesn't need to be parsed.
+    """
+    header = []
+    for i, line in enumerate(fp):
+        if i >= PACK_ID_LINES or line.startswith(b'runs:'):
+            break
+        header.append(line)
+    try:
+        header = yaml.load(b''.join(header), Loader=SafeLoader)
+    except yaml.YAMLError:
+        return None
+    if isinstance(header, dict):
+        return header.get('pack_id')
+    return None
+
+
+def pack_trace_key(rpz_pack):
+    """Computes the cache key for the trace in a pack.
+
+    This uses the name, size and modification time of the trace in the tar,
+    without reading it.
+    """
+    fp = rpz_pack.open_config()
+    try:
+        pack_id = read_pack_id(fp) or ''
+    finally:
+        fp.close()
+    h = hashlib.sha1(('%s\0' % pack_id).encode('utf-8'))
+    for name in ('METADATA/trace.sqlite3.gz', 'METADATA/trace.sqlite3'):
+        try:
+            member = rpz_pack.tar.getmember(name)
+        except KeyError:
+            continue
+        h.update(('%s\0%d\0%d\0' % (
+            name, member.size, member.mtime)).encode('utf-8'))
+        break
+    return h.hexdigest()
+
+
+def file_trace_key(database, pack_id=None):
+    """Computes the cache key for a trace database on disk.
+
+    This uses the file's device, inode, size and modification time.
+    """
+    st = database.stat()
+    h = hashlib.sha1(('%s\0' % (pack_id or '')).encode('utf-8'))
+    h.update(('%s\0%d\0%d\0%d\0%r\0' % (
+        unicode_(database.absolute()), st.st_dev, st.st_ino,
+        st.st_size, st.st_mtime)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def trace_cache_path(key, name):
+    """Gets the path of a file in the cache entry of a trace.
+    """
+    entry = trace_cache_dir() / key
+    entry.mkdir(parents=True)
+    return entry / name
+
+
+def prune_trace_cache(keep=None):
+    """Removes the least recently used entries from the trace cache.
+    """
+    try:
+        entries = sorted(((entry.mtime(), entry)
+                          for entry in trace_cache_dir().listdir()
+                          if entry.is_dir() and entry != keep),
+                         reverse=True)
+    except OSError:
+        return
+    kept = TRACE_CACHE_ENTRIES - (1 if keep is not None else 0)
+    for mtime, entry in entries[kept:]:
+        logger.debug("Removing cached trace %s", entry)
+        try:
+            entry.rmtree()
+        except OSError:
+            logger.warning("Couldn't remove cached trace %s", entry)
+
+
+@contextlib.contextmanager
+def cached_trace(rpz_pack):
+    """Context manager giving the trace database of a pack and its cache key.
+
+    The trace is extracted to the cache the first time. If the cache can't be
+    used, it gets extracted to a temporary file like `RPZPack.with_trace()`
+    does, and the key is None.
+    """
+    try:
+        key = pack_trace_key(rpz_pack)
+        trace = trace_cache_path(key, 'trace.sqlite3')
+        if trace.exists():
+            logger.info("Using cached trace %s", key)
+        else:
+            fd, tmp = Path.tempfile(prefix='.trace_', dir=trace.parent)
+            os.close(fd)
+            try:
+                rpz_pack.extract_trace(tmp)
+                replace_file(tmp, trace)
+            except Exception:
+                tmp.remove()
+                raise
+        # Marks the entry as recently used
+        os.utime(trace.parent.path, None)
+        prune_trace_cache(keep=trace.parent)
+    except (IOError, OSError) as e:
+        logger.warning("Couldn't use the trace cache: %s", e)
+        with rpz_pack.with_trace() as trace:
+            yield trace, None
+        return
+    yield trace, key
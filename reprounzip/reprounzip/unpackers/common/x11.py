@@ -8,6 +8,7 @@
 from __future__ import division, print_function, unicode_literals
 
 import contextlib
+import errno
 import logging
 import os
 from rpaths import Path, PosixPath
@@ -15,6 +16,16 @@ import select
 import socket
 import struct
 import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:
+    import selectors
+except ImportError:  # Python 2
+    selectors = None
 
 from reprounzip.utils import irange, iteritems
 
@@ -335,48 +346,383 @@ class X11Handler(BaseX11Handler):
         return ['echo -ne "%s" > %s' % (xauth, self.xauth)]
 
 
+#: Size of the buffer used for each direction of a forwarded connection
+FORWARD_BUFFER_SIZE = 256 * 1024
+
+_splice_supported = hasattr(os, 'splice')
+
+_would_block = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _Stream(object):
+    """One direction of a forwarded connection, from `src` to `dst`.
+
+    Data goes through a buffer, or through a kernel pipe with ``splice()`` if
+    both ends are real sockets, in which case it never gets copied to
+    userspace.
+    """
+    def __init__(self, src, dst, use_splice):
+        self.src = src
+        self.dst = dst
+        self.eof = False
+        self.pending = 0
+        self.transferred = 0
+        self.pipe = None
+        if use_splice:
+            self.pipe = os.pipe()
+            if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+                try:
+                    fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ,
+                                FORWARD_BUFFER_SIZE)
+                except (IOError, OSError):
+                    pass
+        else:
+            self._use_buffer()
+
+    def _use_buffer(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+        self.buffer = bytearray(FORWARD_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+
+    def want_read(self):
+        return not self.eof and not self.pending
+
+    def fill(self):
+        """Reads as much as possible from the source.
+        """
+        try:
+            if self.pipe is not None:
+                try:
+                    read = os.splice(self.src.fileno(), self.pipe[1],
+                                     FORWARD_BUFFER_SIZE,
+                                     flags=(os.SPLICE_F_MOVE |
+                                            os.SPLICE_F_NONBLOCK))
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        raise
+                    # This kind of socket can't be spliced
+                    logger.debug("splice() unsupported, using a buffer")
+                    self._use_buffer()
+                    return self.fill()
+            else:
+                read = self.src.recv_into(self.buffer)
+                self.start = 0
+        except (OSError, socket.error) as e:
+            if e.errno in _would_block:
+                return
+            raise
+        if read:
+            self.pending = read
+        else:
+            self.eof = True
+
+    def flush(self):
+        """Writes as much buffered data as possible to the destination.
+        """
+        while self.pending:
+            try:
+                if self.pipe is not None:
+                    written = os.splice(self.pipe[0], self.dst.fileno(),
+                                        self.pending,
+                                        flags=(os.SPLICE_F_MOVE |
+                                               os.SPLICE_F_NONBLOCK))
+                else:
+                    written = self.dst.send(
+                        self.view[self.start:self.start + self.pending])
+                    self.start += written
+            except (OSError, socket.error) as e:
+                if e.errno in _would_block:
+                    return
+                raise
+            self.pending -= written
+            self.transferred += written
+
+    def close(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+
+class _ForwardedConnection(object):
+    """A connection forwarded by the `ForwardingLoop`.
+
+    `client` is the accepted socket, `remote` the one we got from entering
+    the connector's `context`; the context is exited when the connection
+    closes.
+    """
+    def __init__(self, forwarder, client, src_addr, context, remote):
+        use_splice = (_splice_supported and
+                      isinstance(client, socket.socket) and
+                      isinstance(remote, socket.socket))
+        client.setblocking(False)
+        remote.setblocking(False)
+        self.forwarder = forwarder
+        self.client = client
+        self.remote = remote
+        self.src_addr = src_addr
+        self.context = context
+        self.upstream = _Stream(client, remote, use_splice)
+        self.downstream = _Stream(remote, client, use_splice)
+        self.masks = {client: 0, remote: 0}
+        self.started = time.time()
+        self.closed = False
+
+    def events(self, sock):
+        """Gets the events we are waiting for on one of the two sockets.
+        """
+        if sock is self.client:
+            reading, writing = self.upstream, self.downstream
+        else:
+            reading, writing = self.downstream, self.upstream
+        mask = 0
+        if reading.want_read():
+            mask |= selectors.EVENT_READ
+        if writing.pending:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    @property
+    def finished(self):
+        return ((self.upstream.eof or self.downstream.eof) and
+                not self.upstream.pending and not self.downstream.pending)
+
+    def handle(self, sock, mask):
+        """Moves data after `sock` became ready.
+        """
+        up, down = self.upstream.transferred, self.downstream.transferred
+        for stream in (self.upstream, self.downstream):
+            if mask & selectors.EVENT_READ and stream.src is sock:
+                stream.fill()
+                stream.flush()
+            elif mask & selectors.EVENT_WRITE and stream.dst is sock:
+                stream.flush()
+        self.forwarder.bytes_upstream += self.upstream.transferred - up
+        self.forwarder.bytes_downstream += self.downstream.transferred - down
+
+    def close(self):
+        self.closed = True
+        self.upstream.close()
+        self.downstream.close()
+        self.client.close()
+        try:
+            self.context.__exit__(None, None, None)
+        except Exception:
+            logger.warning("Error closing forwarded connection",
+                           exc_info=True)
+        duration = time.time() - self.started
+        logger.debug("Forwarded connection from %s: %d bytes up, %d bytes "
+                     "down in %.2fs",
+                     self.src_addr, self.upstream.transferred,
+                     self.downstream.transferred, duration)
+
+
+class ForwardingLoop(object):
+    """Event loop moving the data of all forwarded connections.
+
+    A single thread waits on all the sockets using the best mechanism
+    available (epoll, kqueue, ...) instead of having a thread per connection.
+    Use `get()` to get the shared instance, which is created on first use.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+        self._new_connections = []
+        self._lock = threading.Lock()
+
+        t = threading.Thread(target=self._run)
+        t.daemon = True
+        t.start()
+
+    def add(self, connection):
+        """Starts forwarding a `_ForwardedConnection`, from any thread.
+        """
+        with self._lock:
+            self._new_connections.append(connection)
+        try:
+            self._wakeup_send.send(b'\0')
+        except socket.error:  # Buffer full, the loop will wake up anyway
+            pass
+
+    def _update(self, connection):
+        for sock in (connection.client, connection.remote):
+            old, new = connection.masks[sock], connection.events(sock)
+            if old == new:
+                continue
+            if not old:
+                self.selector.register(sock, new, connection)
+            elif not new:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, new, connection)
+            connection.masks[sock] = new
+
+    def _close(self, connection):
+        for sock, mask in iteritems(connection.masks):
+            if mask:
+                try:
+                    self.selector.unregister(sock)
+                except (KeyError, ValueError):
+                    pass
+                connection.masks[sock] = 0
+        try:
+            connection.close()
+        except Exception:
+            logger.warning("Error closing forwarded connection",
+                           exc_info=True)
+
+    def _handle(self, connection, sock=None, mask=0):
+        """Moves the data of a connection and updates what it waits for.
+
+        Errors only close this connection, the loop keeps serving the others.
+        """
+        try:
+            if sock is not None:
+                connection.handle(sock, mask)
+            if connection.finished:
+                self._close(connection)
+            else:
+                self._update(connection)
+        except (OSError, socket.error) as e:
+            logger.info("Forwarded connection from %s failed: %s",
+                        connection.src_addr, e)
+            self._close(connection)
+        except Exception:
+            logger.warning("Error forwarding connection from %s",
+                           connection.src_addr, exc_info=True)
+            self._close(connection)
+
+    def _run(self):
+        while True:
+            for key, mask in self.selector.select():
+                connection = key.data
+                if connection is None:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except socket.error:
+                        pass
+                    with self._lock:
+                        connections = self._new_connections
+                        self._new_connections = []
+                    for connection in connections:
+                        self._handle(connection)
+                elif not connection.closed:
+                    self._handle(connection, key.fileobj, mask)
+
+
 class BaseForwarder(object):
     """Accepts connections and forwards to the given connector object.
 
     The `connector` is a function which takes the address of remote process
     connecting on this ends, and gives out a socket object that is the second
-    endpoint of the tunnel. The socket object must provide ``recv()``,
-    ``sendall()`` and ``close()``.
+    endpoint of the tunnel. The socket object must provide ``fileno()``,
+    ``recv()``, ``sendall()`` and ``close()``.
+
+    The number of connections and the bytes forwarded in each direction are
+    counted in `connections`, `bytes_upstream` (from the client to the
+    connector) and `bytes_downstream`.
 
     Abstract class, implementations will provide actual ways to accept
     connections.
     """
     def __init__(self, connector):
         self.connector = connector
+        self.connections = 0
+        self.bytes_upstream = 0
+        self.bytes_downstream = 0
+
+    def _start_forwarding(self, client, src_addr):
+        """Forwards a new connection from the event loop.
+
+        Falls back to a thread running `_forward()` if there is no
+        ``selectors`` module or if `client` is not a real socket.
+        """
+        if selectors is None or not isinstance(client, socket.socket):
+            t = threading.Thread(target=self._forward,
+                                 args=(client, src_addr))
+            t.daemon = True
+            t.start()
+            return
+
+        context = self.connector(src_addr)
+        try:
+            remote = context.__enter__()
+        except Exception:
+            logger.warning("Couldn't forward connection from %s",
+                           src_addr, exc_info=True)
+            client.close()
+            return
+        self.connections += 1
+        if isinstance(remote, socket.socket):
+            ForwardingLoop.get().add(
+                _ForwardedConnection(self, client, src_addr, context, remote))
+        else:
+            t = threading.Thread(target=self._forward_entered,
+                                 args=(client, context, remote))
+            t.daemon = True
+            t.start()
+
+    def _forward_entered(self, client, context, remote):
+        try:
+            with context:
+                self._pump(client, remote)
+        finally:
+            client.close()
 
     def _forward(self, client, src_addr):
+        """Forwards a connection from the current thread.
+        """
+        self.connections += 1
         try:
             with self.connector(src_addr) as local_connection:
-                local_fd = local_connection.fileno()
-                client_fd = client.fileno()
-                while True:
-                    r, w, x = select.select([local_fd, client_fd], [], [])
-                    if local_fd in r:
-                        data = local_connection.recv(4096)
-                        if not data:
-                            break
-                        client.sendall(data)
-                    elif client_fd in r:
-                        data = client.recv(4096)
-                        if not data:
-                            break
-                        local_connection.sendall(data)
+                self._pump(client, local_connection)
         finally:
             client.close()
 
+    def _pump(self, client, local_connection):
+        local_fd = local_connection.fileno()
+        client_fd = client.fileno()
+        while True:
+            r, w, x = select.select([local_fd, client_fd], [], [])
+            if local_fd in r:
+                data = local_connection.recv(FORWARD_BUFFER_SIZE)
+                if not data:
+                    break
+                client.sendall(data)
+                self.bytes_downstream += len(data)
+            if client_fd in r:
+                data = client.recv(FORWARD_BUFFER_SIZE)
+                if not data:
+                    break
+                local_connection.sendall(data)
+                self.bytes_upstream += len(data)
+
 
 class LocalForwarder(BaseForwarder):
     """Listens on a random port and forwards to the given connector object.
 
     The `connector` is a function which takes the address of remote process
     connecting on this ends, and gives out a socket object that is the second
-    endpoint of the tunnel. The socket object must provide ``recv()``,
-    ``sendall()`` and ``close()``.
+    endpoint of the tunnel. The socket object must provide ``fileno()``,
+    ``recv()``, ``sendall()`` and ``close()``.
     """
     def __init__(self, connector, local_port=None):
         BaseForwarder.__init__(self, connector)
@@ -386,13 +732,10 @@ class LocalForwarder(BaseForwarder):
         server.listen(5)
 
         t = threading.Thread(target=self._accept, args=(server,))
-        t.setDaemon(True)
+        t.daemon = True
         t.start()
 
     def _accept(self, server):
         while True:
             client, src_addr = server.accept()
-            t = threading.Thread(target=self._forward,
-                                 args=(client, src_addr))
-            t.setDaemon(True)
-            t.start()
+            self._start_forwarding(client, src_addr)
@@ -18,6 +18,7 @@ from __future__ import division, print_function, unicode_literals
 
 import argparse
 import copy
+import hashlib
 import logging
 import os
 import platform
@@ -27,14 +28,14 @@ import subprocess
 import sys
 import tarfile
 
-from reprounzip.common import RPZPack, load_config as load_config_file, \
-    record_usage
+from reprounzip.common import RPZPack, record_usage
 from reprounzip import signals
 from reprounzip.unpackers.common import THIS_DISTRIBUTION, PKG_NOT_INSTALLED, \
     COMPAT_OK, COMPAT_NO, CantFindInstaller, target_must_exist, shell_escape, \
-    load_config, select_installer, busybox_url, join_root, FileUploader, \
-    FileDownloader, get_runs, add_environment_options, fixup_environment, \
-    interruptible_call, metadata_read, metadata_write, \
+    load_config, load_target_config, select_installer, busybox_url, \
+    join_root, FileUploader, FileDownloader, get_runs, \
+    add_environment_options, fixup_environment, interruptible_call, \
+    metadata_read, metadata_write, metadata_update, \
     metadata_initial_iofiles, metadata_update_run
 from reprounzip.unpackers.common.x11 import X11Handler, LocalForwarder
 from reprounzip.utils import unicode_, irange, iteritems, itervalues, \
@@ -125,7 +126,7 @@ def directory_create(args):
     rpz_pack.extract_config(target / 'config.yml')
 
     # Loads config
-    config = load_config_file(target / 'config.yml', True)
+    config = load_target_config(target)
     packages = config.packages
 
     target.mkdir()
@@ -190,11 +191,11 @@ def directory_run(args):
     """Runs the command in the directory.
     """
     target = Path(args.target[0])
-    unpacked_info = metadata_read(target, 'directory')
+    metadata_read(target, 'directory')
     cmdline = args.cmdline
 
     # Loads config
-    config = load_config_file(target / 'config.yml', True)
+    config = load_target_config(target)
     runs = config.runs
 
     selected_runs = get_runs(runs, args.run, cmdline)
@@ -287,8 +288,8 @@ def directory_run(args):
     signals.post_run(target=target, retcode=retcode)
 
     # Update input file status
-    metadata_update_run(config, unpacked_info, selected_runs)
-    metadata_write(target, unpacked_info, 'directory')
+    with metadata_update(target, 'directory') as unpacked_info:
+        metadata_update_run(config, unpacked_info, selected_runs)
 
 
 @target_must_exist
@@ -399,7 +400,7 @@ def chroot_create(args):
     rpz_pack.extract_config(target / 'config.yml')
 
     # Loads config
-    config = load_config_file(target / 'config.yml', True)
+    config = load_target_config(target)
     packages = config.packages
 
     target.mkdir()
@@ -533,11 +534,11 @@ def chroot_run(args):
     """Runs the command in the chroot.
     """
     target = Path(args.target[0])
-    unpacked_info = metadata_read(target, 'chroot')
+    metadata_read(target, 'chroot')
     cmdline = args.cmdline
 
     # Loads config
-    config = load_config_file(target / 'config.yml', True)
+    config = load_target_config(target)
     runs = config.runs
 
     selected_runs = get_runs(runs, args.run, cmdline)
@@ -588,8 +589,8 @@ def chroot_run(args):
     signals.post_run(target=target, retcode=retcode)
 
     # Update input file status
-    metadata_update_run(config, unpacked_info, selected_runs)
-    metadata_write(target, unpacked_info, 'chroot')
+    with metadata_update(target, 'chroot') as unpacked_info:
+        metadata_update_run(config, unpacked_info, selected_runs)
 
 
 def chroot_unmount(target):
@@ -663,10 +664,11 @@ def chroot_destroy(args):
 
 
 class LocalUploader(FileUploader):
-    def __init__(self, target, input_files, files, type_, param_restore_owner):
+    def __init__(self, target, input_files, files, type_, param_restore_owner,
+                 delta=False):
         self.type = type_
         self.param_restore_owner = param_restore_owner
-        FileUploader.__init__(self, target, input_files, files)
+        FileUploader.__init__(self, target, input_files, files, delta=delta)
 
     def prepare_upload(self, files):
         self.restore_owner = (self.type == 'chroot' and
@@ -693,6 +695,30 @@ class LocalUploader(FileUploader):
             if self.restore_owner:
                 remote_path.chown(orig_stat.st_uid, orig_stat.st_gid)
 
+    def get_block_hashes(self, input_path, block_size):
+        remote_path = join_root(self.root, input_path)
+        if not (remote_path.is_file() and
+                os.access(remote_path.path, os.W_OK)):
+            return None
+        hashes = []
+        with remote_path.open('rb') as fp:
+            block = fp.read(block_size)
+            while block:
+                hashes.append(hashlib.md5(block).hexdigest())
+                block = fp.read(block_size)
+        return remote_path.size(), hashes
+
+    def write_blocks(self, local_path, input_path, runs, truncate):
+        remote_path = join_root(self.root, input_path)
+        with local_path.open('rb') as src:
+            with remote_path.open('r+b') as dst:
+                for first_block, count in runs:
+                    dst.seek(first_block * self.delta_block_size)
+                    for chunk in self.read_blocks(src, first_block, count):
+                        dst.write(chunk)
+                if truncate:
+                    dst.truncate()
+
 
 @target_must_exist
 def upload(args):
@@ -705,12 +731,15 @@ def upload(args):
 
     try:
         LocalUploader(target, input_files, files,
-                      args.type, args.type == 'chroot' and args.restore_owner)
+                      args.type, args.type == 'chroot' and args.restore_owner,
+                      delta=args.delta)
     finally:
         metadata_write(target, unpacked_info, args.type)
 
 
 class LocalDownloader(FileDownloader):
+    max_workers = 4
+
     def __init__(self, target, files, type_, all_=False):
         self.type = type_
         FileDownloader.__init__(self, target, files, all_=all_)
@@ -843,6 +872,9 @@ def setup_directory(parser, **kwargs):
     add_opt_general(parser_upload)
     parser_upload.add_argument('file', nargs=argparse.ZERO_OR_MORE,
                                help="<path>:<input_file_name>")
+    parser_upload.add_argument('--delta', action='store_true', default=False,
+                               help="Only write the parts of the files that "
+                                    "changed")
     parser_upload.set_defaults(func=upload, type='directory')
 
     # run
@@ -959,6 +991,9 @@ def setup_chroot(parser, **kwargs):
     add_opt_owner(parser_upload)
     parser_upload.add_argument('file', nargs=argparse.ZERO_OR_MORE,
                                help="<path>:<input_file_name>")
+    parser_upload.add_argument('--delta', action='store_true', default=False,
+                               help="Only write the parts of the files that "
+                                    "changed")
     parser_upload.set_defaults(func=upload, type='chroot')
 
     # run
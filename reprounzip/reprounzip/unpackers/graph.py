@@ -17,10 +17,13 @@ See http://www.graphviz.org/
 from __future__ import division, print_function, unicode_literals
 
 import argparse
+import array
 from distutils.version import LooseVersion
 import heapq
 import json
 import logging
+import os
+import pickle
 import re
 from rpaths import PosixPath, Path
 import sqlite3
@@ -28,10 +31,10 @@ import sys
 
 from reprounzip.common import FILE_READ, FILE_WRITE, FILE_WDIR, RPZPack, \
     load_config
-from reprounzip.orderedset import OrderedSet
-from reprounzip.unpackers.common import COMPAT_OK, COMPAT_NO
-from reprounzip.utils import PY3, izip, iteritems, itervalues, stderr, \
-    unicode_, escape, normalize_path
+from reprounzip.unpackers.common import COMPAT_OK, COMPAT_NO, \
+    cached_trace, file_trace_key, prune_trace_cache, trace_cache_path
+from reprounzip.utils import PY3, irange, izip, iteritems, itervalues, \
+    stderr, unicode_, escape, normalize_path, replace_file
 
 
 logger = logging.getLogger('reprounzip.graph')
@@ -64,6 +67,8 @@ LVL_OTHER_NO = 3        # Don't show other files
 class Run(object):
     """Structure representing a whole run.
     """
+    __slots__ = ('nb', 'name', 'processes')
+
     def __init__(self, nb):
         self.nb = nb
         self.name = "run %d" % nb
@@ -88,7 +93,7 @@ class Run(object):
     def json(self, prog_map, level_processes):
         assert self.processes
         if level_processes == LVL_PROC_RUN:
-            json_process = self.processes[0].json()
+            json_process = self.processes[0].json({})
             for process in self.processes:
                 prog_map[process] = json_process
             processes = [json_process]
@@ -112,6 +117,9 @@ class Run(object):
 class Process(object):
     """Structure representing a process in the experiment.
     """
+    __slots__ = ('id', 'pid', 'run', 'parent', 'timestamp', 'thread', 'acted',
+                 'binary', 'argv', 'created')
+
     _id_gen = 0
 
     def __init__(self, pid, run, parent, timestamp, thread, acted, binary,
@@ -189,6 +197,8 @@ class Process(object):
 class Package(object):
     """Structure representing a system package.
     """
+    __slots__ = ('id', 'name', 'version', 'files')
+
     def __init__(self, name, version=None):
         self.id = None
         self.name = name
@@ -242,6 +252,84 @@ class Package(object):
                 'files': files}
 
 
+class EdgeStore(object):
+    """Ordered set of edges ``(program, file, mode, argv)``.
+
+    This replaces an `OrderedSet` of tuples, which takes a lot of memory for
+    large traces. Programs and files are interned to integer ids, and edges
+    are stored as columns of integers in arrays. The argv is only set on exec
+    edges (where mode is None), so those are kept in a separate dict.
+    """
+    __slots__ = ('programs', 'program_ids', 'files', 'file_ids',
+                 'program_col', 'file_col', 'mode_col', 'argvs', 'keys')
+
+    def __init__(self, iterable=None):
+        self.programs = []
+        self.program_ids = {}
+        self.files = []
+        self.file_ids = {}
+        self.program_col = array.array('i')
+        self.file_col = array.array('i')
+        self.mode_col = array.array('h')
+        self.argvs = {}
+        self.keys = set()
+        if iterable is not None:
+            for edge in iterable:
+                self.add(edge)
+
+    @staticmethod
+    def _key(prog_id, file_id, mode, argv):
+        if mode is None:
+            return prog_id, file_id, argv
+        else:
+            # Packs the key of open edges in a single integer
+            assert 0 <= mode < 0x8000
+            return (((file_id << 32) | prog_id) << 16) | mode
+
+    def add(self, edge):
+        if self.keys is None:
+            # Loaded with load_events(), the keys were not saved
+            self.keys = set(self._key(prog_id, file_id, mode, argv)
+                            for prog_id, file_id, mode, argv in izip(
+                                self.program_col, self.file_col,
+                                (None if m == -1 else m
+                                 for m in self.mode_col),
+                                (self.argvs.get(i)
+                                 for i in irange(len(self.mode_col)))))
+        prog, fi, mode, argv = edge
+        prog_id = self.program_ids.get(prog)
+        if prog_id is None:
+            prog_id = self.program_ids[prog] = len(self.programs)
+            self.programs.append(prog)
+        file_id = self.file_ids.get(fi)
+        if file_id is None:
+            file_id = self.file_ids[fi] = len(self.files)
+            self.files.append(fi)
+        key = self._key(prog_id, file_id, mode, argv)
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        if mode is None:
+            self.argvs[len(self.mode_col)] = argv
+            mode = -1
+        self.program_col.append(prog_id)
+        self.file_col.append(file_id)
+        self.mode_col.append(mode)
+
+    def __len__(self):
+        return len(self.mode_col)
+
+    def __iter__(self):
+        programs, files = self.programs, self.files
+        for i, (prog_id, file_id, mode) in enumerate(izip(self.program_col,
+                                                          self.file_col,
+                                                          self.mode_col)):
+            if mode == -1:
+                yield programs[prog_id], files[file_id], None, self.argvs[i]
+            else:
+                yield programs[prog_id], files[file_id], mode, None
+
+
 def parse_levels(level_pkgs, level_processes, level_other_files):
     try:
         level_pkgs = {'file': LVL_PKG_FILE,
@@ -285,7 +373,88 @@ def parse_levels(level_pkgs, level_processes, level_other_files):
     return level_pkgs, level_processes, level_other_files, file_depth
 
 
-def read_events(database, all_forks, has_thread_flag):
+def connect_database(database):
+    if PY3:
+        # On PY3, connect() only accepts unicode
+        conn = sqlite3.connect(str(database))
+    else:
+        conn = sqlite3.connect(database.path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class SQLFileFilter(object):
+    """Filters file accesses in the database according to the levels of detail.
+
+    This drops accesses to files that would be hidden from the graph anyway
+    before they get loaded: package files if packages are dropped, and every
+    file if neither packages nor other files are shown. The list of package
+    files is loaded into a temporary table, against which the names are
+    matched.
+
+    This can't be used if paths get rewritten (--regex-replace, --aggregate),
+    since files could then be mapped to a package. Filtering happens on the
+    names before `normalize_path()`, so only conditions that can't drop a
+    file which would be kept are used: a name that is not in the list can
+    still normalize to a package file, so it is kept, and the exact filtering
+    still happens afterwards. Keeping only the input/output files can't be
+    done here for the same reason.
+    """
+    __slots__ = ('package_files', 'level_pkgs', 'level_other_files')
+
+    def __init__(self, package_files, level_pkgs, level_other_files):
+        self.package_files = package_files
+        self.level_pkgs = level_pkgs
+        self.level_other_files = level_other_files
+
+    def condition(self):
+        """Gets the SQL condition to use, on a ``name`` column.
+
+        Returns None if nothing can be filtered.
+        """
+        if (self.level_other_files == LVL_OTHER_NO and
+                self.level_pkgs in (LVL_PKG_IGNORE, LVL_PKG_DROP)):
+            return '0'
+        elif self.level_pkgs == LVL_PKG_DROP:
+            return 'name NOT IN (SELECT path FROM temp.graph_package_files)'
+        else:
+            return None
+
+    def setup(self, conn):
+        """Creates the temporary tables, returns the SQL condition to use.
+        """
+        condition = self.condition()
+        if condition is None or condition == '0':
+            # No need for the list of package files
+            return condition
+        conn.execute(
+            '''
+            CREATE TEMP TABLE graph_package_files(
+                path TEXT NOT NULL PRIMARY KEY
+                );
+            ''')
+        conn.executemany(
+            '''
+            INSERT OR IGNORE INTO graph_package_files(path)
+            VALUES(?);
+            ''',
+            ((unicode_(path),) for path in self.package_files))
+        return condition
+
+
+def file_condition(conn, sql_filter):
+    """Gets the SQL condition selecting the opened_files rows to read.
+    """
+    condition = 'mode & %d = 0 AND NOT is_directory' % FILE_WDIR
+    if sql_filter is not None:
+        extra = sql_filter.setup(conn)
+        if extra is not None:
+            condition = '%s AND %s' % (condition, extra)
+    return condition
+
+
+def read_events(database, all_forks, has_thread_flag, opened_files=True,
+                sql_filter=None):
     # In here, a file is any file on the filesystem. A binary is a file, that
     # gets executed. A process is a system-level task, identified by its pid
     # (pids don't get reused in the database).
@@ -296,13 +465,11 @@ def read_events(database, all_forks, has_thread_flag):
     # doesn't do anything (new process but still old binary). If that program
     # doesn't do anything worth showing on the graph, it will be erased, unless
     # all_forks is True (--all-forks).
+    # If opened_files is False, file accesses are not read, only the processes
+    # and their executions. Accesses to directories are never read, and
+    # sql_filter can drop more of them (see SQLFileFilter).
 
-    if PY3:
-        # On PY3, connect() only accepts unicode
-        conn = sqlite3.connect(str(database))
-    else:
-        conn = sqlite3.connect(database.path)
-    conn.row_factory = sqlite3.Row
+    conn = connect_database(database)
 
     # This is a bit weird. We need to iterate on all types of events at the
     # same time, ordering by timestamp, so we decorate-sort-undecorate
@@ -329,15 +496,19 @@ def read_events(database, all_forks, has_thread_flag):
 
     # ... and opened files...
     file_cursor = conn.cursor()
-    file_rows = file_cursor.execute(
-        '''
-        SELECT name, timestamp, mode, process, is_directory
-        FROM opened_files
-        ORDER BY id
-        ''')
+    if opened_files:
+        file_rows = file_cursor.execute(
+            '''
+            SELECT name, timestamp, mode, process
+            FROM opened_files
+            WHERE %s
+            ORDER BY id
+            ''' % file_condition(conn, sql_filter))
+    else:
+        file_rows = []
     binaries = set()
     files = set()
-    edges = OrderedSet()
+    edges = EdgeStore()
 
     # ... as well as executed files.
     exec_cursor = conn.cursor()
@@ -385,13 +556,12 @@ def read_events(database, all_forks, has_thread_flag):
             run.processes.append(process)
 
         elif event_type == 'open':
-            r_name, r_timestamp, r_mode, r_process, r_directory = data
+            r_name, r_timestamp, r_mode, r_process = data
             r_name = normalize_path(r_name)
             logger.debug("File open: %s, process %d", r_name, r_process)
-            if not (r_mode & FILE_WDIR or r_directory):
-                process = processes[r_process]
-                files.add(r_name)
-                edges.add((process, r_name, r_mode, None))
+            process = processes[r_process]
+            files.add(r_name)
+            edges.add((process, r_name, r_mode, None))
 
         elif event_type == 'exec':
             r_name, r_timestamp, r_process, r_argv = data
@@ -433,6 +603,149 @@ def read_events(database, all_forks, has_thread_flag):
     return runs, files, edges
 
 
+EVENTS_CACHE_VERSION = 1
+
+
+def _array_bytes(arr):
+    if PY3:
+        return arr.tobytes()
+    else:
+        return arr.tostring()
+
+
+def _array_from_bytes(typecode, data):
+    arr = array.array(typecode)
+    if PY3:
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    return arr
+
+
+def dump_events(fp, runs, edges):
+    """Saves what `read_events()` returned to a file.
+
+    Processes are flattened into tuples, and the edges are stored as the
+    columns of the `EdgeStore`.
+    """
+    processes = sorted((p for run in runs for p in run.processes),
+                       key=lambda p: p.id)
+    process_idx = dict((p, i) for i, p in enumerate(processes))
+    run_idx = dict((run, i) for i, run in enumerate(runs))
+    data = {
+        'version': EVENTS_CACHE_VERSION,
+        'runs': [(run.nb, run.name) for run in runs],
+        'processes': [(p.pid, run_idx[p.run],
+                       process_idx[p.parent] if p.parent is not None else -1,
+                       p.timestamp, p.thread, p.acted,
+                       p.binary.path if p.binary is not None else None,
+                       p.argv, p.created)
+                      for p in processes],
+        'edge_programs': [process_idx[p] for p in edges.programs],
+        'edge_files': [f.path for f in edges.files],
+        'program_col': _array_bytes(edges.program_col),
+        'file_col': _array_bytes(edges.file_col),
+        'mode_col': _array_bytes(edges.mode_col),
+        'argvs': edges.argvs,
+    }
+    pickle.dump(data, fp, 2)
+
+
+def load_events(fp):
+    """Loads events saved by `dump_events()`.
+
+    Returns ``(runs, files, edges)`` like `read_events()`, or raises
+    ValueError if the file is from a different version.
+    """
+    data = pickle.load(fp)
+    if data.get('version') != EVENTS_CACHE_VERSION:
+        raise ValueError("Unknown cached events version")
+    runs = []
+    for nb, name in data['runs']:
+        run = Run(nb)
+        run.name = name
+        runs.append(run)
+    processes = []
+    for (pid, run, parent, timestamp, thread, acted, binary, argv,
+            created) in data['processes']:
+        process = Process(pid, runs[run],
+                          processes[parent] if parent != -1 else None,
+                          timestamp, thread, acted,
+                          PosixPath(binary) if binary is not None else None,
+                          argv, created)
+        processes.append(process)
+        runs[run].processes.append(process)
+
+    edges = EdgeStore()
+    edges.programs = [processes[i] for i in data['edge_programs']]
+    edges.program_ids = dict((p, i) for i, p in enumerate(edges.programs))
+    edges.files = [PosixPath(f) for f in data['edge_files']]
+    edges.file_ids = dict((f, i) for i, f in enumerate(edges.files))
+    edges.program_col = _array_from_bytes('i', data['program_col'])
+    edges.file_col = _array_from_bytes('i', data['file_col'])
+    edges.mode_col = _array_from_bytes('h', data['mode_col'])
+    edges.argvs = data['argvs']
+    edges.keys = None
+    return runs, set(edges.files), edges
+
+
+def read_events_cached(database, all_forks, has_thread_flag, cache_key,
+                       sql_filter=None):
+    """Like `read_events()`, but uses the trace cache if possible.
+
+    The events are cached unfiltered, and `sql_filter` is only used if they
+    are not in the cache yet. In that case, they are only written to the
+    cache if the filter doesn't drop anything.
+    """
+    name = 'graph-events-v%d-py%d-%s-%s.pickle' % (
+        EVENTS_CACHE_VERSION, 3 if PY3 else 2,
+        'allforks' if all_forks else 'forks',
+        'threads' if has_thread_flag else 'nothreads')
+    try:
+        cache = trace_cache_path(cache_key, name)
+    except OSError as e:
+        logger.warning("Couldn't use the trace cache: %s", e)
+        cache = None
+    if cache is not None and cache.exists():
+        try:
+            with cache.open('rb') as fp:
+                events = load_events(fp)
+        except Exception as e:
+            logger.warning("Couldn't load cached events: %s", e)
+        else:
+            logger.info("Loaded events from cache")
+            try:
+                # Marks the entry as recently used
+                os.utime(cache.parent.path, None)
+            except OSError:
+                pass
+            return events
+
+    if cache is None or (sql_filter is not None and
+                         sql_filter.condition() is not None):
+        return read_events(database, all_forks, has_thread_flag,
+                           sql_filter=sql_filter)
+
+    runs, files, edges = read_events(database, all_forks, has_thread_flag)
+    fd, tmp = Path.tempfile(prefix='.graph_', dir=cache.parent)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            dump_events(fp, runs, edges)
+        replace_file(tmp, cache)
+    except (IOError, OSError) as e:
+        logger.warning("Couldn't cache events: %s", e)
+        tmp.remove()
+    else:
+        # Entries for traces on disk don't go through cached_trace(), so
+        # they are counted against the limit here
+        try:
+            os.utime(cache.parent.path, None)
+        except OSError:
+            pass
+        prune_trace_cache(keep=cache.parent)
+    return runs, files, edges
+
+
 def format_argv(argv):
     joined = ' '.join(argv)
     if len(joined) < 50:
@@ -445,8 +758,16 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
              level_pkgs='file', level_processes='thread',
              level_other_files='all',
              regex_filters=None, regex_includes=None,
-             regex_replaces=None, aggregates=None):
+             regex_replaces=None, aggregates=None, streaming=False,
+             cache_key=None):
     """Main function for the graph subcommand.
+
+    If `streaming` is True, file accesses are aggregated by SQLite and the
+    graph is written incrementally, so that memory usage doesn't depend on
+    the size of the trace (see `generate_streaming()`).
+
+    If `cache_key` is given, the events read from the trace are cached with
+    the trace (see `read_events_cached()`), unless streaming.
     """
     try:
         graph_format = {'dot': FORMAT_DOT, 'DOT': FORMAT_DOT,
@@ -475,8 +796,23 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
                               for n, f in iteritems(config.inputs_outputs))
     has_thread_flag = config.format_version >= LooseVersion('0.7')
 
-    runs, files, edges = read_events(database, all_forks,
-                                     has_thread_flag)
+    # Filters what we can in the database, unless paths get rewritten
+    if regex_replaces or aggregates:
+        sql_filter = None
+    else:
+        sql_filter = SQLFileFilter(
+            [f.path for pkg in config.packages for f in pkg.files],
+            level_pkgs, level_other_files)
+
+    if cache_key is not None and not streaming:
+        runs, files, edges = read_events_cached(database, all_forks,
+                                                has_thread_flag, cache_key,
+                                                sql_filter=sql_filter)
+    else:
+        runs, files, edges = read_events(database, all_forks,
+                                         has_thread_flag,
+                                         opened_files=not streaming,
+                                         sql_filter=sql_filter)
 
     # Label the runs
     if len(runs) != len(config.runs):
@@ -516,6 +852,14 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
                 break
         return PosixPath(pathuni)
 
+    if streaming:
+        generate_streaming(target, graph_format, database, runs, edges,
+                           filefilter, sql_filter, config.packages,
+                           inputs_outputs, inputs_outputs_map,
+                           level_pkgs, level_processes, level_other_files,
+                           file_depth)
+        return
+
     files_new = set()
     for fi in files:
         fi = filefilter(fi)
@@ -523,7 +867,7 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
             files_new.add(fi)
     files = files_new
 
-    edges_new = OrderedSet()
+    edges_new = EdgeStore()
     for prog, fi, mode, argv in edges:
         fi = filefilter(fi)
         if fi is not None:
@@ -560,12 +904,12 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
     if level_other_files == LVL_OTHER_ALL and file_depth is not None:
         other_files = set(PosixPath(*f.components[:file_depth + 1])
                           for f in other_files)
-        edges = OrderedSet((prog,
-                            f if f in package_map
-                            else PosixPath(*f.components[:file_depth + 1]),
-                            mode,
-                            argv)
-                           for prog, f, mode, argv in edges)
+        edges = EdgeStore((prog,
+                           f if f in package_map
+                           else PosixPath(*f.components[:file_depth + 1]),
+                           mode,
+                           argv)
+                          for prog, f, mode, argv in edges)
     else:
         if level_other_files == LVL_OTHER_IO:
             other_files = set(f
@@ -579,7 +923,7 @@ def generate(target, configfile, database, all_forks=False, graph_format='dot',
                      for prog, f, mode, argv in edges
                      if f in package_map]
 
-    args = (target, runs, packages, other_files, package_map, edges,
+    args = (target, runs, packages, sorted(other_files), package_map, edges,
             inputs_outputs, inputs_outputs_map,
             level_pkgs, level_processes, level_other_files)
     if graph_format == FORMAT_DOT:
@@ -594,6 +938,8 @@ def graph_dot(target, runs, packages, other_files, package_map, edges,
               inputs_outputs, inputs_outputs_map,
               level_pkgs, level_processes, level_other_files):
     """Writes a GraphViz DOT file from the collected information.
+
+    `other_files` should be sorted; it and `edges` are only iterated on once.
     """
     with target.open('w', encoding='utf-8', newline='\n') as fp:
         fp.write('digraph G {\n    rankdir=LR;\n\n    /* programs */\n'
@@ -620,7 +966,7 @@ def graph_dot(target, runs, packages, other_files, package_map, edges,
 
         # Other files
         logger.info("Writing other files...")
-        for fi in sorted(other_files):
+        for fi in other_files:
             if fi in inputs_outputs_map:
                 fp.write('    "%(path)s" [fillcolor="#A3B4E0", '
                          'label="%(name)s\\n%(path)s"];\n' %
@@ -663,25 +1009,11 @@ def graph_dot(target, runs, packages, other_files, package_map, edges,
         fp.write('}\n')
 
 
-def graph_json(target, runs, packages, other_files, package_map, edges,
-               inputs_outputs, inputs_outputs_map,
-               level_pkgs, level_processes, level_other_files):
-    """Writes a JSON file suitable for further processing.
-    """
-    # Packages
-    if level_pkgs in (LVL_PKG_IGNORE, LVL_PKG_DROP):
-        json_packages = []
-    else:
-        json_packages = [pkg.json(level_pkgs) for pkg in packages]
-
-    # Other files
-    json_other_files = [unicode_(fi) for fi in sorted(other_files)]
-
-    # Programs
-    prog_map = {}
-    json_runs = [run.json(prog_map, level_processes) for run in runs]
+def json_edges(edges, prog_map, package_map, level_pkgs):
+    """Gets the edges to write in the JSON file.
 
-    # Connect edges
+    Yields tuples ``(json_process, endpoint, is_write)``.
+    """
     done_edges = set()
     for prog, fi, mode, argv in edges:
         endp_prog = prog_map[prog]
@@ -697,11 +1029,38 @@ def graph_json(target, runs, packages, other_files, package_map, edges,
         else:
             endp_file = unicode_(fi)
         if mode is None:
-            endp_prog['reads'].append(endp_file)
+            yield endp_prog, endp_file, False
             # TODO: argv?
         elif mode & FILE_WRITE:
-            endp_prog['writes'].append(endp_file)
+            yield endp_prog, endp_file, True
         elif mode & FILE_READ:
+            yield endp_prog, endp_file, False
+
+
+def graph_json(target, runs, packages, other_files, package_map, edges,
+               inputs_outputs, inputs_outputs_map,
+               level_pkgs, level_processes, level_other_files):
+    """Writes a JSON file suitable for further processing.
+    """
+    # Packages
+    if level_pkgs in (LVL_PKG_IGNORE, LVL_PKG_DROP):
+        json_packages = []
+    else:
+        json_packages = [pkg.json(level_pkgs) for pkg in packages]
+
+    # Other files
+    json_other_files = [unicode_(fi) for fi in other_files]
+
+    # Programs
+    prog_map = {}
+    json_runs = [run.json(prog_map, level_processes) for run in runs]
+
+    # Connect edges
+    for endp_prog, endp_file, write in json_edges(edges, prog_map,
+                                                  package_map, level_pkgs):
+        if write:
+            endp_prog['writes'].append(endp_file)
+        else:
             endp_prog['reads'].append(endp_file)
 
     json_other_files.sort()
@@ -728,27 +1087,326 @@ def graph_json(target, runs, packages, other_files, package_map, edges,
         fp.close()
 
 
+def read_edges(conn, runs, exec_edges, sql_filter=None):
+    """Reads the file accesses, aggregated by the database.
+
+    This yields the same edges as `read_events()`, in the same order, but the
+    accesses are grouped by program, file and mode by SQLite instead of being
+    loaded in memory. `exec_edges` are the edges returned by `read_events()`
+    when called with ``opened_files=False``; `sql_filter` is an optional
+    `SQLFileFilter`.
+    """
+    # Records when each program started, so that SQLite can find the program
+    # that made each access
+    programs = dict((p.id, p) for run in runs for p in run.processes)
+    conn.execute(
+        '''
+        CREATE TEMP TABLE graph_programs(
+            process INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            program INTEGER NOT NULL
+            );
+        ''')
+    conn.executemany(
+        '''
+        INSERT INTO graph_programs(process, start, program)
+        VALUES(?, ?, ?);
+        ''',
+        ((p.pid, p.timestamp, p.id) for p in itervalues(programs)))
+    conn.execute(
+        '''
+        CREATE INDEX temp.graph_programs_idx
+        ON graph_programs(process, start);
+        ''')
+
+    # Exec edges come in the same order as the executed_files rows
+    exec_times = [r[0] for r in conn.execute(
+        '''
+        SELECT timestamp
+        FROM executed_files
+        ORDER BY id
+        ''')]
+    assert len(exec_times) == len(exec_edges)
+
+    file_cursor = conn.cursor()
+    file_rows = file_cursor.execute(
+        '''
+        SELECT (SELECT p.program
+                FROM graph_programs p
+                WHERE p.process = o.process AND p.start <= o.timestamp
+                ORDER BY p.start DESC
+                LIMIT 1) AS program,
+               o.name, o.mode, min(o.timestamp) AS first
+        FROM opened_files o
+        WHERE %s
+        GROUP BY program, o.name, o.mode
+        ORDER BY first
+        ''' % file_condition(conn, sql_filter))
+
+    # Merges them like read_events() does, executions first
+    rows = heapq.merge(((ts, 0, i, edge)
+                        for i, (ts, edge) in enumerate(izip(exec_times,
+                                                            exec_edges))),
+                       ((r[3], 1, i, r) for i, r in enumerate(file_rows)))
+    for ts, event_type, i, data in rows:
+        if event_type == 0:
+            yield data
+        else:
+            r_program, r_name, r_mode, r_first = data
+            yield (programs[r_program], normalize_path(r_name), r_mode, None)
+    file_cursor.close()
+
+
+def generate_streaming(target, graph_format, database, runs, exec_edges,
+                       filefilter, sql_filter, config_packages,
+                       inputs_outputs, inputs_outputs_map,
+                       level_pkgs, level_processes, level_other_files,
+                       file_depth):
+    """Writes the graph without loading the whole trace in memory.
+
+    The aggregated edges and the files to show are stored in temporary tables
+    instead of Python sets, so memory usage only depends on the number of
+    programs and packages.
+    """
+    conn = connect_database(database)
+    try:
+        conn.execute(
+            '''
+            CREATE TEMP TABLE graph_files(
+                path BLOB NOT NULL PRIMARY KEY
+                );
+            ''')
+        conn.execute(
+            '''
+            CREATE TEMP TABLE graph_edges(
+                id INTEGER NOT NULL PRIMARY KEY,
+                program INTEGER NOT NULL,
+                path BLOB NOT NULL,
+                mode INTEGER NOT NULL,
+                argv TEXT NOT NULL,
+                UNIQUE(program, path, mode, argv)
+                );
+            ''')
+
+        # Filters files and puts them in packages
+        logger.info("Aggregating file accesses...")
+        file2package = dict((f.path, pkg)
+                            for pkg in config_packages for f in pkg.files)
+        packages = {}
+        package_map = {}
+        for prog, fi, mode, argv in read_edges(conn, runs, exec_edges,
+                                               sql_filter):
+            fi = filefilter(fi)
+            if fi is None:
+                continue
+            if level_pkgs != LVL_PKG_IGNORE and fi not in package_map:
+                pkg = file2package.get(fi)
+                if pkg is not None:
+                    package = packages.get(pkg.name)
+                    if package is None:
+                        package = Package(pkg.name, pkg.version)
+                        packages[pkg.name] = package
+                    package.files.add(fi)
+                    package_map[fi] = package
+            if fi not in package_map:
+                if level_other_files == LVL_OTHER_IO:
+                    if fi not in inputs_outputs_map:
+                        continue
+                elif level_other_files == LVL_OTHER_NO:
+                    continue
+                elif file_depth is not None:
+                    fi = PosixPath(*fi.components[:file_depth + 1])
+                conn.execute(
+                    '''
+                    INSERT OR IGNORE INTO graph_files(path)
+                    VALUES(?);
+                    ''',
+                    (sqlite3.Binary(fi.path),))
+            conn.execute(
+                '''
+                INSERT OR IGNORE INTO graph_edges(program, path, mode, argv)
+                VALUES(?, ?, ?, ?);
+                ''',
+                (prog.id, sqlite3.Binary(fi.path),
+                 -1 if mode is None else mode,
+                 '\0'.join(argv) if mode is None else ''))
+        packages = sorted(itervalues(packages), key=lambda pkg: pkg.name)
+        for i, pkg in enumerate(packages):
+            pkg.id = i
+
+        programs = dict((p.id, p) for run in runs for p in run.processes)
+
+        def other_files():
+            for r_path, in conn.execute(
+                    '''
+                    SELECT path
+                    FROM graph_files
+                    ORDER BY path
+                    '''):
+                yield PosixPath(bytes(r_path))
+
+        def edges():
+            for r_program, r_path, r_mode, r_argv in conn.execute(
+                    '''
+                    SELECT program, path, mode, argv
+                    FROM graph_edges
+                    ORDER BY id
+                    '''):
+                if r_mode == -1:
+                    yield (programs[r_program], PosixPath(bytes(r_path)),
+                           None, tuple(r_argv.split('\0')))
+                else:
+                    yield (programs[r_program], PosixPath(bytes(r_path)),
+                           r_mode, None)
+
+        args = (target, runs, packages, other_files(), package_map, edges(),
+                inputs_outputs, inputs_outputs_map,
+                level_pkgs, level_processes, level_other_files)
+        if graph_format == FORMAT_DOT:
+            graph_dot(*args)
+        elif graph_format == FORMAT_JSON:
+            graph_json_streaming(conn, *args)
+        else:
+            assert False
+    finally:
+        conn.close()
+
+
+def write_json(fp, obj, level=0):
+    """Writes JSON like ``json.dump(obj, fp, indent=2, sort_keys=True)``.
+
+    Lists can be replaced with iterators, which are consumed as the file is
+    written.
+    """
+    if isinstance(obj, dict):
+        items = sorted(iteritems(obj))
+        opening, closing = '{', '}'
+    elif isinstance(obj, (list, tuple)) or hasattr(obj, '__next__') or \
+            hasattr(obj, 'next'):
+        items = obj
+        opening, closing = '[', ']'
+    else:
+        fp.write(unicode_(json.dumps(obj, ensure_ascii=False)))
+        return
+    indent = '\n' + '  ' * (level + 1)
+    empty = True
+    for item in items:
+        fp.write((opening if empty else ',') + indent)
+        empty = False
+        if opening == '{':
+            key, item = item
+            fp.write(unicode_(json.dumps(key, ensure_ascii=False)) + ': ')
+        write_json(fp, item, level + 1)
+    if empty:
+        fp.write(opening + closing)
+    else:
+        fp.write('\n' + '  ' * level + closing)
+
+
+def graph_json_streaming(conn, target, runs, packages, other_files,
+                         package_map, edges,
+                         inputs_outputs, inputs_outputs_map,
+                         level_pkgs, level_processes, level_other_files):
+    """Writes the same JSON file as `graph_json()`, incrementally.
+
+    The edges are sorted by program in a temporary table, from which each
+    program's lists of reads and writes are written.
+    """
+    # Packages
+    if level_pkgs in (LVL_PKG_IGNORE, LVL_PKG_DROP):
+        json_packages = []
+    else:
+        json_packages = [pkg.json(level_pkgs) for pkg in packages]
+
+    # Programs
+    prog_map = {}
+    json_runs = [run.json(prog_map, level_processes) for run in runs]
+
+    # Connect edges
+    conn.execute(
+        '''
+        CREATE TEMP TABLE graph_json_edges(
+            id INTEGER NOT NULL PRIMARY KEY,
+            program INTEGER NOT NULL,
+            is_write BOOLEAN NOT NULL,
+            endpoint TEXT NOT NULL
+            );
+        ''')
+    program_ids = {}
+    for endp_prog, endp_file, write in json_edges(edges, prog_map,
+                                                  package_map, level_pkgs):
+        program_id = program_ids.setdefault(id(endp_prog), len(program_ids))
+        conn.execute(
+            '''
+            INSERT INTO graph_json_edges(program, is_write, endpoint)
+            VALUES(?, ?, ?);
+            ''',
+            (program_id, write, endp_file))
+    conn.execute(
+        '''
+        CREATE INDEX temp.graph_json_edges_idx
+        ON graph_json_edges(program, is_write);
+        ''')
+
+    def endpoints(program_id, write):
+        for r_endpoint, in conn.execute(
+                '''
+                SELECT endpoint
+                FROM graph_json_edges
+                WHERE program = ? AND is_write = ?
+                ORDER BY id
+                ''',
+                (program_id, write)):
+            yield r_endpoint
+
+    for json_run in json_runs:
+        for json_process in json_run['processes']:
+            program_id = program_ids.get(id(json_process))
+            if program_id is not None:
+                json_process['reads'] = endpoints(program_id, False)
+                json_process['writes'] = endpoints(program_id, True)
+
+    with target.open('w', encoding='utf-8', newline='\n') as fp:
+        write_json(fp, {'packages': sorted(json_packages,
+                                           key=lambda p: p['name']),
+                        'other_files': (unicode_(fi) for fi in other_files),
+                        'runs': json_runs,
+                        'inputs_outputs': [
+                            {'name': k, 'path': unicode_(v.path),
+                             'read_by_runs': v.read_runs,
+                             'written_by_runs': v.write_runs}
+                            for k, v in sorted(iteritems(inputs_outputs))]})
+
+
 def graph(args):
     """graph subcommand.
 
     Reads in the trace sqlite3 database and writes out a graph in GraphViz DOT
     format or JSON.
     """
-    def call_generate(args, config, trace):
+    def call_generate(args, config, trace, cache_key):
         generate(Path(args.target[0]), config, trace, args.all_forks,
                  args.format, args.packages, args.processes, args.otherfiles,
                  args.regex_filter, args.regex_include,
-                 args.regex_replace, args.aggregate)
+                 args.regex_replace, args.aggregate, args.stream,
+                 cache_key)
 
     if args.pack is not None:
         rpz_pack = RPZPack(args.pack)
         with rpz_pack.with_config() as config:
-            with rpz_pack.with_trace() as trace:
-                call_generate(args, config, trace)
+            if args.cache:
+                with cached_trace(rpz_pack) as (trace, cache_key):
+                    call_generate(args, config, trace, cache_key)
+            else:
+                with rpz_pack.with_trace() as trace:
+                    call_generate(args, config, trace, None)
     else:
-        call_generate(args,
-                      Path(args.dir) / 'config.yml',
-                      Path(args.dir) / 'trace.sqlite3')
+        trace = Path(args.dir) / 'trace.sqlite3'
+        if args.cache and not args.stream and trace.is_file():
+            cache_key = file_trace_key(trace)
+        else:
+            cache_key = None
+        call_generate(args, Path(args.dir) / 'config.yml', trace, cache_key)
 
 
 def disabled_bug13676(args):
@@ -793,6 +1451,14 @@ def setup(parser, **kwargs):
                              "after --regex-include)")
     parser.add_argument('--regex-replace', action='append', nargs=2,
                         help="Apply regular expression replacement to files")
+    parser.add_argument('--stream', action='store_true',
+                        help="Aggregate file accesses in the database and "
+                        "write the graph incrementally, for very large "
+                        "traces")
+    parser.add_argument('--no-cache', action='store_false', dest='cache',
+                        default=True,
+                        help="Don't cache the trace and the events read from "
+                        "it")
     parser.add_argument('--dot', action='store_const', dest='format',
                         const='dot', default='dot',
                         help="Set the output format to DOT (this is the "
@@ -19,16 +19,18 @@ import codecs
 import contextlib
 from datetime import datetime
 import email.utils
+import hashlib
 import itertools
+import json
 import locale
 import logging
 import operator
 import os
-import requests
 from rpaths import Path, PosixPath
 import stat
 import subprocess
 import sys
+import threading
 import time
 
 
@@ -412,32 +414,138 @@ def copyfile(source, destination, CHUNK_SIZE=4096):
             break
 
 
-def download_file(url, dest, cachename=None, ssl_verify=None):
+def replace_file(source, destination):
+    """Renames a file, replacing the destination if it exists.
+
+    This is atomic, so readers see either the old or the new file, except on
+    Windows with Python 2 where the destination has to be removed first.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(source.path, destination.path)
+    else:
+        if sys.platform.startswith('win') and destination.exists():
+            destination.remove()
+        source.rename(destination)
+
+
+def cache_dir():
+    """Gets the directory where reprozip caches files.
+
+    This is ``~/.cache/reprozip/``, unless ``XDG_CACHE_HOME`` is set.
+    """
+    if 'XDG_CACHE_HOME' in os.environ:
+        cache = Path(os.environ['XDG_CACHE_HOME'])
+    else:
+        cache = Path('~/.cache').expand_user()
+    return cache / 'reprozip'
+
+
+#: How long a downloaded file is used without checking the server, in seconds
+DOWNLOAD_CACHE_TTL = 24 * 3600
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _read_download_info(cache):
+    """Reads the information stored along with a cached download.
+    """
+    try:
+        with (cache.parent / (cache.unicodename + '.info')).open('r') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_download_info(cache, info):
+    infofile = cache.parent / (cache.unicodename + '.info')
+    fd, tmp = Path.tempfile(prefix='.%s_' % infofile.unicodename,
+                            dir=cache.parent)
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(info, fp)
+        replace_file(tmp, infofile)
+    except Exception:
+        tmp.remove()
+        raise
+
+
+def _hash_file(filename):
+    h = hashlib.sha256()
+    with filename.open('rb') as fp:
+        chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+        while chunk:
+            h.update(chunk)
+            chunk = fp.read(DOWNLOAD_CHUNK_SIZE)
+    return h.hexdigest()
+
+
+def _link_or_copy(source, dest):
+    """Makes `dest` a hard link to `source`, or a copy if that's not possible.
+    """
+    if dest.lexists():
+        dest.remove()
+    try:
+        os.link(source.path, dest.path)
+    except (OSError, AttributeError):
+        source.copy(dest)
+
+
+def download_file(url, dest, cachename=None, ssl_verify=None, ttl=None):
     """Downloads a file using a local cache.
 
-    If the file cannot be downloaded or if it wasn't modified, the cached
-    version will be used instead.
+    The cache lives in ``~/.cache/reprozip/``. Along with the file, it stores
+    the URL, the ETag and the SHA-256 hash of the content. If the file was
+    downloaded from the same URL less than `ttl` seconds ago (defaults to
+    `DOWNLOAD_CACHE_TTL`), it is used without contacting the server;
+    otherwise the server is asked whether it changed. If the file cannot be
+    downloaded, the cached version will be used instead.
 
-    The cache lives in ``~/.cache/reprozip/``.
+    The download is written to a temporary file which is then renamed, so that
+    commands running concurrently only ever see complete files. `dest` is a
+    hard link to the cached file when possible.
     """
+    import requests
+
     if cachename is None:
         if dest is None:
             raise ValueError("One of 'dest' or 'cachename' must be specified")
         cachename = dest.components[-1]
+    if ttl is None:
+        ttl = DOWNLOAD_CACHE_TTL
 
-    headers = {}
-
-    if 'XDG_CACHE_HOME' in os.environ:
-        cache = Path(os.environ['XDG_CACHE_HOME'])
-    else:
-        cache = Path('~/.cache').expand_user()
-    cache = cache / 'reprozip' / cachename
-    if cache.exists():
-        mtime = email.utils.formatdate(cache.mtime(), usegmt=True)
-        headers['If-Modified-Since'] = mtime
+    def finish():
+        if dest is not None:
+            _link_or_copy(cache, dest)
+            return dest
+        else:
+            return cache
 
+    cache = cache_dir() / cachename
     cache.parent.mkdir(parents=True)
 
+    # The cached file is only validated for the same URL; files cached by
+    # older versions don't have the info, they are checked with their mtime
+    info = _read_download_info(cache)
+    validate = cache.exists()
+    if not validate:
+        info = None
+    elif info is not None and (info.get('url') != url or
+                               cache.size() != info.get('size') or
+                               _hash_file(cache) != info.get('sha256')):
+        # Different URL, or the file was changed through a hard link
+        validate = False
+        info = None
+    elif info is not None and 0 <= time.time() - info['time'] < ttl:
+        logger.info("Download %s: using cached file", cachename)
+        return finish()
+
+    headers = {}
+    if validate:
+        if info is not None and info.get('etag'):
+            headers['If-None-Match'] = info['etag']
+        headers['If-Modified-Since'] = email.utils.formatdate(
+            cache.mtime(), usegmt=True)
+
     try:
         response = requests.get(url, headers=headers,
                                 timeout=2 if cache.exists() else 10,
@@ -449,35 +557,73 @@ def download_file(url, dest, cachename=None, ssl_verify=None):
                 response=response)
     except requests.RequestException as e:
         if cache.exists():
-            if e.response and e.response.status_code == 304:
+            if e.response is not None and e.response.status_code == 304:
                 logger.info("Download %s: cache is up to date", cachename)
+                if info is None:
+                    info = {'url': url,
+                            'etag': e.response.headers.get('ETag'),
+                            'sha256': _hash_file(cache),
+                            'size': cache.size()}
+                info['time'] = time.time()
+                try:
+                    _write_download_info(cache, info)
+                except (IOError, OSError):
+                    pass
             else:
                 logger.warning("Download %s: error downloading %s: %s",
                                cachename, url, e)
-            if dest is not None:
-                cache.copy(dest)
-                return dest
-            else:
-                return cache
+            return finish()
         else:
             raise
 
     logger.info("Download %s: downloading %s", cachename, url)
+    fd, tmp = Path.tempfile(prefix='.%s_' % cachename, dir=cache.parent)
     try:
-        with cache.open('wb') as f:
-            for chunk in response.iter_content(4096):
+        h = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
                 f.write(chunk)
+                h.update(chunk)
+                size += len(chunk)
         response.close()
-    except Exception as e:  # pragma: no cover
+        tmp.chmod(0o644)
+        replace_file(tmp, cache)
+    except Exception:
         try:
-            cache.remove()
+            tmp.remove()
         except OSError:
             pass
-        raise e
+        raise
+    _write_download_info(cache, {'url': url,
+                                 'etag': response.headers.get('ETag'),
+                                 'sha256': h.hexdigest(),
+                                 'size': size,
+                                 'time': time.time()})
     logger.info("Downloaded %s successfully", cachename)
 
-    if dest is not None:
-        cache.copy(dest)
-        return dest
-    else:
-        return cache
+    return finish()
+
+
+def download_files(downloads, ssl_verify=None):
+    """Downloads several files at once, with `download_file()`.
+
+    :param downloads: A list of ``(url, dest, cachename)`` tuples.
+    """
+    errors = []
+
+    def download(url, dest, cachename):
+        try:
+            download_file(url, dest, cachename, ssl_verify=ssl_verify)
+        except Exception as e:
+            logger.error("Error downloading %s: %s", url, e)
+            errors.append(e)
+
+    threads = [threading.Thread(target=download, args=args)
+               for args in downloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
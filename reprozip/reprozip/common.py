@@ -24,7 +24,6 @@ import atexit
 import contextlib
 import copy
 from datetime import datetime
-from distutils.version import LooseVersion
 import functools
 import gzip
 import logging
@@ -33,9 +32,13 @@ import os
 from rpaths import PosixPath, Path
 import sys
 import tarfile
-import usagestats
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader, SafeDumper
+
 from .utils import iteritems, itervalues, unicode_, stderr, UniqueNames, \
     escape, optional_return_type, isodatetime, hsize, join_root, copyfile
 
@@ -72,14 +75,44 @@ class File(object):
 
 class Package(object):
     """A distribution package, containing a set of files.
+
+    The files can also be given as a list of paths to `set_file_paths()`, in
+    which case the `File` objects only get created when `files` is accessed.
     """
     def __init__(self, name, version, files=None, packfiles=True, size=None):
         self.name = name
         self.version = version
-        self.files = list(files) if files is not None else []
+        self._files = list(files) if files is not None else []
+        self._file_paths = None
         self.packfiles = packfiles
         self.size = size
 
+    def set_file_paths(self, paths, File=File):
+        """Sets the files from a list of paths, without creating them yet.
+        """
+        self._file_paths = paths, File
+
+    @property
+    def files(self):
+        if self._file_paths is not None:
+            paths, File = self._file_paths
+            self._files = [File(PosixPath(p)) for p in paths]
+            self._file_paths = None
+        return self._files
+
+    @files.setter
+    def files(self, files):
+        self._files = files
+        self._file_paths = None
+
+    @property
+    def nb_files(self):
+        """The number of files, without creating them.
+        """
+        if self._file_paths is not None:
+            return len(self._file_paths[0])
+        return len(self._files)
+
     def __eq__(self, other):
         return (isinstance(other, Package) and
                 self.name == other.name and
@@ -313,8 +346,11 @@ def read_packages(packages, File=File, Package=Package):
         return []
     new_pkgs = []
     for pkg in packages:
-        pkg['files'] = read_files(pkg['files'], File)
-        new_pkgs.append(Package(**pkg))
+        pkg = dict(pkg)
+        paths = pkg.pop('files') or []
+        package = Package(**pkg)
+        package.set_file_paths(paths, File)
+        new_pkgs.append(package)
     return new_pkgs
 
 
@@ -399,6 +435,15 @@ def load_iofiles(config, runs):
     return files
 
 
+def read_config_document(filename):
+    """Parses a YAML configuration file, without interpreting it.
+
+    Use `parse_config()` to get the configuration from the result.
+    """
+    with filename.open(encoding='utf-8') as fp:
+        return yaml.load(fp, Loader=SafeLoader)
+
+
 def load_config(filename, canonical, File=File, Package=Package):
     """Loads a YAML configuration file.
 
@@ -410,8 +455,17 @@ def load_config(filename, canonical, File=File, Package=Package):
     (in which case the ``additional_patterns`` section is not accepted). Note
     that this changes the number of returned values of this function.
     """
-    with filename.open(encoding='utf-8') as fp:
-        config = yaml.safe_load(fp)
+    return parse_config(read_config_document(filename), canonical,
+                        File, Package)
+
+
+def parse_config(config, canonical, File=File, Package=Package):
+    """Gets the configuration from a parsed YAML document.
+
+    See `load_config()`.
+    """
+    # Imported here, it brings in setuptools
+    from distutils.version import LooseVersion
 
     ver = LooseVersion(config['version'])
 
@@ -472,14 +526,38 @@ def load_config(filename, canonical, File=File, Package=Package):
                   **kwargs)
 
 
+#: Number of lines formatted before each write to the configuration file
+WRITE_BATCH_SIZE = 4096
+
+
+def format_file(fi, indent=0):
+    return "%s  - \"%s\"%s\n" % (
+        "    " * indent,
+        escape(unicode_(fi.path)),
+        ' # %s' % fi.comment if fi.comment is not None else '')
+
+
 def write_file(fp, fi, indent=0):
-    fp.write("%s  - \"%s\"%s\n" % (
-             "    " * indent,
-             escape(unicode_(fi.path)),
-             ' # %s' % fi.comment if fi.comment is not None else ''))
+    fp.write(format_file(fi, indent))
 
 
-def write_package(fp, pkg, indent=0):
+def write_files(fp, files, indent=0):
+    """Writes a list of files, from any iterable.
+
+    The lines are formatted and written in batches, so the files can come from
+    a generator without being all in memory.
+    """
+    lines = []
+    for fi in files:
+        lines.append(format_file(fi, indent))
+        if len(lines) >= WRITE_BATCH_SIZE:
+            fp.write(''.join(lines))
+            lines = []
+    if lines:
+        fp.write(''.join(lines))
+
+
+def write_package(fp, pkg, indent=0, presorted=False):
     indent_str = "    " * indent
     fp.write("%s  - name: \"%s\"\n" % (indent_str, escape(pkg.name)))
     fp.write("%s    version: \"%s\"\n" % (indent_str, escape(pkg.version)))
@@ -496,19 +574,28 @@ def write_package(fp, pkg, indent=0):
     if pkg.size is not None:
         fp.write("%s      # Installed package size: %s\n" % (
                  indent_str, hsize(pkg.size)))
-    for fi in sorted(pkg.files, key=lambda fi_: fi_.path):
-        write_file(fp, fi, indent + 1)
+    if presorted:
+        write_files(fp, pkg.files, indent + 1)
+    else:
+        write_files(fp, sorted(pkg.files, key=lambda fi_: fi_.path),
+                    indent + 1)
 
 
 def save_config(filename, runs, packages, other_files, reprozip_version,
                 inputs_outputs=None,
-                canonical=False, pack_id=None):
+                canonical=False, pack_id=None, presorted=False):
     """Saves the configuration to a YAML file.
 
     `canonical` indicates whether this is a canonical configuration file
     (no ``additional_patterns`` section).
+
+    If `presorted` is True, `packages` and `other_files` are taken to be
+    already sorted (packages by name, files by path, for example from an
+    ``ORDER BY`` query) and are only iterated on once; they can then be
+    generators, so that the whole file list doesn't need to be in memory.
     """
-    dump = lambda x: yaml.safe_dump(x, encoding='utf-8', allow_unicode=True)
+    dump = lambda x: yaml.dump(x, Dumper=SafeDumper,
+                               encoding='utf-8', allow_unicode=True)
     with filename.open('w', encoding='utf-8', newline='\n') as fp:
         # Writes preamble
         fp.write("""\
@@ -571,8 +658,10 @@ packages:
 """)
 
         # Writes files
-        for pkg in sorted(packages, key=lambda p: p.name):
-            write_package(fp, pkg)
+        if not presorted:
+            packages = sorted(packages, key=lambda p: p.name)
+        for pkg in packages:
+            write_package(fp, pkg, presorted=presorted)
 
         fp.write("""\
 
@@ -580,8 +669,9 @@ packages:
 # want them packed
 other_files:
 """)
-        for f in sorted(other_files, key=lambda fi: fi.path):
-            write_file(fp, f)
+        if not presorted:
+            other_files = sorted(other_files, key=lambda fi: fi.path)
+        write_files(fp, other_files)
 
         if not canonical:
             fp.write("""\
@@ -660,11 +750,27 @@ def setup_logging(tag, verbosity):
 _usage_report = None
 
 
+def usage_report_disabled_env():
+    """Whether usage reports are disabled through the environment.
+
+    This is the same test usagestats does on ``REPROZIP_USAGE_STATS``, so that
+    it doesn't get imported at all in that case (it brings in requests).
+    """
+    value = os.environ.get('REPROZIP_USAGE_STATS', '').lower()
+    return value not in ('', '1', 'on', 'enabled', 'yes', 'true')
+
+
 def setup_usage_report(name, version):
     """Sets up the usagestats module.
     """
     global _usage_report
 
+    if usage_report_disabled_env():
+        _usage_report = None
+        return
+
+    import usagestats
+
     certificate_file = get_reprozip_ca_certificate()
 
     _usage_report = usagestats.Stats(
@@ -688,6 +794,10 @@ def setup_usage_report(name, version):
 def enable_usage_report(enable):
     """Enables or disables usage reporting.
     """
+    if _usage_report is None:
+        logger.critical("Usage reports are disabled by the "
+                        "REPROZIP_USAGE_STATS environment variable")
+        return
     if enable:
         _usage_report.enable_reporting()
         stderr.write("Thank you, usage reports will be sent automatically "
@@ -715,8 +825,7 @@ def record_usage_package(runs, packages, other_files,
         record_usage(argv0=run['argv'][0])
     record_usage(pack_id=pack_id or '',
                  nb_packages=len(packages),
-                 nb_package_files=sum(len(pkg.files)
-                                      for pkg in packages),
+                 nb_package_files=sum(pkg.nb_files for pkg in packages),
                  packed_packages=sum(1 for pkg in packages
                                      if pkg.packfiles),
                  nb_other_files=len(other_files),
@@ -730,6 +839,11 @@ def record_usage_package(runs, packages, other_files,
 def submit_usage_report(**kwargs):
     """Submits the current usage report to the usagestats server.
     """
+    if _usage_report is None:
+        return
+
+    import usagestats
+
     _usage_report.submit(kwargs,
                          usagestats.OPERATING_SYSTEM,
                          usagestats.SESSION_TIME,
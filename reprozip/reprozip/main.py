@@ -7,7 +7,9 @@
 This contains :func:`~reprozip.main.main`, which is the entry point declared to
 setuptools. It is also callable directly.
 
-It dispatchs to other routines, or handles the testrun command.
+It dispatchs to other routines, or handles the testrun command. The modules
+implementing the subcommands are only imported when they get used, so that
+tracing a command doesn't have to load the packer.
 """
 
 from __future__ import division, print_function, unicode_literals
@@ -30,9 +32,6 @@ from reprozip import _pytracer
 from reprozip.common import setup_logging, \
     setup_usage_report, enable_usage_report, \
     submit_usage_report, record_usage
-import reprozip.pack
-import reprozip.tracer.trace
-import reprozip.traceutils
 from reprozip.utils import PY3, unicode_, stderr
 
 
@@ -188,6 +187,8 @@ def trace(args):
 
     Simply calls reprozip.tracer.trace() with the arguments from argparse.
     """
+    import reprozip.tracer.trace
+
     if args.arg0 is not None:
         argv = [args.arg0] + args.cmdline[1:]
     else:
@@ -219,6 +220,8 @@ def reset(args):
     Just regenerates the configuration (config.yml) from the trace
     (trace.sqlite3).
     """
+    import reprozip.tracer.trace
+
     reprozip.tracer.trace.write_configuration(Path(args.dir),
                                               args.identify_packages,
                                               args.find_inputs_outputs,
@@ -230,6 +233,8 @@ def pack(args):
 
     Reads in the configuration file and writes out a tarball.
     """
+    import reprozip.pack
+
     target = Path(args.target)
     if not target.unicodename.lower().endswith('.rpz'):
         target = Path(target.path + b'.rpz')
@@ -245,6 +250,9 @@ def combine(args):
     The runs from the original traces are appended ('run_id' field gets
     translated to avoid conflicts).
     """
+    import reprozip.tracer.trace
+    import reprozip.traceutils
+
     traces = []
     for tracepath in args.traces:
         if tracepath == '-':
@@ -255,7 +263,7 @@ def combine(args):
                 tracepath = tracepath / 'trace.sqlite3'
         traces.append(tracepath)
 
-    reprozip.traceutils.combine_traces(traces, Path(args.dir))
+    reprozip.traceutils.combine_traces(traces, Path(args.dir), args.jobs)
     reprozip.tracer.trace.write_configuration(Path(args.dir),
                                               args.identify_packages,
                                               args.find_inputs_outputs,
@@ -376,6 +384,10 @@ def main():
         'combine',
         help="Combine multiple traces into one (possibly as subsequent runs)")
     add_options(parser_combine)
+    parser_combine.add_argument(
+        '-j', '--jobs', action='store', type=int, default=1,
+        help="merge that many groups of traces concurrently first; this "
+        "helps if reading the traces is slow, e.g. over the network")
     parser_combine.add_argument('traces', nargs=argparse.ONE_OR_MORE)
     parser_combine.set_defaults(func=combine)
 
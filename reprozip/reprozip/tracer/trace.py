@@ -16,7 +16,6 @@ from collections import defaultdict
 from itertools import count
 import logging
 import os
-from pkg_resources import iter_entry_points
 import platform
 from rpaths import Path
 import sqlite3
@@ -96,8 +95,26 @@ class TracedFile(File):
                 self.runs[run] = TracedFile.READ_THEN_WRITTEN
 
 
+def iter_filter_entry_points():
+    """Lists the ``reprozip.filters`` entry points.
+
+    importlib.metadata is used if available, it is a lot faster to import than
+    pkg_resources.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # Python < 3.8
+        from pkg_resources import iter_entry_points
+        return iter_entry_points('reprozip.filters')
+    entry_points = entry_points()
+    if hasattr(entry_points, 'select'):  # Python >= 3.10
+        return entry_points.select(group='reprozip.filters')
+    else:
+        return entry_points.get('reprozip.filters', [])
+
+
 def run_filter_plugins(files, input_files):
-    for entry_point in iter_entry_points('reprozip.filters'):
+    for entry_point in iter_filter_entry_points():
         func = entry_point.load()
         name = entry_point.name
 
@@ -14,9 +14,10 @@ import logging
 import os
 from rpaths import Path
 import sqlite3
+import threading
 
 from reprozip.tracer.trace import TracedFile
-from reprozip.utils import PY3, listvalues
+from reprozip.utils import PY3, irange, listvalues
 
 
 logger = logging.getLogger('reprozip')
@@ -97,163 +98,287 @@ def combine_files(newfiles, newpackages, oldfiles, oldpackages):
     return files, packages
 
 
-def combine_traces(traces, target):
-    """Combines multiple trace databases into one.
+#: Number of traces attached at once by `combine_traces()`; SQLite limits the
+#: number of attached databases to 10 by default
+COMBINE_BATCH_SIZE = 8
 
-    The runs from the original traces are appended ('run_id' field gets
-    translated to avoid conflicts).
 
-    :param traces: List of trace database filenames.
-    :type traces: [Path]
-    :param target: Directory where to write the new database and associated
-        configuration file.
-    :type target: Path
+class _IdMapping(object):
+    """Translation of the ids of runs or processes from a trace being merged.
+
+    The new ids follow the ones already in the target, in the same order as
+    the old ones. If the old ids are contiguous, which is usually the case,
+    the new ones are computed with an offset; else a lookup table is built in
+    the temporary database.
+    """
+    def __init__(self, conn, alias, name, query, offset):
+        self.offset = offset
+        self.count, self.min, self.max = conn.execute(
+            '''
+            SELECT COUNT(*), MIN(old), MAX(old) FROM (%s);
+            ''' % query).fetchone()
+        if self.count and self.max - self.min + 1 != self.count:
+            self.table = 'temp.map_%s_%s' % (name, alias)
+            conn.execute(
+                '''
+                CREATE TABLE %s(
+                    new INTEGER NOT NULL PRIMARY KEY,
+                    old INTEGER NOT NULL UNIQUE
+                    );
+                ''' % self.table)
+            conn.execute(
+                '''
+                INSERT INTO %s(old)
+                SELECT old FROM (%s) ORDER BY old;
+                ''' % (self.table, query))
+        else:
+            self.table = None
+
+    def join(self, column, name):
+        """Gets the JOIN clause needed to translate a column, if any.
+        """
+        if self.table is None:
+            return ''
+        return 'INNER JOIN %s %s ON t.%s = %s.old' % (
+            self.table, name, column, name)
+
+    def condition(self, column):
+        """Gets the condition on rows that can be translated.
+
+        The unary + keeps SQLite from using an index for this, rows are read
+        in order of id.
+        """
+        if self.table is None:
+            return '+t.%s BETWEEN %d AND %d' % (column, self.min, self.max)
+        return '1'
+
+    def new(self, column, name):
+        """Gets the expression for the new id.
+        """
+        if self.table is None:
+            return 't.%s + %d' % (column, self.offset + 1 - self.min)
+        return '%s.new + %d' % (name, self.offset)
+
+    def drop(self, conn):
+        if self.table is not None:
+            conn.execute('DROP TABLE %s;' % self.table)
+
+
+def _merge_trace(conn, alias, run_offset, process_offset):
+    """Appends the content of an attached trace to the target database.
+
+    Returns the number of runs and processes added.
+    """
+    runs = _IdMapping(conn, alias, 'runs',
+                      'SELECT DISTINCT run_id AS old FROM %s.processes' %
+                      alias,
+                      run_offset)
+    processes = _IdMapping(conn, alias, 'processes',
+                           'SELECT id AS old FROM %s.processes' % alias,
+                           process_offset)
+    logger.info("%d runs and %d processes in %s",
+                runs.count, processes.count, alias)
+    if processes.count == 0:
+        # Nothing to translate, and rows without a process are dropped
+        return 0, 0
+
+    # processes
+    logger.info("Insert processes...")
+    conn.execute(
+        '''
+        INSERT INTO processes(id, run_id, parent,
+                              timestamp, is_thread, exitcode)
+        SELECT {new_p} AS id, {new_r} AS run_id, parent,
+               timestamp, is_thread, exitcode
+        FROM {alias}.processes t
+        {join_r}
+        {join_p}
+        WHERE {cond_r} AND {cond_p}
+        ORDER BY t.id;
+        '''.format(alias=alias,
+                   new_p=processes.new('id', 'p'),
+                   new_r=runs.new('run_id', 'r'),
+                   join_r=runs.join('run_id', 'r'),
+                   join_p=processes.join('id', 'p'),
+                   cond_r=runs.condition('run_id'),
+                   cond_p=processes.condition('id')))
+
+    # opened_files
+    logger.info("Insert opened_files...")
+    conn.execute(
+        '''
+        INSERT INTO opened_files(run_id, name, timestamp,
+                                 mode, is_directory, process)
+        SELECT {new_r} AS run_id, name, timestamp,
+               mode, is_directory, {new_p} AS process
+        FROM {alias}.opened_files t
+        {join_r}
+        {join_p}
+        WHERE {cond_r} AND {cond_p}
+        ORDER BY t.id;
+        '''.format(alias=alias,
+                   new_p=processes.new('process', 'p'),
+                   new_r=runs.new('run_id', 'r'),
+                   join_r=runs.join('run_id', 'r'),
+                   join_p=processes.join('process', 'p'),
+                   cond_r=runs.condition('run_id'),
+                   cond_p=processes.condition('process')))
+
+    # executed_files
+    logger.info("Insert executed_files...")
+    conn.execute(
+        '''
+        INSERT INTO executed_files(name, run_id, timestamp, process,
+                                   argv, envp, workingdir)
+        SELECT name, {new_r} AS run_id, timestamp, {new_p} AS process,
+               argv, envp, workingdir
+        FROM {alias}.executed_files t
+        {join_r}
+        {join_p}
+        WHERE {cond_r} AND {cond_p}
+        ORDER BY t.id;
+        '''.format(alias=alias,
+                   new_p=processes.new('process', 'p'),
+                   new_r=runs.new('run_id', 'r'),
+                   join_r=runs.join('run_id', 'r'),
+                   join_p=processes.join('process', 'p'),
+                   cond_r=runs.condition('run_id'),
+                   cond_p=processes.condition('process')))
+
+    runs.drop(conn)
+    processes.drop(conn)
+    return runs.count, processes.count
+
+
+def _combine(traces, output):
+    """Merges trace databases into a new database file.
     """
-    # We are probably overwriting one of the traces we're reading, so write to
-    # a temporary file first then move it
-    fd, output = Path.tempfile('.sqlite3', 'reprozip_combined_')
     if PY3:
         # On PY3, connect() only accepts unicode
         conn = sqlite3.connect(str(output))
     else:
         conn = sqlite3.connect(output.path)
-    os.close(fd)
     conn.row_factory = sqlite3.Row
+    # Transactions are handled explicitly, since ATTACH and DETACH can't
+    # happen in one
+    conn.isolation_level = None
+
+    # This is a new file, that only gets moved in place once complete, so
+    # there is no need to sync it
+    conn.execute('PRAGMA synchronous=OFF;')
+    conn.execute('PRAGMA cache_size=-65536;')
 
     # Create the schema
     create_schema(conn)
 
-    # Temporary database with lookup tables
-    conn.execute(
-        '''
-        ATTACH DATABASE '' AS maps;
-        ''')
-    conn.execute(
-        '''
-        CREATE TABLE maps.map_runs(
-            old INTEGER NOT NULL,
-            new INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT
-            );
-        ''')
-    conn.execute(
-        '''
-        CREATE TABLE maps.map_processes(
-            old INTEGER NOT NULL,
-            new INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT
-            );
-        ''')
-
     # Do the merge
-    for other in traces:
-        logger.info("Attaching database %s", other)
+    run_offset = process_offset = 0
+    for batch in irange(0, len(traces), COMBINE_BATCH_SIZE):
+        aliases = []
+        for other in traces[batch:batch + COMBINE_BATCH_SIZE]:
+            logger.info("Attaching database %s", other)
+            alias = 'trace%d' % len(aliases)
+            conn.execute(
+                '''
+                ATTACH DATABASE ? AS %s;
+                ''' % alias,
+                (str(other),))
+            aliases.append(alias)
+
+        conn.execute('BEGIN;')
+        for alias in aliases:
+            nb_runs, nb_processes = _merge_trace(conn, alias,
+                                                 run_offset, process_offset)
+            run_offset += nb_runs
+            process_offset += nb_processes
+        conn.execute('COMMIT;')
+
+        for alias in aliases:
+            conn.execute(
+                '''
+                DETACH DATABASE %s;
+                ''' % alias)
 
-        # Attach the other trace
-        conn.execute(
-            '''
-            ATTACH DATABASE ? AS trace;
-            ''',
-            (str(other),))
+    conn.close()
 
-        # Add runs to lookup table
-        conn.execute(
-            '''
-            INSERT INTO maps.map_runs(old)
-            SELECT DISTINCT run_id AS old
-            FROM trace.processes
-            ORDER BY run_id;
-            ''')
-
-        logger.info(
-            "%d rows in maps.map_runs",
-            list(conn.execute('SELECT COUNT(*) FROM maps.map_runs;'))[0][0])
-
-        # Add processes to lookup table
-        conn.execute(
-            '''
-            INSERT INTO maps.map_processes(old)
-            SELECT id AS old
-            FROM trace.processes
-            ORDER BY id;
-            ''')
-
-        logger.info(
-            "%d rows in maps.map_processes",
-            list(conn.execute('SELECT COUNT(*) FROM maps.map_processes;'))
-            [0][0])
-
-        # processes
-        logger.info("Insert processes...")
-        conn.execute(
-            '''
-            INSERT INTO processes(id, run_id, parent,
-                                       timestamp, is_thread, exitcode)
-            SELECT p.new AS id, r.new AS run_id, parent,
-                   timestamp, is_thread, exitcode
-            FROM trace.processes t
-            INNER JOIN maps.map_runs r ON t.run_id = r.old
-            INNER JOIN maps.map_processes p ON t.id = p.old
-            ORDER BY t.id;
-            ''')
-
-        # opened_files
-        logger.info("Insert opened_files...")
-        conn.execute(
-            '''
-            INSERT INTO opened_files(run_id, name, timestamp,
-                                     mode, is_directory, process)
-            SELECT r.new AS run_id, name, timestamp,
-                   mode, is_directory, p.new AS process
-            FROM trace.opened_files t
-            INNER JOIN maps.map_runs r ON t.run_id = r.old
-            INNER JOIN maps.map_processes p ON t.process = p.old
-            ORDER BY t.id;
-            ''')
-
-        # executed_files
-        logger.info("Insert executed_files...")
-        conn.execute(
-            '''
-            INSERT INTO executed_files(name, run_id, timestamp, process,
-                                       argv, envp, workingdir)
-            SELECT name, r.new AS run_id, timestamp, p.new AS process,
-                   argv, envp, workingdir
-            FROM trace.executed_files t
-            INNER JOIN maps.map_runs r ON t.run_id = r.old
-            INNER JOIN maps.map_processes p ON t.process = p.old
-            ORDER BY t.id;
-            ''')
-
-        # Flush maps
-        conn.execute(
-            '''
-            DELETE FROM maps.map_runs;
-            ''')
-        conn.execute(
-            '''
-            DELETE FROM maps.map_processes;
-            ''')
 
-        # An implicit transaction gets created. Python used to implicitly
-        # commit it, but no longer does as of 3.6, so we have to explicitly
-        # commit before detaching.
-        conn.commit()
+def _combine_parallel(traces, tmpdir, jobs):
+    """Merges contiguous groups of traces concurrently.
 
-        # Detach
-        conn.execute(
-            '''
-            DETACH DATABASE trace;
-            ''')
+    Returns the list of intermediate databases, which can be merged in turn
+    to get the same result as merging all the traces.
+    """
+    size = (len(traces) + jobs - 1) // jobs
+    groups = [(traces[i:i + size], tmpdir / ('group%d.sqlite3' % n))
+              for n, i in enumerate(irange(0, len(traces), size))]
+
+    # Each worker thread takes groups from the shared list until it's empty.
+    # SQLite releases the GIL while it runs the statements
+    remaining = list(reversed(groups))
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining or errors:
+                    return
+                group, output = remaining.pop()
+            try:
+                _combine(group, output)
+            except Exception as e:
+                logger.error("Error combining traces: %s", e)
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for i in irange(min(jobs, len(groups)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return [output for group, output in groups]
+
+
+def combine_traces(traces, target, jobs=1):
+    """Combines multiple trace databases into one.
 
-    # See above.
-    conn.commit()
+    The runs from the original traces are appended ('run_id' field gets
+    translated to avoid conflicts).
 
-    conn.execute(
-        '''
-        DETACH DATABASE maps;
-        ''')
+    Traces are attached and merged in batches, each in a single transaction.
+    If `jobs` is more than 1, contiguous groups of traces are first merged
+    concurrently, and the results are then merged together; the resulting
+    database is the same.
 
-    conn.commit()
-    conn.close()
+    :param traces: List of trace database filenames.
+    :type traces: [Path]
+    :param target: Directory where to write the new database and associated
+        configuration file.
+    :type target: Path
+    :param jobs: Number of groups to merge concurrently.
+    :type jobs: int
+    """
+    traces = list(traces)
+
+    # We are probably overwriting one of the traces we're reading, so write to
+    # a temporary file first then move it
+    fd, output = Path.tempfile('.sqlite3', 'reprozip_combined_')
+    os.close(fd)
+    try:
+        if jobs > 1 and len(traces) > COMBINE_BATCH_SIZE:
+            tmpdir = Path.tempdir(prefix='reprozip_combine_')
+            try:
+                _combine(_combine_parallel(traces, tmpdir, jobs), output)
+            finally:
+                tmpdir.rmtree()
+        else:
+            _combine(traces, output)
+    except BaseException:
+        if output.exists():
+            output.remove()
+        raise
 
     # Move database to final destination
     if not target.exists():
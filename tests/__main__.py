@@ -65,6 +65,8 @@ if __name__ == '__main__':
     parser.add_argument('--interactive', action='store_true')
     parser.add_argument('--run-vagrant', action='store_true')
     parser.add_argument('--run-docker', action='store_true')
+    parser.add_argument('--benchmarks', action='store_true',
+                        help="Run the benchmarks instead of the tests")
     parser.add_argument('arg', nargs=argparse.REMAINDER)
     parser.add_argument('--no-raise-warnings', action='store_false',
                         dest='raise_warnings', default=True)
@@ -80,6 +82,11 @@ if __name__ == '__main__':
     unittests, functests = default_map.get((args.unittests, args.functests),
                                            (args.unittests, args.functests))
 
+    if args.benchmarks:
+        from tests.benchmarks import run_benchmarks
+        run_benchmarks(args.arg)
+        sys.exit(0)
+
     successful = True
     if unittests:
         logger.info("Running unit tests")
@@ -0,0 +1,278 @@
+# Copyright (C) 2014-2017 New York University
+# This file is part of ReproZip which is released under the Revised BSD License
+# See file LICENSE for full license details.
+
+"""Benchmarks, run with ``python tests --benchmarks [name ...]``.
+
+These are not part of the unit tests; they don't check anything, but print
+measurements that can be compared between implementations.
+"""
+
+from __future__ import division, print_function, unicode_literals
+
+import gc
+import logging
+import os
+from rpaths import Path, PosixPath
+import subprocess
+import sys
+import time
+
+from reprounzip.common import FILE_READ, FILE_WRITE, FILE_STAT
+from reprounzip.utils import irange
+
+from tests.common import make_database
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+benchmarks = {}
+
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+
+def measure(func, *args, **kwargs):
+    """Calls a function, returning its result, its duration and peak memory.
+
+    Peak memory is in bytes allocated by Python, or None if it can't be
+    measured.
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+        duration = time.time() - start
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+        else:
+            peak = None
+    finally:
+        if tracemalloc is not None:
+            tracemalloc.stop()
+    return result, duration, peak
+
+
+def report(name, duration, peak, **info):
+    print("%s: %.2fs, peak memory %s%s" % (
+          name, duration,
+          "%.1f MiB" % (peak / (1 << 20)) if peak is not None else "unknown",
+          ''.join(", %s=%s" % i for i in sorted(info.items()))))
+
+
+def synthetic_trace(path, processes=49, files=100000, accesses=500000):
+    """Makes a trace database with a lot of file accesses.
+    """
+    def events():
+        yield ('proc', 0, None, False)
+        yield ('exec', 0, "/bin/sh", "/", "sh\0script\0")
+        for pid in irange(1, processes):
+            yield ('proc', pid, 0, False)
+            yield ('exec', pid, "/usr/bin/prog%d" % (pid % 5), "/",
+                   "prog\0%d\0" % pid)
+        modes = [FILE_READ, FILE_READ, FILE_WRITE, FILE_STAT]
+        for i in irange(accesses):
+            yield ('open', i % processes,
+                   "/data/dir%d/file%d" % (i % 100, (i * 7) % files), False,
+                   modes[i % len(modes)])
+
+    make_database(events(), path).close()
+
+
+@benchmark
+def graph_read_events():
+    """Reads the events of a large trace for the graph.
+    """
+    from reprounzip.unpackers import graph
+
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        synthetic_trace(tmp / 'trace.sqlite3')
+        (runs, files, edges), duration, peak = measure(
+            graph.read_events, tmp / 'trace.sqlite3', False, True)
+        report("graph.read_events()", duration, peak,
+               files=len(files), edges=len(edges))
+    finally:
+        tmp.rmtree()
+
+
+@benchmark
+def provviewer_generate():
+    """Exports a large trace to the Prov Viewer format.
+    """
+    from reprounzip.unpackers import provviewer
+
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        synthetic_trace(tmp / 'trace.sqlite3')
+        with (tmp / 'config.yml').open('w', encoding='utf-8') as fp:
+            fp.write('version: "0.8"\n'
+                     'runs: []\n'
+                     'inputs_outputs: []\n'
+                     'packages: []\n'
+                     'other_files: []\n')
+        _, duration, peak = measure(
+            provviewer.generate, tmp / 'graph.xml', tmp / 'config.yml',
+            tmp / 'trace.sqlite3')
+        report("provviewer.generate()", duration, peak,
+               size=(tmp / 'graph.xml').size())
+    finally:
+        tmp.rmtree()
+
+
+@benchmark
+def combine_traces():
+    """Combines many small traces into one.
+    """
+    from reprozip import traceutils
+
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        traces = []
+        for i in irange(100):
+            trace = tmp / ('trace%d.sqlite3' % i)
+            synthetic_trace(trace, processes=10, files=1000, accesses=20000)
+            traces.append(trace)
+        _, duration, peak = measure(
+            traceutils.combine_traces, traces, tmp / 'combined')
+        report("traceutils.combine_traces()", duration, peak,
+               traces=len(traces))
+    finally:
+        tmp.rmtree()
+
+
+def synthetic_config(path, packages=2000, files=200000):
+    """Writes a configuration file listing a lot of files.
+
+    The packages and files are generated in order and streamed to
+    `save_config()`, so they are never all in memory.
+    """
+    from reprounzip.common import File, Package, save_config
+
+    per_package = files // 2 // packages
+
+    def gen_packages():
+        for p in irange(packages):
+            yield Package('pkg%05d' % p, '1.%d' % p,
+                          (File(PosixPath('/usr/lib/pkg%05d/file%05d.so' %
+                                          (p, f)),
+                                size=4096)
+                           for f in irange(per_package)),
+                          packfiles=True, size=per_package * 4096)
+
+    def gen_other_files():
+        for f in irange(files - per_package * packages):
+            yield File(PosixPath('/home/user/data/file%07d.dat' % f))
+
+    runs = [{'id': 'run%d' % r, 'binary': '/usr/bin/python',
+             'argv': ['python', 'step%d.py' % r], 'workingdir': '/home/user',
+             'environ': {'PATH': '/usr/bin:/bin', 'HOME': '/home/user'},
+             'architecture': 'x86_64', 'distribution': ['debian', '10'],
+             'hostname': 'test', 'system': ['Linux', '4.19'],
+             'uid': 1000, 'gid': 1000, 'signal': None, 'exitcode': 0}
+            for r in irange(10)]
+    save_config(path, runs, gen_packages(), gen_other_files(), '1.0', {},
+                canonical=True, presorted=True)
+
+
+@benchmark
+def config_load_save():
+    """Loads and saves a configuration file listing 200k files.
+    """
+    from reprounzip.common import load_config, save_config
+
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        synthetic_config(tmp / 'config.yml')
+        config, duration, peak = measure(
+            load_config, tmp / 'config.yml', canonical=True)
+        report("load_config()", duration, peak,
+               files=(sum(len(pkg.files) for pkg in config.packages) +
+                      len(config.other_files)))
+        _, duration, peak = measure(
+            save_config, tmp / 'config2.yml', config.runs, config.packages,
+            config.other_files, '1.0', config.inputs_outputs,
+            canonical=True)
+        report("save_config()", duration, peak,
+               size=(tmp / 'config2.yml').size())
+        _, duration, peak = measure(
+            save_config, tmp / 'config3.yml', config.runs, config.packages,
+            config.other_files, '1.0', config.inputs_outputs,
+            canonical=True, presorted=True)
+        report("save_config(presorted=True)", duration, peak,
+               size=(tmp / 'config3.yml').size())
+    finally:
+        tmp.rmtree()
+
+
+@benchmark
+def config_save_stream():
+    """Saves a configuration file listing 200k files from generators.
+    """
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        _, duration, peak = measure(synthetic_config, tmp / 'config.yml')
+        report("save_config(<generators>)", duration, peak,
+               size=(tmp / 'config.yml').size())
+    finally:
+        tmp.rmtree()
+
+
+def startup(args, runs=5):
+    """Runs a Python command-line several times.
+
+    Returns the fastest duration and the number of modules imported (or None
+    if Python can't report it).
+    """
+    with open(os.devnull, 'wb') as devnull:
+        durations = []
+        for _ in irange(runs):
+            start = time.time()
+            subprocess.call([sys.executable] + args,
+                            stdout=devnull, stderr=devnull)
+            durations.append(time.time() - start)
+        modules = None
+        if sys.version_info >= (3, 7):
+            proc = subprocess.Popen([sys.executable, '-X', 'importtime'] +
+                                    args,
+                                    stdout=devnull, stderr=subprocess.PIPE)
+            _, err = proc.communicate()
+            modules = sum(1 for line in err.splitlines()
+                          if line.startswith(b'import time:') and
+                          not line.endswith(b'imported package'))
+    return min(durations), modules
+
+
+@benchmark
+def cli_startup():
+    """Measures how long the command-lines take to start.
+    """
+    for args in (['--help'], ['directory', '--help'],
+                 ['docker', '--help']):
+        duration, modules = startup(['-m', 'reprounzip.main'] + args)
+        report("reprounzip %s" % ' '.join(args), duration, None,
+               modules=modules)
+
+    tmp = Path.tempdir(prefix='rpz_bench_')
+    try:
+        for args in (['--help'],
+                     ['trace', '-d', str(tmp / 'trace'), '--overwrite',
+                      '--dont-identify-packages', 'true']):
+            duration, modules = startup(['-m', 'reprozip.main'] + args)
+            report("reprozip %s" % args[0], duration, None, modules=modules)
+    finally:
+        tmp.rmtree()
+
+
+def run_benchmarks(names=None):
+    # Debug messages would dominate the measurements
+    logging.root.setLevel(logging.WARNING)
+    for name in names or sorted(benchmarks):
+        benchmarks[name]()
@@ -0,0 +1,257 @@
+# Copyright (C) 2014-2017 New York University
+# This file is part of ReproZip which is released under the Revised BSD License
+# See file LICENSE for full license details.
+
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+import os
+from rpaths import Path
+import socket
+import struct
+import tarfile
+import threading
+import unittest
+
+from reprounzip.unpackers.docker import ContainerDownloader
+from reprounzip.unpackers.docker.client import DockerAPIClient, DockerError
+from reprounzip.utils import PY3
+
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+
+class StubDockerHandler(BaseHTTPRequestHandler):
+    """Answers requests like the Docker daemon would, for a few containers.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                chunk = self.rfile.read(size + 2)
+                if size == 0:
+                    return body
+                body += chunk[:-2]
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length)
+
+    def reply(self, status, content=b'', content_type='application/json'):
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method):
+        body = self.read_body()
+        server = self.server
+        server.requests.append((method, self.path))
+        path, _, query = self.path.partition('?')
+        parts = path.split('/')[2:]
+        if parts[0] == 'containers' and len(parts) == 3:
+            name = parts[1]
+            if name not in server.containers:
+                self.reply(404, {'message': "No such container: %s" % name})
+            elif parts[2] == 'exec':
+                server.exec_command = json.loads(body.decode('utf-8'))['Cmd']
+                self.reply(201, {'Id': 'e1'})
+            elif parts[2] == 'json':
+                self.reply(200, {'State': {'Running': False}})
+            elif parts[2] == 'wait':
+                self.reply(200, {'StatusCode': 3})
+            elif parts[2] == 'archive' and method == 'PUT':
+                server.containers[name] = body
+                self.reply(200)
+            elif parts[2] == 'archive':
+                self.reply(200, server.containers[name], 'application/x-tar')
+            else:
+                self.reply(204)
+        elif parts == ['containers', 'create']:
+            server.containers[query.split('=', 1)[1]] = None
+            self.reply(201, {'Id': '1234'})
+        elif parts[0] == 'containers' and method == 'DELETE':
+            if server.containers.pop(parts[1], False) is False:
+                self.reply(404, {'message': "No such container"})
+            else:
+                self.reply(204)
+        elif parts == ['commit']:
+            self.reply(201, {'Id': '5678'})
+        elif parts == ['exec', 'e1', 'start']:
+            # Take over the connection, echo the input back on stdout
+            self.wfile.write(b'HTTP/1.1 101 UPGRADED\r\n'
+                             b'Content-Type: application/vnd.docker.raw-stream'
+                             b'\r\nConnection: Upgrade\r\n'
+                             b'Upgrade: tcp\r\n\r\n')
+            data = self.rfile.read()
+            self.wfile.write(b'\x02\x00\x00\x00\x00\x00\x00\x05error')
+            self.wfile.write(b'\x01\x00\x00\x00' +
+                             struct.pack('>I', len(data)) + data)
+            self.close_connection = True
+        elif parts == ['exec', 'e1', 'json']:
+            self.reply(200, {'ExitCode': 4})
+        else:
+            self.reply(404, {'message': "page not found"})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class StubDockerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        UnixStreamServer.__init__(self, socket_path, StubDockerHandler)
+        self.containers = {}
+        self.requests = []
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Needs UNIX sockets")
+class TestDockerAPI(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testdocker_')
+        self.server = StubDockerServer(str(self.tmp / 'docker.sock'))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.client = DockerAPIClient(str(self.tmp / 'docker.sock'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.rmtree()
+
+    def test_containers(self):
+        """Creates, commits and removes a container through the API."""
+        client = self.client
+        self.assertIsNone(client.inspect_container(b'nonexistent'))
+        client.create_container(b'some_image', b'cont')
+        self.assertEqual(client.inspect_container(b'cont'),
+                         {'State': {'Running': False}})
+        self.assertEqual(client.wait_container(b'cont'), 3)
+        client.commit(b'cont', b'new_image')
+        client.remove_container(b'cont', force=True)
+        self.assertRaises(DockerError, client.remove_container, b'cont')
+        self.assertEqual(
+            self.server.requests,
+            [('GET', '/v1.24/containers/nonexistent/json'),
+             ('POST', '/v1.24/containers/create?name=cont'),
+             ('GET', '/v1.24/containers/cont/json'),
+             ('POST', '/v1.24/containers/cont/wait'),
+             ('POST', '/v1.24/commit?container=cont&repo=new_image'),
+             ('DELETE', '/v1.24/containers/cont?force=1'),
+             ('DELETE', '/v1.24/containers/cont?force=0')])
+
+    def test_archive(self):
+        """Streams a tar archive to a container and gets it back."""
+        client = self.client
+        client.create_container(b'some_image', b'cont')
+        data = os.urandom(100000)
+        stream = client.put_archive(b'cont', b'/')
+        tar = tarfile.open(fileobj=stream, mode='w|')
+        tarinfo = tarfile.TarInfo('tmp/file.bin')
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+        tar.close()
+        stream.close()
+        self.assertIn(('PUT', '/v1.24/containers/cont/archive?path=%2F'),
+                      self.server.requests)
+
+        stream = client.get_archive(b'cont', b'/tmp/file.bin')
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        member = next(iter(tar))
+        self.assertEqual(member.name, 'tmp/file.bin')
+        self.assertEqual(tar.extractfile(member).read(), data)
+        tar.close()
+        stream.close()
+
+    def test_exec(self):
+        """Runs a command in a container, sending it input."""
+        client = self.client
+        client.create_container(b'some_image', b'cont')
+        retcode, output = client.exec_(b'cont', ['cat'],
+                                       iter([b'some ', b'input']))
+        self.assertEqual(retcode, 4)
+        self.assertEqual(output, b'some input')
+        self.assertEqual(self.server.exec_command, ['cat'])
+
+
+class ArchiveStream(io.BytesIO):
+    """Archive from a container, failing on close like a broken pipe would.
+    """
+    closed_by_reader = False
+
+    def close(self):
+        self.closed_by_reader = True
+        io.BytesIO.close(self)
+        raise DockerError("docker cp failed with code 1")
+
+
+class ArchiveClient(object):
+    def __init__(self, members):
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w')
+        for name, data in members:
+            tarinfo = tarfile.TarInfo(name)
+            if data is None:
+                tarinfo.type = tarfile.DIRTYPE
+                tar.addfile(tarinfo)
+            else:
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, io.BytesIO(data))
+        tar.close()
+        self.stream = ArchiveStream(buf.getvalue())
+
+    def get_archive(self, container, path):
+        return self.stream
+
+
+class TestContainerDownloader(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testdocker_')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def download(self, members):
+        # Don't run the download command from the constructor
+        downloader = ContainerDownloader.__new__(ContainerDownloader)
+        downloader.client = ArchiveClient(members)
+        downloader.container = b'cont'
+        result = downloader.download(Path('/out.txt'), self.tmp / 'out.txt')
+        self.assertTrue(downloader.client.stream.closed_by_reader)
+        return result
+
+    def test_file(self):
+        """Gets a file, closing the archive before reading all of it."""
+        self.assertTrue(self.download([('out.txt', b'data'),
+                                       ('other', b'more data')]))
+        with (self.tmp / 'out.txt').open('rb') as fp:
+            self.assertEqual(fp.read(), b'data')
+
+    def test_not_file(self):
+        """Gets a directory, which fails but still closes the archive."""
+        self.assertFalse(self.download([('out.txt', None)]))
+        self.assertFalse((self.tmp / 'out.txt').exists())
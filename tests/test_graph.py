@@ -4,14 +4,19 @@
 
 from __future__ import print_function, unicode_literals
 
+import io
 import json
+import os
 from rpaths import Path
 import sys
 import unittest
+from xml.etree import ElementTree
 
 from reprounzip.common import FILE_READ, FILE_WRITE, FILE_WDIR, FILE_STAT
-from reprounzip.unpackers import graph
+from reprounzip.unpackers import graph, provviewer
 from reprounzip.unpackers.common import UsageError
+from reprounzip.unpackers.common.tracecache import TRACE_CACHE_ENTRIES
+from reprounzip.utils import irange
 
 from tests.common import make_database
 
@@ -172,8 +177,192 @@ other_files:
             tmpdir.rmtree()
 
     def do_tests(self, expected_dot, expected_json, **kwargs):
-        self.do_dot_test(expected_dot, **kwargs)
-        self.do_json_test(expected_json, **kwargs)
+        for streaming in (False, True):
+            self.do_dot_test(expected_dot, streaming=streaming, **kwargs)
+            self.do_json_test(expected_json, streaming=streaming, **kwargs)
+
+    def read_graph(self, graph_format, **kwargs):
+        graph.Process._id_gen = 0
+        tmpdir = Path.tempdir(prefix='rpz_testgraph_')
+        target = tmpdir / 'graph'
+        try:
+            graph.generate(target,
+                           self._trace / 'config.yml',
+                           self._trace / 'trace.sqlite3',
+                           graph_format=graph_format, **kwargs)
+            with target.open('r', encoding='utf-8') as fp:
+                return fp.read()
+        finally:
+            tmpdir.rmtree()
+
+    variants = [dict(level_processes='run', level_other_files='io'),
+                dict(level_processes='process', level_other_files='depth:2'),
+                dict(level_pkgs='drop', all_forks=True),
+                dict(level_pkgs='drop', level_other_files='io'),
+                dict(level_pkgs='ignore', level_other_files='io'),
+                dict(level_pkgs='ignore', level_other_files='no',
+                     aggregates=['/some/dir']),
+                dict(level_pkgs='package', level_other_files='no',
+                     regex_filters=['\\.cfg$'])]
+
+    def compare_graphs(self, reference, **kwargs):
+        """Checks that variants of graph generation give the same graphs."""
+        for variant in self.variants:
+            for graph_format in ('dot', 'json'):
+                if graph_format == 'json' and \
+                        variant.get('level_pkgs') == 'package':
+                    continue
+                expected = reference(graph_format, **variant)
+                result = self.read_graph(graph_format,
+                                         **dict(variant, **kwargs))
+                if graph_format == 'json':
+                    expected = json.loads(expected)
+                    result = json.loads(result)
+                self.assertEqual(expected, result)
+
+    def test_streaming(self):
+        """Checks that streaming mode gives the same graphs."""
+        self.compare_graphs(self.read_graph, streaming=True)
+
+    def test_sql_filter(self):
+        """Checks that filtering in the database gives the same graphs."""
+        def unfiltered(graph_format, **kwargs):
+            old_setup = graph.SQLFileFilter.setup
+            graph.SQLFileFilter.setup = lambda self, conn: None
+            try:
+                return self.read_graph(graph_format, **kwargs)
+            finally:
+                graph.SQLFileFilter.setup = old_setup
+
+        self.compare_graphs(unfiltered)
+        self.compare_graphs(unfiltered, streaming=True)
+
+        # Only the executions are left
+        sql_filter = graph.SQLFileFilter([], graph.LVL_PKG_IGNORE,
+                                         graph.LVL_OTHER_NO)
+        runs, files, edges = graph.read_events(self._trace / 'trace.sqlite3',
+                                               False, True,
+                                               sql_filter=sql_filter)
+        self.assertEqual(len(edges), 7)
+        self.assertTrue(all(mode is None for _, _, mode, _ in edges))
+
+    def test_sql_filter_normalize(self):
+        """Checks that names are matched after normalization."""
+        tmpdir = Path.tempdir(prefix='rpz_testgraph_')
+        try:
+            make_database([
+                ('proc', 0, None, False),
+                ('exec', 0, "/bin/sh", "/some/dir", "sh\0script_1\0"),
+                ('open', 0, "//some/dir/one", False, FILE_READ),
+                ('open', 0, "//usr/lib/2_one.so", False, FILE_READ),
+                ('open', 0, "/some/dir/other", False, FILE_READ),
+            ], tmpdir / 'trace.sqlite3').close()
+            (self._trace / 'config.yml').copy(tmpdir / 'config.yml')
+
+            for kwargs in [dict(level_other_files='io'),
+                           dict(level_pkgs='drop', level_other_files='io'),
+                           dict(level_pkgs='drop', level_other_files='no')]:
+                graph.Process._id_gen = 0
+                graph.generate(tmpdir / 'graph.json',
+                               tmpdir / 'config.yml',
+                               tmpdir / 'trace.sqlite3',
+                               graph_format='json', **kwargs)
+                with (tmpdir / 'graph.json').open('r',
+                                                  encoding='utf-8') as fp:
+                    result = json.load(fp)
+                (tmpdir / 'graph.json').remove()
+                files = set(result['other_files'])
+                files.update(f for pkg in result['packages']
+                             for f in pkg['files'])
+                expected = set()
+                if kwargs['level_other_files'] == 'io':
+                    expected.add('/some/dir/one')
+                if 'level_pkgs' not in kwargs:
+                    expected.add('/usr/lib/2_one.so')
+                self.assertEqual(files, expected)
+        finally:
+            tmpdir.rmtree()
+
+    def test_events_cache(self):
+        """Checks that events loaded from the cache give the same graphs."""
+        cache = Path.tempdir(prefix='rpz_testcache_')
+        old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = str(cache)
+        try:
+            # First run fills the cache, second one reads from it
+            self.compare_graphs(self.read_graph, cache_key='testkey')
+            self.assertTrue(
+                (cache / 'reprozip/traces/testkey').listdir('*.pickle'))
+            self.compare_graphs(self.read_graph, cache_key='testkey')
+
+            # Old entries get removed
+            for i in irange(TRACE_CACHE_ENTRIES + 2):
+                graph.read_events_cached(self._trace / 'trace.sqlite3',
+                                         False, True, 'key%d' % i)
+            self.assertEqual(
+                sorted(p.unicodename
+                       for p in (cache / 'reprozip/traces').listdir()),
+                ['key%d' % i for i in irange(2, TRACE_CACHE_ENTRIES + 2)])
+
+            runs, files, edges = graph.read_events(
+                self._trace / 'trace.sqlite3', True, True)
+            buf = io.BytesIO()
+            graph.dump_events(buf, runs, edges)
+            buf.seek(0)
+            runs2, files2, edges2 = graph.load_events(buf)
+            self.assertEqual(files, files2)
+            self.assertEqual(
+                [(prog.pid, f, mode, argv) for prog, f, mode, argv in edges],
+                [(prog.pid, f, mode, argv) for prog, f, mode, argv in edges2])
+            self.assertEqual(
+                [run.json({}, graph.LVL_PROC_THREAD) for run in runs],
+                [run.json({}, graph.LVL_PROC_THREAD) for run in runs2])
+        finally:
+            if old_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_cache_home
+            cache.rmtree()
+
+    def read_provviewer(self, **kwargs):
+        tmpdir = Path.tempdir(prefix='rpz_testgraph_')
+        target = tmpdir / 'graph.xml'
+        try:
+            provviewer.generate(target,
+                                self._trace / 'config.yml',
+                                self._trace / 'trace.sqlite3',
+                                **kwargs)
+            tree = ElementTree.parse(target.path)
+        finally:
+            tmpdir.rmtree()
+        vertices = [v.find('ID').text
+                    for v in tree.getroot().find('vertices')]
+        edges = [(e.find('sourceID').text, e.find('targetID').text)
+                 for e in tree.getroot().find('edges')]
+        return vertices, edges
+
+    def test_provviewer(self):
+        """Exports the trace for Prov Viewer, then a sample of it."""
+        vertices, edges = self.read_provviewer()
+        self.assertEqual(len([v for v in vertices if v.startswith('access')]),
+                         17)
+        self.assertEqual(len([v for v in vertices if v.startswith('exec')]),
+                         7)
+        nb_edges = len(edges)
+
+        vertices, edges = self.read_provviewer(limit=5)
+        self.assertEqual([v for v in vertices if v.startswith('access')],
+                         ['access4', 'access8', 'access12', 'access16'])
+        self.assertEqual([v for v in vertices if v.startswith('exec')],
+                         ['exec2', 'exec4', 'exec6'])
+        # Each access and execution has 2 edges
+        self.assertEqual(len(edges), nb_edges - 2 * (17 - 4) - 2 * (7 - 3))
+        vertices = set(vertices)
+        for source, target in edges:
+            self.assertIn(source, vertices)
+            self.assertIn(target, vertices)
+
+        self.assertRaises(ValueError, self.read_provviewer, limit=0)
 
     def test_simple(self):
         self.do_tests(
@@ -4,11 +4,16 @@
 
 from __future__ import print_function, unicode_literals
 
+import argparse
+import io
 import os
+from rpaths import Path, PosixPath
 import sys
+import tarfile
 import unittest
 import warnings
 
+from reprounzip.common import File, Package, load_config, save_config
 from reprounzip.signals import Signal
 import reprounzip.unpackers.common
 
@@ -111,6 +116,137 @@ class TestArgs(unittest.TestCase):
         (reprounzip.unpackers.default.chroot_run,
          reprounzip.main.setup_logging) = old_funcs
 
+    def test_plugin_manifest(self):
+        """Tests the cached list of plugins"""
+        import reprounzip.main
+
+        tmp = Path.tempdir(prefix='rpz_testplugins_')
+        old_environ = dict(os.environ)
+        old_scan = reprounzip.main._scan_plugins
+        scans = []
+
+        def scan_plugins():
+            scans.append(1)
+            return old_scan()
+
+        os.environ['XDG_CACHE_HOME'] = str(tmp)
+        reprounzip.main._scan_plugins = scan_plugins
+        try:
+            manifest = reprounzip.main.get_plugin_manifest()
+            self.assertTrue((tmp / 'reprozip/plugins.json').is_file())
+            chroot, = [p for p in manifest['reprounzip.unpackers']
+                       if p['name'] == 'chroot']
+            self.assertEqual(chroot['module'],
+                             'reprounzip.unpackers.default')
+            self.assertTrue(chroot['description'].startswith("Unpacks"))
+            self.assertEqual(reprounzip.main.get_plugin_manifest(),
+                             manifest)
+            self.assertEqual(len(scans), 1)
+
+            # Changing the installed distributions invalidates it
+            old_path = sys.path
+            sys.path = sys.path + [str(tmp)]
+            try:
+                reprounzip.main.get_plugin_manifest()
+            finally:
+                sys.path = old_path
+            self.assertEqual(len(scans), 2)
+
+            self.assertEqual(
+                reprounzip.main._selected_subcommand(['-v', '-vv', 'chroot',
+                                                      'run', '.']),
+                'chroot')
+        finally:
+            reprounzip.main._scan_plugins = old_scan
+            os.environ.clear()
+            os.environ.update(old_environ)
+            tmp.rmtree()
+
+    def test_info_unpackers(self):
+        """Tests that 'info' gets the compatibility of every unpacker"""
+        import reprounzip.main
+        from reprounzip.pack_info import get_package_info
+
+        tmp = Path.tempdir(prefix='rpz_testinfo_')
+        old_environ = dict(os.environ)
+        old_unpackers = dict(reprounzip.main.unpackers)
+        os.environ['XDG_CACHE_HOME'] = str(tmp)
+        try:
+            config = tmp / 'config.yml'
+            runs = [{'id': 'run0', 'binary': '/bin/true',
+                     'argv': ['true'], 'environ': {}, 'workingdir': '/',
+                     'architecture': 'x86_64',
+                     'distribution': ['debian', '10'],
+                     'uid': 1000, 'gid': 1000}]
+            save_config(config, runs, [], [], '0.8', {}, canonical=True)
+            pack = tmp / 'pack.rpz'
+            tar = tarfile.open(str(pack), 'w:gz')
+            version = tarfile.TarInfo('METADATA/version')
+            version.size = len(b'REPROZIP VERSION 1\n')
+            tar.addfile(version, io.BytesIO(b'REPROZIP VERSION 1\n'))
+            tar.add(str(config), 'METADATA/config.yml')
+            tar.close()
+
+            reprounzip.main.unpackers.clear()
+            parser = argparse.ArgumentParser()
+            reprounzip.main.add_unpackers(parser.add_subparsers(),
+                                          lambda opts: None, 'info')
+            info = get_package_info(pack)
+            names = set(name
+                        for status in info['unpacker_status'].values()
+                        for name, msg in status)
+            self.assertIn('directory', names)
+            self.assertIn('chroot', names)
+        finally:
+            reprounzip.main.unpackers.clear()
+            reprounzip.main.unpackers.update(old_unpackers)
+            os.environ.clear()
+            os.environ.update(old_environ)
+            tmp.rmtree()
+
+
+class TestConfig(unittest.TestCase):
+    def test_save_presorted(self):
+        """Saves a configuration from sorted generators"""
+        tmp = Path.tempdir(prefix='rpz_testconfig_')
+        try:
+            def packages():
+                for name in ('a', 'b'):
+                    yield Package(
+                        name, '1.0',
+                        (File(PosixPath('/usr/%s/%d' % (name, i)), 1024)
+                         for i in range(3)))
+
+            def other_files():
+                for i in range(5):
+                    yield File(PosixPath('/home/user/"%d"' % i))
+
+            runs = [{'id': 'run0', 'argv': ['true']}]
+            save_config(tmp / 'sorted.yml', runs,
+                        reversed(list(packages())),
+                        reversed(list(other_files())),
+                        '1.0', {}, canonical=True, pack_id='1')
+            save_config(tmp / 'presorted.yml', runs,
+                        packages(), other_files(),
+                        '1.0', {}, canonical=True, pack_id='1',
+                        presorted=True)
+
+            with (tmp / 'sorted.yml').open('r', encoding='utf-8') as fp:
+                expected = fp.readlines()[2:]
+            with (tmp / 'presorted.yml').open('r', encoding='utf-8') as fp:
+                self.assertEqual(fp.readlines()[2:], expected)
+
+            config = load_config(tmp / 'presorted.yml', canonical=True)
+            self.assertEqual([pkg.name for pkg in config.packages],
+                             ['a', 'b'])
+            self.assertEqual([f.path for f in config.packages[1].files],
+                             [PosixPath('/usr/b/%d' % i) for i in range(3)])
+            self.assertEqual([f.path for f in config.other_files],
+                             [PosixPath('/home/user/"%d"' % i)
+                              for i in range(5)])
+        finally:
+            tmp.rmtree()
+
 
 class TestCommon(unittest.TestCase):
     def test_env(self):
@@ -8,6 +8,7 @@ import os
 
 import sqlite3
 from rpaths import AbstractPath, Path
+import subprocess
 import sys
 import unittest
 
@@ -106,6 +107,26 @@ class TestReprozip(unittest.TestCase):
             sys.argv = old_argv
             reprozip.main.testrun, reprozip.main.setup_logging = old_funcs
 
+    @unittest.skipIf(sys.version_info < (3, 7), "Needs -X importtime")
+    def test_startup_imports(self):
+        """Checks that tracing doesn't import the heavy modules."""
+        env = dict(os.environ, REPROZIP_USAGE_STATS='off')
+        proc = subprocess.Popen(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import reprozip.main, reprozip.tracer.trace; '
+             'reprozip.main.setup_usage_report("reprozip", "1.0"); '
+             'reprozip.main.submit_usage_report(result="success")'],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        modules = set(line.rsplit(b'|', 1)[1].strip().decode('ascii')
+                      for line in err.splitlines()
+                      if line.startswith(b'import time:'))
+        self.assertIn('reprozip.tracer.trace', modules)
+        for module in ('reprozip.pack', 'reprozip.traceutils', 'usagestats',
+                       'requests', 'pkg_resources', 'distutils'):
+            self.assertNotIn(module, modules)
+
 
 class TestNames(unittest.TestCase):
     def test_uniquenames(self):
@@ -284,11 +305,22 @@ INSERT INTO "opened_files" VALUES(3,1,'/usr/bin',12345678902004,4,1,3);
 INSERT INTO "executed_files" VALUES(1,'/usr/bin/id',1,12345678902006,4,'id',
     'RUN=third','/home/vagrant');
             ''',
+            # Empty trace
+            schema,
             schema + '''
 INSERT INTO "processes" VALUES(0,0,NULL,12345678903001,0,1);
 INSERT INTO "opened_files" VALUES(0,0,'/home',12345678903001,4,1,0);
 INSERT INTO "executed_files" VALUES(1,'/bin/false',0,12345678903002,0,'false',
     'RUN=fourth','/home');
+            ''',
+            schema + '''
+INSERT INTO "processes" VALUES(5,0,NULL,12345678904001,0,0);
+INSERT INTO "processes" VALUES(9,2,NULL,12345678904002,0,0);
+INSERT INTO "opened_files" VALUES(1,0,'/tmp',12345678904001,4,1,5);
+INSERT INTO "opened_files" VALUES(2,2,'/tmp/a',12345678904003,1,0,9);
+INSERT INTO "opened_files" VALUES(3,2,'/tmp/b',12345678904004,1,0,7);
+INSERT INTO "executed_files" VALUES(1,'/bin/true',2,12345678904002,9,'true',
+    'RUN=sixth','/tmp');
             ''']
 
         for i, dat in enumerate(sql_data):
@@ -304,47 +336,65 @@ INSERT INTO "executed_files" VALUES(1,'/bin/false',0,12345678903002,0,'false',
 
             traces.append(trace)
 
-        target = self.tmpdir / 'target'
-        traceutils.combine_traces(traces, target)
-        target = target / 'trace.sqlite3'
+        def combine(target, **kwargs):
+            traceutils.combine_traces(traces, target, **kwargs)
+            target = target / 'trace.sqlite3'
 
-        if PY3:
-            conn = sqlite3.connect(str(target))
-        else:
-            conn = sqlite3.connect(target.path)
-        conn.row_factory = None
-        processes = list(conn.execute(
-            '''
-            SELECT * FROM processes;
-            '''))
-        opened_files = list(conn.execute(
-            '''
-            SELECT * FROM opened_files;
-            '''))
-        executed_files = list(conn.execute(
-            '''
-            SELECT * FROM executed_files;
-            '''))
-
-        self.assertEqual([processes, opened_files, executed_files], [
+            if PY3:
+                conn = sqlite3.connect(str(target))
+            else:
+                conn = sqlite3.connect(target.path)
+            conn.row_factory = None
+            processes = list(conn.execute(
+                '''
+                SELECT * FROM processes;
+                '''))
+            opened_files = list(conn.execute(
+                '''
+                SELECT * FROM opened_files;
+                '''))
+            executed_files = list(conn.execute(
+                '''
+                SELECT * FROM executed_files;
+                '''))
+            conn.close()
+            return [processes, opened_files, executed_files]
+
+        result = combine(self.tmpdir / 'target')
+        self.assertEqual(result, [
             [(1, 1, None, 12345678901001, 0, 0),
              (2, 2, None, 12345678902001, 0, 0),
              (3, 2, 1, 12345678902002, 1, 0),
              (4, 3, None, 12345678902004, 0, 0),
              (5, 3, 3, 12345678902005, 0, 1),
-             (6, 4, None, 12345678903001, 0, 1)],
+             (6, 4, None, 12345678903001, 0, 1),
+             (7, 5, None, 12345678904001, 0, 0),
+             (8, 6, None, 12345678904002, 0, 0)],
 
             [(1, 1, '/home/vagrant', 12345678901001, 4, 1, 1),
              (2, 1, '/lib/ld.so', 12345678901003, 1, 0, 1),
              (3, 2, '/usr', 12345678902001, 4, 1, 2),
              (4, 2, '/lib/ld.so', 12345678902003, 1, 0, 3),
              (5, 3, '/usr/bin', 12345678902004, 4, 1, 4),
-             (6, 4, '/home', 12345678903001, 4, 1, 6)],
+             (6, 4, '/home', 12345678903001, 4, 1, 6),
+             (7, 5, '/tmp', 12345678904001, 4, 1, 7),
+             (8, 6, '/tmp/a', 12345678904003, 1, 0, 8)],
 
             [(1, '/usr/bin/id', 1, 12345678901002, 1, 'id',
               'RUN=first', '/home/vagrant'),
              (2, '/usr/bin/id', 3, 12345678902006, 5, 'id',
               'RUN=third', '/home/vagrant'),
              (3, '/bin/false', 4, 12345678903002, 6, 'false',
-              'RUN=fourth', '/home')],
+              'RUN=fourth', '/home'),
+             (4, '/bin/true', 6, 12345678904002, 8, 'true',
+              'RUN=sixth', '/tmp')],
         ])
+
+        # Merging groups of traces in parallel gives the same result
+        old_batch_size = traceutils.COMBINE_BATCH_SIZE
+        traceutils.COMBINE_BATCH_SIZE = 1
+        try:
+            self.assertEqual(combine(self.tmpdir / 'target2', jobs=3),
+                             result)
+        finally:
+            traceutils.COMBINE_BATCH_SIZE = old_batch_size
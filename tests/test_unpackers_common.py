@@ -4,11 +4,28 @@
 
 from __future__ import print_function, unicode_literals
 
+import contextlib
+import io
+import os
+import pickle
+from rpaths import Path, PosixPath
+import socket
+import subprocess
 import sys
+import tarfile
+import threading
+import time
 import unittest
 
-from reprounzip.unpackers.common import UsageError, \
-    unique_names, make_unique_name, get_runs
+import reprounzip.common
+from reprounzip.unpackers.common import UsageError, FileUploader, \
+    FileDownloader, load_target_config, metadata_read, metadata_write, \
+    metadata_update, \
+    unique_names, make_unique_name, get_runs, delta_hashes_command, \
+    parse_block_hashes, delta_write_command
+from reprounzip.unpackers.common import x11
+from reprounzip.unpackers.common.tracecache import file_trace_key, \
+    pack_trace_key
 from reprounzip.utils import irange
 
 
@@ -74,3 +91,496 @@ class TestMisc(unittest.TestCase):
             self.do_ok('2-3,two-heh', [2, 3, 1])
         finally:
             print(">>>>> get_runs tests", file=sys.stderr)
+
+
+class TestTargetConfig(unittest.TestCase):
+    config = """\
+version: "0.8"
+runs:
+- id: run0
+  binary: /bin/sh
+  argv: [sh, script.sh]
+  workingdir: /home/user
+inputs_outputs:
+- name: data
+  path: /home/user/data.csv
+  read_by_runs: [0]
+  written_by_runs: []
+packages:
+- name: pkg
+  version: "1.0"
+  packfiles: true
+  files:
+  - /usr/lib/lib%s.so
+other_files:
+- /home/user/script.sh
+"""
+
+    def setUp(self):
+        self.target = Path.tempdir(prefix='rpz_testconfig_')
+        self.write_config('one')
+        self.old_read = reprounzip.common.read_config_document
+        self.reads = 0
+
+        def read_config_document(filename):
+            self.reads += 1
+            return self.old_read(filename)
+        reprounzip.common.read_config_document = read_config_document
+
+    def tearDown(self):
+        reprounzip.common.read_config_document = self.old_read
+        self.target.rmtree()
+
+    def write_config(self, libname):
+        with (self.target / 'config.yml').open('w') as fp:
+            fp.write(self.config % libname)
+
+    def check_config(self, libname):
+        config = load_target_config(self.target)
+        self.assertEqual(config.runs[0]['argv'], ['sh', 'script.sh'])
+        self.assertEqual(config.inputs_outputs['data'].path,
+                         PosixPath('/home/user/data.csv'))
+        self.assertEqual(config.runs[0]['input_files'],
+                         {'data': PosixPath('/home/user/data.csv')})
+        self.assertEqual([f.path for f in config.packages[0].files],
+                         [PosixPath('/usr/lib/lib%s.so' % libname)])
+        self.assertEqual([f.path for f in config.other_files],
+                         [PosixPath('/home/user/script.sh')])
+
+    def test_cache(self):
+        """Loads the configuration of an unpacked directory twice."""
+        self.check_config('one')
+        self.assertTrue((self.target / '.reprounzip-config').is_file())
+        self.assertEqual(
+            (self.target / '.reprounzip-config').stat().st_mode & 0o777,
+            0o644)
+        self.check_config('one')
+        self.assertEqual(self.reads, 1)
+
+        # Same content, different modification time
+        os.utime((self.target / 'config.yml').path, (0, 0))
+        self.check_config('one')
+        self.assertEqual(self.reads, 1)
+
+        # Changed content
+        self.write_config('two')
+        self.check_config('two')
+        self.assertEqual(self.reads, 2)
+        self.check_config('two')
+        self.assertEqual(self.reads, 2)
+
+        # Invalid cache
+        with (self.target / '.reprounzip-config').open('wb') as fp:
+            fp.write(b'garbage')
+        self.check_config('two')
+        self.assertEqual(self.reads, 3)
+
+    def test_lazy_files(self):
+        """Only creates the files of a package when they are used."""
+        package = load_target_config(self.target).packages[0]
+        self.assertEqual(package.nb_files, 1)
+        self.assertIsNotNone(package._file_paths)
+        self.assertEqual([f.path for f in package.files],
+                         [PosixPath('/usr/lib/libone.so')])
+        self.assertIsNone(package._file_paths)
+        self.assertIs(package.files, package.files)
+        package.files = []
+        self.assertEqual(package.nb_files, 0)
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self.target = Path.tempdir(prefix='rpz_testmetadata_')
+
+    def tearDown(self):
+        self.target.rmtree()
+
+    def test_read_write(self):
+        """Writes and reads back the metadata of an unpacked directory."""
+        self.assertRaises(UsageError, metadata_read, self.target, 'docker')
+        metadata_write(self.target, {'input_files': {'a': True}}, 'docker')
+        self.assertEqual(metadata_read(self.target, 'docker'),
+                         {'unpacker': 'docker', 'metadata_version': 1,
+                          'input_files': {'a': True}})
+        self.assertRaises(UsageError, metadata_read, self.target, 'vagrant')
+        self.assertEqual([p.unicodename for p in self.target.listdir()],
+                         ['.reprounzip'])
+        self.assertEqual((self.target / '.reprounzip').stat().st_mode & 0o777,
+                         0o644)
+
+        # Changing what was returned doesn't change the cached copy
+        metadata_read(self.target, None)['input_files']['a'] = False
+        self.assertEqual(metadata_read(self.target, None)['input_files'],
+                         {'a': True})
+
+        # Changes made by other processes are seen
+        with (self.target / '.reprounzip').open('wb') as fp:
+            pickle.dump({'unpacker': 'docker', 'other': 'value'}, fp, 2)
+        self.assertEqual(metadata_read(self.target, 'docker'),
+                         {'unpacker': 'docker', 'other': 'value'})
+
+        # Newer format
+        with (self.target / '.reprounzip').open('wb') as fp:
+            pickle.dump({'unpacker': 'docker', 'metadata_version': 99},
+                        fp, 2)
+        self.assertRaises(UsageError, metadata_read, self.target, 'docker')
+
+    def test_update(self):
+        """Updates the metadata from several threads."""
+        metadata_write(self.target, {'counter': 0}, 'chroot')
+
+        def increment():
+            for _ in irange(20):
+                with metadata_update(self.target, 'chroot') as dct:
+                    dct['counter'] += 1
+
+        threads = [threading.Thread(target=increment) for _ in irange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metadata_read(self.target, 'chroot')['counter'], 80)
+
+        # Not written back if there is an error
+        with self.assertRaises(KeyError):
+            with metadata_update(self.target, 'chroot') as dct:
+                dct['counter'] = 0
+                dct['missing']
+        self.assertEqual(metadata_read(self.target, 'chroot')['counter'], 80)
+
+
+class TestTraceCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testtracecache_')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def make_pack(self, pack_id, trace, mtime):
+        pack = self.tmp / 'pack.rpz'
+        tar = tarfile.open(str(pack), 'w')
+        # The file list after the runs is never parsed
+        config = ('# ReproZip configuration file\n\n'
+                  '# Run info\npack_id: "%s"\nversion: "0.8"\n'
+                  'runs:\n- [not, valid\n' % pack_id).encode('utf-8')
+        for name, data in [('METADATA/version', b'REPROZIP VERSION 1\n'),
+                           ('METADATA/config.yml', config),
+                           ('METADATA/trace.sqlite3', trace)]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            tar.addfile(info, io.BytesIO(data))
+        tar.close()
+        rpz_pack = reprounzip.common.RPZPack(pack)
+        try:
+            return pack_trace_key(rpz_pack)
+        finally:
+            rpz_pack.close()
+
+    def test_keys(self):
+        """Computes cache keys from the pack_id and trace metadata."""
+        key = self.make_pack('abc', b'trace', 1000)
+        self.assertEqual(self.make_pack('abc', b'trace', 1000), key)
+        self.assertNotEqual(self.make_pack('def', b'trace', 1000), key)
+        self.assertNotEqual(self.make_pack('abc', b'trace2', 1000), key)
+        self.assertNotEqual(self.make_pack('abc', b'trace', 2000), key)
+
+        database = self.tmp / 'trace.sqlite3'
+        with database.open('wb') as fp:
+            fp.write(b'trace')
+        key = file_trace_key(database)
+        self.assertEqual(file_trace_key(database), key)
+        self.assertNotEqual(file_trace_key(database, 'abc'), key)
+        os.utime(database.path, (2000, 2000))
+        self.assertNotEqual(file_trace_key(database), key)
+
+
+class ShellDeltaUploader(FileUploader):
+    """Uploader updating a local file using the shell commands.
+    """
+    delta_block_size = 16
+
+    def __init__(self, remote_path):
+        self.remote_path = remote_path
+        self.sent = 0
+
+    def get_block_hashes(self, input_path, block_size):
+        proc = subprocess.Popen(['/bin/sh', '-c', delta_hashes_command(
+            self.remote_path.path, block_size)],
+            stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            return None
+        return parse_block_hashes(output)
+
+    def write_blocks(self, local_path, input_path, runs, truncate):
+        with local_path.open('rb') as fp:
+            for i, (first_block, count) in enumerate(runs):
+                proc = subprocess.Popen(['/bin/sh', '-c', delta_write_command(
+                    self.remote_path.path, self.delta_block_size, first_block,
+                    truncate and i == len(runs) - 1)],
+                    stdin=subprocess.PIPE)
+                for chunk in self.read_blocks(fp, first_block, count):
+                    self.sent += len(chunk)
+                    proc.stdin.write(chunk)
+                proc.stdin.close()
+                if proc.wait() != 0:
+                    raise subprocess.CalledProcessError(proc.returncode,
+                                                        'dd')
+
+
+@unittest.skipIf(sys.platform.startswith('win'), "Needs a POSIX shell")
+class TestDeltaUpload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testdelta_')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def do_upload(self, old, new, sent):
+        remote = self.tmp / 'remote'
+        local = self.tmp / 'local'
+        with remote.open('wb') as fp:
+            fp.write(old)
+        with local.open('wb') as fp:
+            fp.write(new)
+        uploader = ShellDeltaUploader(remote)
+        self.assertTrue(uploader.upload_delta(local, None))
+        with remote.open('rb') as fp:
+            self.assertEqual(fp.read(), new)
+        self.assertEqual(uploader.sent, sent)
+
+    def test_delta(self):
+        """Uploads only the changed blocks of a file."""
+        old = b''.join(b'block %9d\n' % i for i in irange(8))
+        # Same file
+        self.do_upload(old, old, 0)
+        # Two blocks changed
+        new = old[:20] + b'X' + old[21:60] + b'Y' + old[61:]
+        self.do_upload(old, new, 32)
+        # File grows
+        self.do_upload(old, old + b'more', 4)
+        self.do_upload(old, old + b'more' * 8, 32)
+        # File shrinks
+        self.do_upload(old, old[:100], 4)
+        self.do_upload(old, old[:96], 16)
+        self.do_upload(old, b'', 0)
+        # New file from empty file
+        self.do_upload(b'', old, 128)
+
+    def test_missing(self):
+        """Falls back to a full upload if the file doesn't exist."""
+        uploader = ShellDeltaUploader(self.tmp / 'nonexistent')
+        local = self.tmp / 'local'
+        with local.open('wb') as fp:
+            fp.write(b'data')
+        self.assertFalse(uploader.upload_delta(local, None))
+
+
+class DictDownloader(FileDownloader):
+    """Downloader getting files from a dict.
+    """
+    def __init__(self, files, max_workers=1, archive=False):
+        self.files = files
+        self.max_workers = max_workers
+        self.archive = archive
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def download(self, remote_path, local_path):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(0.05)
+            if remote_path not in self.files:
+                return False
+            with local_path.open('wb') as fp:
+                fp.write(self.files[remote_path])
+            return True
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def download_archive(self, remote_paths):
+        if not self.archive:
+            return None
+        fp = io.BytesIO()
+        tar = tarfile.open(fileobj=fp, mode='w')
+        for path in remote_paths:
+            if path in self.files:
+                info = tarfile.TarInfo(str(path)[1:])
+                info.size = len(self.files[path])
+                tar.addfile(info, io.BytesIO(self.files[path]))
+        tar.close()
+        fp.seek(0)
+        return fp
+
+
+class TestDownload(unittest.TestCase):
+    files = {PosixPath('/tmp/one'): b'first file',
+             PosixPath('/tmp/two'): b'second',
+             PosixPath('/home/user/three'): b'the third file'}
+
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testdownload_')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def do_download(self, downloader):
+        jobs = [(PosixPath('/tmp/one'), self.tmp / 'one'),
+                (PosixPath('/tmp/two'), self.tmp / 'two'),
+                (PosixPath('/tmp/one'), self.tmp / 'one_again'),
+                (PosixPath('/home/user/three'), self.tmp / 'three')]
+        self.assertTrue(downloader.download_files(jobs))
+        for remote_path, local_path in jobs:
+            with local_path.open('rb') as fp:
+                self.assertEqual(fp.read(), self.files[remote_path])
+        self.assertFalse(downloader.download_files(
+            jobs[:2] + [(PosixPath('/tmp/missing'), self.tmp / 'missing')]))
+        self.assertFalse((self.tmp / 'missing').exists())
+
+    def test_parallel(self):
+        """Downloads files from several threads."""
+        downloader = DictDownloader(self.files, max_workers=3)
+        self.do_download(downloader)
+        self.assertEqual(downloader.max_running, 3)
+        self.assertEqual(downloader.running, 0)
+
+    def test_sequential(self):
+        """Downloads files one at a time."""
+        downloader = DictDownloader(self.files)
+        self.do_download(downloader)
+        self.assertEqual(downloader.max_running, 1)
+
+    def test_archive(self):
+        """Downloads files as a single archive."""
+        downloader = DictDownloader(self.files, archive=True)
+        self.do_download(downloader)
+        self.assertEqual(downloader.max_running, 0)
+
+
+class TestForwarder(unittest.TestCase):
+    """Forwards connections to an echo server."""
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        t = threading.Thread(target=self.echo_server)
+        t.daemon = True
+        t.start()
+
+    def tearDown(self):
+        self.server.close()
+
+    def echo_server(self):
+        while True:
+            try:
+                conn, addr = self.server.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.echo, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    @staticmethod
+    def echo(conn):
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            conn.sendall(data)
+        conn.close()
+
+    @contextlib.contextmanager
+    def connector(self, src_addr):
+        sock = socket.create_connection(self.server.getsockname())
+        yield sock
+        sock.close()
+
+    def do_forward(self):
+        forwarder = x11.LocalForwarder(self.connector)
+        data = [os.urandom(1 << 20) for _ in irange(4)]
+        clients = [socket.create_connection(('127.0.0.1',
+                                             forwarder.local_port))
+                   for _ in data]
+        senders = [threading.Thread(target=client.sendall, args=(buf,))
+                   for client, buf in zip(clients, data)]
+        for t in senders:
+            t.start()
+        for client, buf in zip(clients, data):
+            received = []
+            size = 0
+            while size < len(buf):
+                chunk = client.recv(65536)
+                self.assertTrue(chunk)
+                received.append(chunk)
+                size += len(chunk)
+            self.assertEqual(b''.join(received), buf)
+        for t in senders:
+            t.join()
+        for client in clients:
+            client.close()
+        # The counters are updated after the data is sent
+        deadline = time.time() + 5
+        while (forwarder.bytes_downstream < 4 << 20 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(forwarder.connections, 4)
+        self.assertEqual(forwarder.bytes_upstream, 4 << 20)
+        self.assertEqual(forwarder.bytes_downstream, 4 << 20)
+
+    def test_forward(self):
+        """Forwards from the event loop, with splice() if available."""
+        self.do_forward()
+
+    def test_forward_buffered(self):
+        """Forwards from the event loop, through buffers."""
+        old_splice, x11._splice_supported = x11._splice_supported, False
+        try:
+            self.do_forward()
+        finally:
+            x11._splice_supported = old_splice
+
+    def test_forward_error(self):
+        """Keeps forwarding other connections after an error."""
+        if x11.selectors is None:
+            self.skipTest("No selectors module")
+        old_handle = x11._ForwardedConnection.handle
+        failed = []
+
+        def handle(connection, sock, mask):
+            if not failed:
+                failed.append(connection)
+                raise ValueError("Broken connection")
+            return old_handle(connection, sock, mask)
+
+        x11._ForwardedConnection.handle = handle
+        try:
+            forwarder = x11.LocalForwarder(self.connector)
+            client = socket.create_connection(('127.0.0.1',
+                                               forwarder.local_port))
+            client.settimeout(5)
+            client.sendall(b'data')
+            # The forwarder closes that connection
+            try:
+                self.assertEqual(client.recv(4), b'')
+            except socket.timeout:
+                raise
+            except socket.error:
+                pass
+            client.close()
+        finally:
+            x11._ForwardedConnection.handle = old_handle
+        self.assertTrue(failed[0].closed)
+        self.do_forward()
+
+    def test_forward_threads(self):
+        """Forwards from a thread per connection."""
+        old_selectors, x11.selectors = x11.selectors, None
+        try:
+            self.do_forward()
+        finally:
+            x11.selectors = old_selectors
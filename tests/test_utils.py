@@ -2,9 +2,24 @@
 # This file is part of ReproZip which is released under the Revised BSD License
 # See file LICENSE for full license details.
 
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import os
+from rpaths import Path
+import threading
 import unittest
 
-from reprounzip.utils import optional_return_type
+from reprounzip.utils import PY3, optional_return_type, download_file, \
+    download_files
+
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 
 class TestOptionalReturnType(unittest.TestCase):
@@ -42,3 +57,120 @@ class TestOptionalReturnType(unittest.TestCase):
         self.assertRaises(TypeError, lambda: T(1))
         self.assertRaises(TypeError, lambda: T(b=1, c=2))
         self.assertRaises(TypeError, lambda: T(c=1))
+
+
+class StubFileHandler(BaseHTTPRequestHandler):
+    """Serves the files of the server, with ETags.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path,
+                                     self.headers.get('If-None-Match')))
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StubFileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubFileHandler)
+        self.files = {}
+        self.requests = []
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='rpz_testdownload_')
+        self.old_cache = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = str(self.tmp / 'cache')
+        self.server = StubFileServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.old_cache is None:
+            os.environ.pop('XDG_CACHE_HOME', None)
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.old_cache
+        self.tmp.rmtree()
+
+    def read(self, path):
+        with path.open('rb') as fp:
+            return fp.read()
+
+    def test_cache(self):
+        """Downloads a file, then uses or revalidates the cached copy."""
+        server = self.server
+        server.files['/busybox'] = b'busybox v1' * 1000
+        dest = self.tmp / 'busybox'
+        download_file(self.url + '/busybox', dest, 'busybox-test')
+        self.assertEqual(self.read(dest), b'busybox v1' * 1000)
+        self.assertEqual(len(server.requests), 1)
+
+        # Fresh: the server is not contacted
+        download_file(self.url + '/busybox', dest, 'busybox-test')
+        self.assertEqual(self.read(dest), b'busybox v1' * 1000)
+        self.assertEqual(len(server.requests), 1)
+
+        # Stale: revalidated with the ETag
+        download_file(self.url + '/busybox', dest, 'busybox-test', ttl=0)
+        self.assertEqual(len(server.requests), 2)
+        self.assertIsNotNone(server.requests[1][1])
+        self.assertEqual(self.read(dest), b'busybox v1' * 1000)
+
+        # Changed on the server
+        server.files['/busybox'] = b'busybox v2'
+        download_file(self.url + '/busybox', dest, 'busybox-test', ttl=0)
+        self.assertEqual(self.read(dest), b'busybox v2')
+
+        # Modified through the hard link: downloaded again
+        with dest.open('wb') as fp:
+            fp.write(b'busybox v3')
+        download_file(self.url + '/busybox', dest, 'busybox-test')
+        self.assertEqual(self.read(dest), b'busybox v2')
+        self.assertEqual(len(server.requests), 4)
+
+        # Server is down: the cache is used
+        server.files.clear()
+        dest.remove()
+        download_file(self.url + '/busybox', dest, 'busybox-test', ttl=0)
+        self.assertEqual(self.read(dest), b'busybox v2')
+
+        # Different URL, not available
+        self.assertRaises(Exception, download_file,
+                          self.url + '/missing', None, 'missing-test')
+
+    def test_parallel(self):
+        """Downloads several files concurrently."""
+        self.server.files['/a'] = b'first file'
+        self.server.files['/b'] = b'second file'
+        download_files([(self.url + '/a', self.tmp / 'a', None),
+                        (self.url + '/b', self.tmp / 'b', 'b-test')])
+        self.assertEqual(self.read(self.tmp / 'a'), b'first file')
+        self.assertEqual(self.read(self.tmp / 'b'), b'second file')
+        self.assertEqual(sorted(path for path, _ in self.server.requests),
+                         ['/a', '/b'])
+        self.assertEqual(
+            sorted(p.unicodename for p in (self.tmp / 'cache/reprozip')
+                   .listdir()),
+            ['a', 'a.info', 'b-test', 'b-test.info'])